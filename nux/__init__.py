@@ -1,5 +1,9 @@
-from nux.internal import *
-from nux.flows import *
-from nux.models import *
-import nux.util
-from nux.training import *
\ No newline at end of file
+from nux.lazy import lazy_exports
+
+# Everything is imported the first time that it is used
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.internal",
+                                     "nux.flows",
+                                     "nux.models",
+                                     "nux.training"],
+                                    submodules=["internal", "util", "flows", "networks", "models", "vae", "training", "serving", "benchmarks"])
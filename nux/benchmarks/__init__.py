@@ -0,0 +1 @@
+""" Benchmarks are scripts.  Run them with python -m nux.benchmarks.<name> """
@@ -0,0 +1,55 @@
+import jax.numpy as jnp
+import jax
+from jax import random
+import argparse
+import nux
+from nux.benchmarks.timing import time_trace, time_compile_and_run
+
+""" Compare the trace and compile times of the auto_batch strategies on inputs with two
+    batch axes, like the ones that scan_apply and the trainer use.
+
+    python -m nux.benchmarks.auto_batch_benchmark --n_layers 8 """
+
+################################################################################################################
+
+def create_fun(n_layers):
+  def create():
+    layers = []
+    for i in range(n_layers):
+      layers.append(nux.Coupling())
+      layers.append(nux.Reverse())
+    layers.append(nux.UnitGaussianPrior())
+    return nux.sequential(*layers)
+  return create
+
+def benchmark(n_layers: int=8, batch_shape=(4, 16), dim: int=16):
+  key = random.PRNGKey(0)
+  inputs = {"x": random.normal(key, batch_shape + (dim,))}
+
+  flow = nux.transform_flow(create_fun(n_layers))
+  params, state = flow.init(key, inputs, batch_axes=tuple(range(len(batch_shape))))
+
+  results = {}
+  default_strategy = nux.Layer.auto_batch_strategy
+  for strategy in ["nested_vmap", "collapse"]:
+    nux.Layer.auto_batch_strategy = strategy
+    apply_fun = lambda params, state, key, inputs: flow.apply(params, state, key, inputs)[0]["x"]
+
+    result = {"trace_time": time_trace(apply_fun, params, state, key, inputs)}
+    result.update(time_compile_and_run(apply_fun, params, state, key, inputs))
+    results[strategy] = result
+
+  nux.Layer.auto_batch_strategy = default_strategy
+  return results
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--n_layers", type=int, default=8)
+  parser.add_argument("--n_outer", type=int, default=4)
+  parser.add_argument("--batch_size", type=int, default=16)
+  parser.add_argument("--dim", type=int, default=16)
+  args = parser.parse_args()
+
+  results = benchmark(args.n_layers, (args.n_outer, args.batch_size), args.dim)
+  for strategy, result in results.items():
+    print(f"{strategy:>12}: " + ", ".join([f"{name}={value*1000:.1f}ms" for name, value in result.items()]))
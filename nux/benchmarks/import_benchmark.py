@@ -0,0 +1,51 @@
+import subprocess
+import argparse
+import sys
+import numpy as np
+
+""" Time "import nux" in fresh processes.  Fails if a median is over budget so that it can be
+    used as a check for short lived jobs.  A plain import doesn't import JAX at all.  Using a layer
+    imports JAX and haiku, but not the optional parts of a flow like the compilation cache or the profiler.
+
+    python -m nux.benchmarks.import_benchmark --budget_ms 250 --layer_budget_ms 2500 """
+
+################################################################################################################
+
+STATEMENTS = {"import nux": "import nux",
+              "import nux + nux.Coupling": "import nux; nux.Coupling",
+              "import nux + nux.MaximumLikelihoodTrainer": "import nux; nux.MaximumLikelihoodTrainer"}
+
+def time_statement(statement: str, n_runs: int) -> np.ndarray:
+  """ Seconds spent running statement in each of n_runs new interpreters """
+  code = ("import time; start = time.perf_counter(); "
+          f"{statement}; "
+          "print(time.perf_counter() - start)")
+  times = []
+  for _ in range(n_runs):
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    times.append(float(out.stdout.strip().splitlines()[-1]))
+  return np.array(times)
+
+def benchmark(n_runs: int=5):
+  return {name: time_statement(statement, n_runs) for name, statement in STATEMENTS.items()}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--n_runs", type=int, default=5)
+  parser.add_argument("--budget_ms", type=float, default=250.0, help="Budget for the median time of a plain import nux")
+  parser.add_argument("--layer_budget_ms", type=float, default=2500.0, help="Budget for the median time of import nux + nux.Coupling")
+  args = parser.parse_args()
+
+  results = benchmark(args.n_runs)
+  for name, times in results.items():
+    print(f"{name:>42}: median={np.median(times)*1000:.1f}ms min={times.min()*1000:.1f}ms")
+
+  over_budget = False
+  for name, budget_ms in [("import nux", args.budget_ms), ("import nux + nux.Coupling", args.layer_budget_ms)]:
+    median_ms = np.median(results[name])*1000
+    if median_ms > budget_ms:
+      print(f"{name} took {median_ms:.1f}ms, which is over the budget of {budget_ms:.1f}ms")
+      over_budget = True
+
+  if over_budget:
+    sys.exit(1)
@@ -0,0 +1,201 @@
+import jax.numpy as jnp
+import jax
+from jax import random
+import argparse
+import json
+import sys
+from typing import Optional, Mapping, Callable, Sequence, Any, NamedTuple
+import nux
+from nux.internal.remat import peak_memory_bytes
+from nux.benchmarks.timing import time_compile_and_run
+
+""" Compile time, steady state throughput and estimated peak memory of the public layers in the
+    forward (sample=False), inverse (sample=True, reconstruction=True) and value_and_grad
+    directions.  The memory is the jaxpr liveness estimate from peak_memory_bytes, which doesn't
+    know about XLA's fusion and buffer reuse.  It is only meaningful relative to other results from the same estimator.
+
+    python -m nux.benchmarks.layer_benchmark --output results.json
+    python -m nux.benchmarks.layer_benchmark --output results.json --baseline baseline.json
+    python -m nux.benchmarks.layer_benchmark --layers Coupling MAF --sizes small """
+
+################################################################################################################
+
+class LayerCase(NamedTuple):
+  """ name    - Name of the case in the results.
+      create  - Function (x_shape) -> layer.
+      kinds   - Which input kinds the layer supports ("1d" and/or "image").
+  """
+  name: str
+  create: Callable
+  kinds: Sequence[str]
+
+LAYERS = [LayerCase("Coupling", lambda shape: nux.Coupling(), ("1d", "image")),
+          LayerCase("NeuralSpline", lambda shape: nux.NeuralSpline(), ("1d", "image")),
+          LayerCase("CouplingLogitsticMixtureLogit", lambda shape: nux.CouplingLogitsticMixtureLogit(), ("1d", "image")),
+          LayerCase("MAF", lambda shape: nux.MAF(hidden_layer_sizes=[4*shape[-1]]*2), ("1d",)),
+          LayerCase("ResidualFlow", lambda shape: nux.ResidualFlow(), ("1d", "image")),
+          LayerCase("OneByOneConv", lambda shape: nux.OneByOneConv(), ("image",)),
+          LayerCase("CircularConv", lambda shape: nux.CircularConv(filter_shape=(3, 3)), ("image",)),
+          LayerCase("AffineLDU", lambda shape: nux.AffineLDU(), ("1d",)),
+          LayerCase("AffineSVD", lambda shape: nux.AffineSVD(n_householders=4), ("1d",)),
+          LayerCase("MaxPool", lambda shape: nux.MaxPool(), ("image",)),
+          LayerCase("RectangularMVP", lambda shape: nux.RectangularMVP(output_dim=shape[-1]//2), ("1d",))]
+
+SIZES = {"small": {"1d": [(16,)], "image": [(8, 8, 4)]},
+         "medium": {"1d": [(64,)], "image": [(16, 16, 8)]},
+         "large": {"1d": [(256,)], "image": [(32, 32, 16)]}}
+
+MODES = ["forward", "inverse", "grad"]
+
+################################################################################################################
+
+def benchmark_case(case: LayerCase, x_shape: Sequence[int], batch_size: int, n_runs: int, key: jnp.ndarray) -> Sequence[Mapping[str, Any]]:
+  """ Benchmark one layer on one input shape in every mode """
+  inputs = {"x": random.normal(key, (batch_size,) + tuple(x_shape))}
+  flow = nux.transform_flow(lambda: case.create(x_shape))
+  params, state = flow.init(key, inputs, batch_axes=(0,))
+
+  # The inverse reconstructs the inputs from the latents that the forward pass produces.
+  # Without reconstruction=True, surjective layers would sample instead of inverting.
+  outputs, _ = flow.apply(params, state, key, inputs)
+  inverse_inputs = {"x": outputs["x"]}
+
+  def forward(params, state, key, inputs):
+    return flow.apply(params, state, key, inputs)[0]
+
+  def inverse(params, state, key, inputs):
+    return flow.apply(params, state, key, inputs, sample=True, reconstruction=True)[0]
+
+  def nll(params, state, key, inputs):
+    outputs, _ = flow.apply(params, state, key, inputs)
+    z = outputs["x"].reshape((batch_size, -1))
+    log_pz = -0.5*jnp.sum(z**2, axis=-1)
+    return -jnp.mean(log_pz + outputs["log_det"])
+
+  mode_funs = {"forward": (forward, inputs),
+               "inverse": (inverse, inverse_inputs),
+               "grad": (jax.value_and_grad(nll), inputs)}
+
+  results = []
+  for mode in MODES:
+    fun, mode_inputs = mode_funs[mode]
+    result = {"layer": case.name,
+              "shape": list(x_shape),
+              "batch_size": batch_size,
+              "mode": mode}
+    try:
+      timings = time_compile_and_run(fun, params, state, key, mode_inputs, n_runs=n_runs)
+      result["compile_time"] = timings["compile_time"]
+      result["run_time"] = timings["run_time"]
+      result["examples_per_sec"] = batch_size/timings["run_time"]
+    except Exception as e:
+      result["error"] = f"{type(e).__name__}: {e}"
+
+    # Separate so that a failure here doesn't throw away the timings
+    try:
+      result["estimated_peak_bytes"] = peak_memory_bytes(fun, params, state, key, mode_inputs)
+    except Exception as e:
+      result["memory_error"] = f"{type(e).__name__}: {e}"
+    results.append(result)
+  return results
+
+def run_benchmarks(layer_names: Optional[Sequence[str]]=None,
+                   sizes: Sequence[str]=("small", "medium", "large"),
+                   batch_size: int=64,
+                   n_runs: int=10) -> Sequence[Mapping[str, Any]]:
+  key = random.PRNGKey(0)
+  results = []
+  for case in LAYERS:
+    if layer_names is not None and case.name not in layer_names:
+      continue
+    for size in sizes:
+      for kind in case.kinds:
+        for x_shape in SIZES[size][kind]:
+          try:
+            results.extend(benchmark_case(case, x_shape, batch_size, n_runs, key))
+          except Exception as e:
+            # Initialization failed, so none of the modes ran
+            results.append({"layer": case.name, "shape": list(x_shape), "batch_size": batch_size,
+                            "mode": "init", "error": f"{type(e).__name__}: {e}"})
+          print(f"{case.name} {tuple(x_shape)} done", file=sys.stderr)
+  return results
+
+################################################################################################################
+
+def result_key(result: Mapping[str, Any]):
+  return (result["layer"], tuple(result["shape"]), result["batch_size"], result["mode"])
+
+def compare_to_baseline(results: Sequence[Mapping[str, Any]],
+                        baseline: Sequence[Mapping[str, Any]],
+                        tolerance: float=0.1) -> Sequence[Mapping[str, Any]]:
+  """ Compare throughput and estimated peak memory to a baseline.  A result regressed if its
+      examples/sec dropped or its estimated peak memory grew by more than tolerance (relative).
+      The memory is only compared when both results have an estimate.
+  """
+  baseline = {result_key(r): r for r in baseline}
+  comparisons = []
+  for result in results:
+    old = baseline.get(result_key(result), None)
+    if old is None or "error" in old:
+      continue
+
+    comparison = {"layer": result["layer"], "shape": result["shape"], "mode": result["mode"]}
+    if "error" in result:
+      comparison.update({"regressed": True, "reason": result["error"]})
+      comparisons.append(comparison)
+      continue
+
+    speed_ratio = result["examples_per_sec"]/old["examples_per_sec"]
+    if "estimated_peak_bytes" in result and "estimated_peak_bytes" in old:
+      memory_ratio = result["estimated_peak_bytes"]/max(old["estimated_peak_bytes"], 1)
+    else:
+      memory_ratio = None
+    memory_regressed = memory_ratio is not None and memory_ratio > 1 + tolerance
+    comparison.update({"speed_ratio": speed_ratio,
+                       "memory_ratio": memory_ratio,
+                       "compile_time_ratio": result["compile_time"]/max(old["compile_time"], 1e-9),
+                       "regressed": bool(speed_ratio < 1 - tolerance or memory_regressed)})
+    comparisons.append(comparison)
+  return comparisons
+
+def print_results(results: Sequence[Mapping[str, Any]]):
+  print(f"{'layer':>30} {'shape':>14} {'mode':>8} {'compile s':>10} {'ex/sec':>12} {'est. peak MB':>13}")
+  for r in results:
+    memory = f"{r['estimated_peak_bytes']/1e6:>13.2f}" if "estimated_peak_bytes" in r else f"{'n/a':>13}"
+    if "error" in r:
+      print(f"{r['layer']:>30} {str(tuple(r['shape'])):>14} {r['mode']:>8} error: {r['error']}")
+    else:
+      print(f"{r['layer']:>30} {str(tuple(r['shape'])):>14} {r['mode']:>8} {r['compile_time']:>10.3f} {r['examples_per_sec']:>12.1f} {memory}")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--layers", nargs="*", default=None, help="Names of the layers to run.  Runs all of them by default.")
+  parser.add_argument("--sizes", nargs="*", default=["small", "medium", "large"], choices=list(SIZES.keys()))
+  parser.add_argument("--batch_size", type=int, default=64)
+  parser.add_argument("--n_runs", type=int, default=10)
+  parser.add_argument("--output", type=str, default=None, help="Where to write the results as json")
+  parser.add_argument("--baseline", type=str, default=None, help="Results file to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1)
+  args = parser.parse_args()
+
+  results = run_benchmarks(args.layers, args.sizes, args.batch_size, args.n_runs)
+  print_results(results)
+
+  report = {"jax": jax.__version__,
+            "backend": jax.default_backend() if hasattr(jax, "default_backend") else jax.lib.xla_bridge.get_backend().platform,
+            "results": results}
+
+  if args.baseline is not None:
+    with open(args.baseline, "r") as file:
+      baseline = json.load(file)["results"]
+    report["comparison"] = compare_to_baseline(results, baseline, args.tolerance)
+    regressions = [c for c in report["comparison"] if c["regressed"]]
+    for c in regressions:
+      print(f"Regression: {c}")
+
+  if args.output is not None:
+    with open(args.output, "w") as file:
+      json.dump(report, file, indent=2)
+
+  if args.baseline is not None and len(regressions) > 0:
+    sys.exit(1)
@@ -0,0 +1,39 @@
+import jax.numpy as jnp
+import jax
+import time
+from typing import Callable, Mapping, Any
+from nux.util import block
+
+__all__ = ["time_trace",
+           "time_compile_and_run"]
+
+################################################################################################################
+
+def partial_kwargs(fun, kwargs):
+  def wrapped(*args):
+    return fun(*args, **kwargs)
+  return wrapped
+
+def time_trace(fun: Callable, *args, **kwargs) -> float:
+  """ Seconds that it takes to trace fun into a jaxpr """
+  start = time.perf_counter()
+  jax.make_jaxpr(partial_kwargs(fun, kwargs))(*args)
+  return time.perf_counter() - start
+
+def time_compile_and_run(fun: Callable, *args, n_runs: int=10, **kwargs) -> Mapping[str, float]:
+  """ Jit a fresh copy of fun and time the first call (trace + compile + run) and the
+      steady state calls after it.
+  """
+  jitted = jax.jit(partial_kwargs(fun, kwargs))
+
+  start = time.perf_counter()
+  block(jitted(*args))
+  first_call = time.perf_counter() - start
+
+  start = time.perf_counter()
+  for _ in range(n_runs):
+    block(jitted(*args))
+  run_time = (time.perf_counter() - start)/n_runs
+
+  return {"compile_time": max(first_call - run_time, 0.0),
+          "run_time": run_time}
@@ -1,5 +1,9 @@
-from nux.internal.layer import Layer
-from nux.flows.compose import *
-from nux.flows.bijective import *
-from nux.flows.surjective import *
-from nux.flows.priors import *
\ No newline at end of file
+from nux.lazy import lazy_exports
+
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.flows.compose",
+                                     "nux.flows.bijective",
+                                     "nux.flows.surjective",
+                                     "nux.flows.priors"],
+                                    submodules=["compose", "bijective", "surjective", "priors"],
+                                    names={"Layer": "nux.internal.layer"})
@@ -187,8 +187,8 @@ class AffineDense(Layer):
 ################################################################################################################
 
 tri_solve = jax.scipy.linalg.solve_triangular
-L_solve = jax.jit(partial(tri_solve, lower=True, unit_diagonal=True))
-U_solve = jax.jit(partial(tri_solve, lower=False, unit_diagonal=True))
+L_solve = util.tracked_jit(partial(tri_solve, lower=True, unit_diagonal=True), name="L_solve")
+U_solve = util.tracked_jit(partial(tri_solve, lower=False, unit_diagonal=True), name="U_solve")
 
 class AffineLDU(Layer):
 
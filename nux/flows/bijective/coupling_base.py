@@ -6,6 +6,7 @@ from functools import partial
 import haiku as hk
 from typing import Optional, Mapping, Callable, Sequence
 from nux.internal.layer import Layer
+from nux.internal.precision import MixedPrecisionNetwork
 import nux.util as util
 import nux.networks as net
 from abc import ABC, abstractmethod
@@ -52,9 +53,12 @@ class CouplingBase(Layer, ABC):
   def get_network(self, out_shape):
     # The user can specify a custom network
     if self.create_network is not None:
-      return self.create_network(out_shape)
+      network = self.create_network(out_shape)
+    else:
+      network = util.get_default_network(out_shape, network_kwargs=self.network_kwargs)
 
-    return util.get_default_network(out_shape, network_kwargs=self.network_kwargs)
+    # The network can run in lower precision than the coupling transform (see set_precision_policy)
+    return MixedPrecisionNetwork(network)
 
   @abstractmethod
   def get_out_shape(self, x):
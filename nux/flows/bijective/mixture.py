@@ -19,38 +19,44 @@ __all__ = ["LogitsticMixtureLogit",
 
 ################################################################################################################
 
-def bisection_body(f, val):
-  x, current_x, current_z, lower, upper, dx, i = val
+def bisection_body(f, carry, f_args):
+  x, current_z, current_x, lower, upper = carry
 
   gt = current_x > x
-  lt = 1.0 - gt
 
-  new_z = gt*0.5*(current_z + lower) + lt*0.5*(current_z + upper)
-  lower = gt*lower                   + lt*current_z
-  upper = gt*current_z               + lt*upper
+  new_z = jnp.where(gt, 0.5*(current_z + lower), 0.5*(current_z + upper))
+  lower = jnp.where(gt, lower, current_z)
+  upper = jnp.where(gt, current_z, upper)
 
   current_z = new_z
-  current_x = f(current_z)
-  dx = current_x - x
+  current_x = f(*f_args, current_z)
 
-  return x, current_x, current_z, lower, upper, dx, i + 1
+  return x, current_z, current_x, lower, upper
 
-def bisection(f, lower, upper, x, atol=1e-8, max_iters=10000):
-  # Compute f^{-1}(x) using the bisection method.  f must be monotonic.
-  z = jnp.zeros_like(x)
-
-  def cond_fun(val):
-    x, current_x, current_z, lower, upper, dx, i = val
+def bisection(f, lower, upper, x, f_args=(), atol=1e-8, max_iters=10000, compact_fraction=None):
+  # Compute f^{-1}(x) using the bisection method.  f must be monotonic and elementwise and is
+  # called as f(*f_args, z), where the leaves of f_args start with the shape of x.  Every element
+  # stops once it is within atol.  If compact_fraction is set, the elements that are still running
+  # are gathered into a smaller array as the rest finish (see util.masked_while_loop).
+  x_shape = x.shape
+  flatten = lambda a: a.reshape((-1,) + a.shape[len(x_shape):])
+  x, lower, upper, f_args = jax.tree_map(flatten, (x, lower, upper, f_args))
 
-    max_iters_reached = jnp.where(i > max_iters, True, False)
-    tolerance_achieved = jnp.allclose(dx, 0.0, atol=atol)
+  # The target is in the carry so that the convergence test can see it
+  z = jnp.zeros_like(x)
+  carry = (x, z, f(*f_args, z), lower, upper)
 
-    return ~(max_iters_reached | tolerance_achieved)
+  def is_converged(carry):
+    x, current_z, current_x, lower, upper = carry
+    # atol can be below what the dtype can resolve, so also stop once the bracket can't shrink
+    finfo = jnp.finfo(x.dtype)
+    bracket_closed = upper - lower <= 4*finfo.eps*jnp.abs(current_z) + finfo.tiny
+    return (jnp.abs(current_x - x) <= atol) | bracket_closed
 
-  val = (x, f(z), z, lower, upper, jnp.ones_like(x)*10.0, 0.0)
-  val = jax.lax.while_loop(cond_fun, partial(bisection_body, f), val)
-  x, current_x, current_z, lower, upper, dx, i = val
-  return current_z
+  carry = util.masked_while_loop(partial(bisection_body, f), is_converged, carry, f_args,
+                                 max_iters=max_iters, compact_fraction=compact_fraction)
+  x, current_z, current_x, lower, upper = carry
+  return current_z.reshape(x_shape)
 
 ################################################################################################################
 
@@ -58,17 +64,21 @@ class _MixtureCDFMixin(ABC):
   def __init__(self,
                n_components: int=4,
                with_affine_coupling: bool=True,
+               bisection_compact_fraction: Optional[float]=None,
                name: str="mixture_cdf",
                **kwargs
   ):
     """ Base class for a mixture cdf with no coupling
     Args:
-      n_components: Number of mixture components to use
-      name        : Optional name for this module.
+      n_components              : Number of mixture components to use
+      bisection_compact_fraction: When inverting, gather the elements that haven't converged into a
+                                  smaller array once at most this fraction of them is left.
+      name                      : Optional name for this module.
     """
     super().__init__(name=name, **kwargs)
-    self.n_components         = n_components
-    self.with_affine_coupling = with_affine_coupling
+    self.n_components               = n_components
+    self.with_affine_coupling       = with_affine_coupling
+    self.bisection_compact_fraction = bisection_compact_fraction
     self.extra = 2 if with_affine_coupling else 0
 
   def split_theta(self, theta):
@@ -160,8 +170,14 @@ class _MixtureCDFMixin(ABC):
     lower = jnp.zeros_like(x) - 1000
     upper = jnp.zeros_like(x) + 1000
 
-    filled_f = partial(self.f, weight_logits, means, log_scales)
-    x = bisection(filled_f, lower, upper, x)
+    if self.bisection_compact_fraction is None:
+      # bisection works on a flat copy of x, so give f the shape that the parameters broadcast against
+      filled_f = lambda z: self.f(weight_logits, means, log_scales, z.reshape(x.shape)).reshape(z.shape)
+      x = bisection(filled_f, lower, upper, x)
+    else:
+      # Compaction gathers the elements that are still running, so it needs the parameters per element
+      f_args = [jnp.broadcast_to(a, x.shape + a.shape[-1:]) for a in (weight_logits, means, log_scales)]
+      x = bisection(self.f, lower, upper, x, f_args=tuple(f_args), compact_fraction=self.bisection_compact_fraction)
     ew_log_det += self.elementwise_log_det(weight_logits, means, log_scales, x)
 
     return x, ew_log_det
@@ -4,7 +4,7 @@ import nux.util as util
 from jax import random, vmap, jit
 from functools import partial
 import haiku as hk
-from typing import Optional, Mapping, Callable, Sequence
+from typing import Optional, Mapping, Callable, Sequence, Union
 from nux.internal.layer import Layer
 from nux.internal.base import CustomFrame
 from haiku._src.typing import PRNGKey
@@ -44,62 +44,40 @@ def unbiased_neumann_coefficients(key, n_terms, n_exact):
 
 ################################################################################################################
 
-def vjp_iterations(vjp_fun, v, n_terms):
+def neumann_series_sums(step, w0, coeff):
+  # Stream through the terms w_k = step^k(w0) of the neumann series and return
+  #   sum_{k>=1} -coeff[k]/k*w_k  (for the log det) and  sum_{k>=0} coeff[k]*w_k  (for the gradient).
+  # Only the current term is held in memory, so nothing scales with the number of terms.
 
-  @jit
   def scan_fun(carry, inputs):
-    w = carry
-    w_updated, = vjp_fun(w)
-    return w_updated, w
-
-  k = jnp.arange(n_terms - 1)
-  w, terms = jax.lax.scan(scan_fun, v, k)
-  terms = jnp.concatenate([terms, w[None]], axis=0)
-
-  return terms
-
-def unbiased_neumann_vjp_terms(vjp_fun, v, rng, n_terms=10, n_exact=4):
+    w, log_det_sum, grad_sum = carry
+    c, k = inputs
+    w = step(w)
+    log_det_sum = log_det_sum - c/k*w
+    grad_sum = grad_sum + c*w
+    return (w, log_det_sum, grad_sum), ()
+
+  n_terms = coeff.shape[0]
+  k = jnp.arange(1, n_terms, dtype=w0.dtype)
+  carry = (w0, jnp.zeros_like(w0), coeff[0]*w0)
+  (_, log_det_sum, grad_sum), _ = jax.lax.scan(scan_fun, carry, (coeff[1:], k))
+  return log_det_sum, grad_sum
+
+def unbiased_neumann_vjp_sums(vjp_fun, v, rng, n_terms=10, n_exact=4):
   # This function assumes that we start at k=0!
-
-  # Compute the terms in the power series.
-  terms = vjp_iterations(vjp_fun, v, n_terms)
-
-  # Compute the coefficients for each term
   coeff = unbiased_neumann_coefficients(rng, n_terms, n_exact)
-  coeff = util.broadcast_to_first_axis(coeff, terms.ndim)
-
-  return coeff*terms
-
-################################################################################################################
-
-def jacobian_power_iterations(J, n_terms):
-
-  def scan_fun(carry, inputs):
-    J_k = carry
-    J_kp1 = J@J_k
-    return J_kp1, J_k
-
-  k = jnp.arange(n_terms - 1)
-  jac_K, terms = jax.lax.scan(scan_fun, J, k)
-  I = jnp.expand_dims(jnp.eye(J.shape[-1]), axis=tuple(range(len(J.shape) - 2)))
-  I = jnp.broadcast_to(I, J.shape)
-  terms = jnp.concatenate([I[None], terms], axis=0)
-
-  return terms
-
-def neumann_jacobian_terms(J, rng, n_terms=10, n_exact=4):
+  step = lambda w: vjp_fun(w)[0]
+  return neumann_series_sums(step, v, coeff)
 
-  terms = jacobian_power_iterations(J, n_terms)
-
-  # Compute the coefficients for each term
+def neumann_jacobian_sums(J, rng, n_terms=10, n_exact=4):
   coeff = unbiased_neumann_coefficients(rng, n_terms, n_exact)
-  coeff = util.broadcast_to_first_axis(coeff, terms.ndim)
-
-  return coeff*terms
+  I = jnp.expand_dims(jnp.eye(J.shape[-1], dtype=J.dtype), axis=tuple(range(len(J.shape) - 2)))
+  I = jnp.broadcast_to(I, J.shape)
+  return neumann_series_sums(lambda J_k: J@J_k, I, coeff)
 
 ################################################################################################################
 
-def log_det_estimate(apply_fun, params, state, x, rng, batch_info):
+def log_det_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
   x_shape, batch_shape = batch_info
   assert len(x_shape) == 1, "Not going to implement this for images"
 
@@ -115,31 +93,21 @@ def log_det_estimate(apply_fun, params, state, x, rng, batch_info):
 
   J = jac_fun(x)
 
-  # Generate the terms of the neumann series
-  terms = neumann_jacobian_terms(J, rng, n_terms=10, n_exact=10)
-
-  # Rescale the terms and sum over k (starting at k=1)
-  cut_terms = terms[1:]
-  log_det_coeff = -1/(1 + jnp.arange(cut_terms.shape[0]))
-  log_det_coeff = util.broadcast_to_first_axis(log_det_coeff, cut_terms.ndim)
-  log_det_terms = log_det_coeff*cut_terms
-  summed_log_det_terms = log_det_terms.sum(axis=0)
+  # Sum the terms of the neumann series that we need for the log det and the gradient
+  summed_log_det_terms, summed_terms_for_grad = neumann_jacobian_sums(J, rng, n_terms=n_terms, n_exact=n_exact)
 
   # Compute the log det
   log_det = vmap_trace(summed_log_det_terms)
 
-  return z, log_det, terms
+  return z, log_det, summed_terms_for_grad
 
-@partial(jax.custom_vjp, nondiff_argnums=(0,))
-def res_flow_estimate(apply_fun, params, state, x, rng, batch_info):
-  z, log_det, _ = log_det_estimate(apply_fun, params, state, x, rng, batch_info)
+@partial(jax.custom_vjp, nondiff_argnums=(0, 1, 2))
+def res_flow_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
+  z, log_det, _ = log_det_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
   return z, log_det
 
-def estimate_fwd(apply_fun, params, state, x, rng, batch_info):
-  z, log_det, terms = log_det_estimate(apply_fun, params, state, x, rng, batch_info)
-
-  # Accumulate the terms we need for the gradient
-  summed_terms_for_grad = terms.sum(axis=0)
+def estimate_fwd(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
+  z, log_det, summed_terms_for_grad = log_det_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
 
   x_shape, batch_shape = batch_info
   sum_axes = util.last_axes(x_shape)
@@ -159,7 +127,7 @@ def estimate_fwd(apply_fun, params, state, x, rng, batch_info):
   ctx = x, params, state, rng, batch_info, dlogdet_dtheta, dlogdet_dx
   return (z, log_det), ctx
 
-def estimate_bwd(apply_fun, ctx, g):
+def estimate_bwd(apply_fun, n_terms, n_exact, ctx, g):
   dLdz, dLdlogdet = g
   x, params, state, rng, batch_info, dlogdet_dtheta, dlogdet_dx = ctx
   x_shape, batch_shape = batch_info
@@ -188,7 +156,7 @@ res_flow_estimate.defvjp(estimate_fwd, estimate_bwd)
 
 ################################################################################################################
 
-def log_det_sliced_estimate(apply_fun, params, state, x, rng, batch_info):
+def log_det_sliced_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
   trace_key, roulette_key = random.split(rng, 2)
 
   # Evaluate the flow and get the vjp function
@@ -198,32 +166,22 @@ def log_det_sliced_estimate(apply_fun, params, state, x, rng, batch_info):
   # Generate the probe vector for the trace estimate
   v = random.normal(trace_key, x.shape)
 
-  # Get all of the terms we need for the log det and gradient estimates
-  terms = unbiased_neumann_vjp_terms(vjp_fun, v, roulette_key, n_terms=7, n_exact=4)
-
-  # Rescale the terms and sum over k (starting at k=1)
-  cut_terms = terms[1:]
-  log_det_coeff = -1/(1 + jnp.arange(cut_terms.shape[0]))
-  log_det_coeff = util.broadcast_to_first_axis(log_det_coeff, cut_terms.ndim)
-  log_det_terms = log_det_coeff*cut_terms
-  summed_log_det_terms = log_det_terms.sum(axis=0)
+  # Sum the vjp terms that we need for the log det and gradient estimates
+  summed_log_det_terms, summed_terms_for_grad = unbiased_neumann_vjp_sums(vjp_fun, v, roulette_key, n_terms=n_terms, n_exact=n_exact)
 
   # Compute the log det
   x_shape, batch_shape = batch_info
   log_det = jnp.sum(summed_log_det_terms*v, axis=util.last_axes(x_shape))
 
-  return z, log_det, v, terms
+  return z, log_det, v, summed_terms_for_grad
 
-@partial(jax.custom_vjp, nondiff_argnums=(0,))
-def res_flow_sliced_estimate(apply_fun, params, state, x, rng, batch_info):
-  z, log_det, _, _ = log_det_sliced_estimate(apply_fun, params, state, x, rng, batch_info)
+@partial(jax.custom_vjp, nondiff_argnums=(0, 1, 2))
+def res_flow_sliced_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
+  z, log_det, _, _ = log_det_sliced_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
   return z, log_det
 
-def sliced_estimate_fwd(apply_fun, params, state, x, rng, batch_info):
-  z, log_det, v, terms = log_det_sliced_estimate(apply_fun, params, state, x, rng, batch_info)
-
-  # Accumulate the terms we need for the gradient
-  summed_terms_for_grad = terms.sum(axis=0)
+def sliced_estimate_fwd(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info):
+  z, log_det, v, summed_terms_for_grad = log_det_sliced_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
 
   x_shape, batch_shape = batch_info
   sum_axes = util.last_axes(x_shape)
@@ -243,7 +201,7 @@ def sliced_estimate_fwd(apply_fun, params, state, x, rng, batch_info):
   ctx = x, params, state, rng, batch_info, dlogdet_dtheta, dlogdet_dx
   return (z, log_det), ctx
 
-def sliced_estimate_bwd(apply_fun, ctx, g):
+def sliced_estimate_bwd(apply_fun, n_terms, n_exact, ctx, g):
   dLdz, dLdlogdet = g
   x, params, state, rng, batch_info, dlogdet_dtheta, dlogdet_dx = ctx
   x_shape, batch_shape = batch_info
@@ -295,23 +253,14 @@ def res_flow_exact(res_block, x, rng):
 
 ################################################################################################################
 
-def _fixed_point(f, x_init):
+@util.track_traces
+def _fixed_point(f, x_init, solver=None, context=None):
   # http://www.autodiff.org/Docs/euroad/Second%20EuroAd%20Workshop%20-%20Sebastian%20Schlenkrich%20-%20Differentianting%20Fixed%20Point%20Iterations%20with%20ADOL-C.pdf
-  max_iters = 10000
-  atol = 1e-5
+  # If context is passed, f is called as f(x, context) and the solver can run on subsets of the batch.
+  if solver is None:
+    solver = util.get_fixed_point_solver("banach", max_iters=10000, atol=1e-5)
 
-  def cond_fun(val):
-    x_prev, x, i = val
-    max_iters_reached = jnp.where(i >= max_iters, True, False)
-    tolerance_achieved = jnp.allclose(x_prev - x, 0.0, atol=atol)
-    return ~(max_iters_reached | tolerance_achieved)
-
-  def body_fun(val):
-    _, x, i = val
-    fx = f(x)
-    return x, fx, i + 1
-
-  _, x, N = jax.lax.while_loop(cond_fun, body_fun, (x_init, f(x_init), 0.0))
+  x, N, _ = solver(f, x_init, context=context)
   return x, N
 
 def contractive_fixed_point(apply_fun, params, state, x_current, z):
@@ -319,23 +268,26 @@ def contractive_fixed_point(apply_fun, params, state, x_current, z):
   gx, state = apply_fun(params, state, x_current)
   return z - gx
 
-@partial(jax.custom_vjp, nondiff_argnums=(0,))
-def fixed_point(apply_fun, params, state, z, roulette_rng):
+@partial(jax.custom_vjp, nondiff_argnums=(0, 1))
+def fixed_point(apply_fun, solver, params, state, z, roulette_rng):
   # Invert a contractive function using fixed point iterations.
+  # Returns the solution and the number of iterations that each example took.
 
-  def fixed_point_iter(x):
+  # z is passed as the context so that converged examples can be compacted away
+  def fixed_point_iter(x, z):
     return contractive_fixed_point(apply_fun, params, state, x, z)
 
-  x, N = _fixed_point(fixed_point_iter, z)
-  return x
+  x, N = _fixed_point(fixed_point_iter, z, solver=solver, context=z)
+  return x, N
 
-def fixed_point_fwd(apply_fun, params, state, z, roulette_rng):
+def fixed_point_fwd(apply_fun, solver, params, state, z, roulette_rng):
   # We need to save frame_data and the fixed point solution for backprop
-  x = fixed_point(apply_fun, params, state, z, roulette_rng)
-  return x, (params, state, x, z, roulette_rng)
+  x, N = fixed_point(apply_fun, solver, params, state, z, roulette_rng)
+  return (x, N), (params, state, x, z, roulette_rng)
 
-def fixed_point_bwd(apply_fun, ctx, dLdx):
-  assert 0, "Bro, did you seriously just try to backprop through a fixed point iteration?"
+def fixed_point_bwd(apply_fun, solver, ctx, g):
+  raise NotImplementedError("Can't backpropagate through the fixed point inverse of a ResidualFlow.  Differentiate the forward pass instead.")
+  dLdx, _ = g
   params, state, x, z, roulette_rng = ctx
 
   with hk_base.frame_stack(CustomFrame.create_from_params_and_state(params, state)):
@@ -355,8 +307,7 @@ def fixed_point_bwd(apply_fun, ctx, dLdx):
     # Also handle the gradient wrt z here.  To do this, we need to solve (dx/dz)^{-1}dx.
     # Do this with vjps against terms in the neumann series for dx/dz
     _, vjp_x = jax.vjp(lambda x: apply_fun(params, state, x)[0], x, has_aux=False)
-    terms = unbiased_neumann_vjp_terms(vjp_x, dLdx, roulette_rng, n_terms=10, n_exact=10)
-    dx_star = terms.sum(axis=0)
+    _, dx_star = unbiased_neumann_vjp_sums(vjp_x, dLdx, roulette_rng, n_terms=10, n_exact=10)
 
     return dparams, None, dx_star, None
 
@@ -369,29 +320,63 @@ class ResidualFlow(Layer):
   def __init__(self,
                scale: float=1.0,
                create_network: Callable=None,
-               fixed_point_iters: Optional[int]=1000,
+               fixed_point_iters: Optional[int]=10000,
+               fixed_point_tol: float=1e-5,
+               fixed_point_solver: Union[str, Callable]="banach",
+               fixed_point_solver_kwargs: Optional[Mapping]=None,
+               fixed_point_compact_fraction: Optional[float]=None,
+               track_fixed_point_iters: bool=False,
                exact_log_det: Optional[bool]=False,
                use_trace_estimator: bool=True,
+               n_neumann_terms: Optional[int]=None,
+               n_exact_terms: Optional[int]=None,
                network_kwargs: Optional=None,
                name: str="residual_flow"
   ):
     """ Residual flows https://arxiv.org/pdf/1906.02735.pdf
 
     Args:
-      create_network   : Function to create the conditioner network.  Should accept a tuple
-                         specifying the output shape.  See coupling_base.py
-      fixed_point_iters: Max number of iterations for inverse
-      exact_log_det    : Whether or not to compute the exact jacobian determinant with autodiff
-      network_kwargs   : Dictionary with settings for the default network (see get_default_network in util.py)
-      name             : Optional name for this module.
+      create_network              : Function to create the conditioner network.  Should accept a tuple
+                                    specifying the output shape.  See coupling_base.py
+      fixed_point_iters           : Max number of iterations for inverse.  None means 10000.
+      fixed_point_tol             : Stop the inverse once max|f(x) - x| is below this for every example
+      fixed_point_solver          : "banach", "anderson", "broyden" or a function with the same signature
+                                    (see nux/util/fixed_point_solvers.py).  anderson and broyden usually need
+                                    far fewer iterations than banach, but anderson keeps a (batch, memory, dim)
+                                    history of both the iterates and their images and broyden keeps twice as much.
+      fixed_point_solver_kwargs   : Extra arguments for the solver, like the memory of anderson or broyden
+      fixed_point_compact_fraction: Once at most this fraction of the batch is still iterating, run the
+                                    rest of the inverse on only those examples.  The network must
+                                    treat examples independently.
+      track_fixed_point_iters     : Whether to keep the most iterations that an example needed in the last
+                                    inverse in the "fixed_point_iters" state of this layer.  This adds a
+                                    leaf to the state, so checkpoints from without it won't load.
+      exact_log_det               : Whether or not to compute the exact jacobian determinant with autodiff
+      use_trace_estimator         : Use the stochastic trace estimate of the log det instead of the full jacobian
+      n_neumann_terms             : Number of terms of the neumann series for the log det.  Defaults to
+                                    7 with the trace estimator and 10 without it.
+      n_exact_terms               : Number of those terms that are always used.  The rest are weighted
+                                    with the russian roulette estimator.  Defaults to 4 with the trace
+                                    estimator and 10 without it.
+      network_kwargs              : Dictionary with settings for the default network (see get_default_network in util.py)
+      name                        : Optional name for this module.
+
+    The inverse can't be differentiated.  Backpropagating through sample=True raises NotImplementedError.
     """
     super().__init__(name=name)
-    self.create_network      = create_network
-    self.fixed_point_iters   = fixed_point_iters
-    self.exact_log_det       = exact_log_det
-    self.network_kwargs      = network_kwargs
-    self.use_trace_estimator = use_trace_estimator
-    self.scale               = scale
+    self.create_network               = create_network
+    self.fixed_point_iters            = fixed_point_iters if fixed_point_iters is not None else 10000
+    self.fixed_point_tol              = fixed_point_tol
+    self.fixed_point_solver           = fixed_point_solver
+    self.fixed_point_solver_kwargs    = fixed_point_solver_kwargs if fixed_point_solver_kwargs is not None else {}
+    self.fixed_point_compact_fraction = fixed_point_compact_fraction
+    self.track_fixed_point_iters      = track_fixed_point_iters
+    self.exact_log_det                = exact_log_det
+    self.network_kwargs               = network_kwargs
+    self.use_trace_estimator          = use_trace_estimator
+    self.n_neumann_terms              = n_neumann_terms
+    self.n_exact_terms                = n_exact_terms
+    self.scale                        = scale
 
   def get_network(self, out_shape):
 
@@ -410,6 +395,13 @@ class ResidualFlow(Layer):
     z, log_det = self.auto_batch(res_fun, in_axes=(0, None))(x, rng)
     return z, log_det
 
+  def neumann_terms(self, default_n_terms, default_n_exact):
+    n_terms = self.n_neumann_terms if self.n_neumann_terms is not None else default_n_terms
+    n_exact = self.n_exact_terms if self.n_exact_terms is not None else default_n_exact
+    assert n_terms >= 1, "Need at least one term in the neumann series"
+    assert 0 <= n_exact <= n_terms, "Need 0 <= n_exact_terms <= n_neumann_terms"
+    return n_terms, n_exact
+
   def init_if_needed(self, x, rng):
     # Before extracting the frame data, we need to make sure that the
     # network is initialized!
@@ -428,9 +420,11 @@ class ResidualFlow(Layer):
                                              state, \
                                              finalize):
       if self.use_trace_estimator:
-        z, log_det = res_flow_sliced_estimate(apply_fun, params, state, x, rng, batch_info)
+        n_terms, n_exact = self.neumann_terms(7, 4)
+        z, log_det = res_flow_sliced_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
       else:
-        z, log_det = res_flow_estimate(apply_fun, params, state, x, rng, batch_info)
+        n_terms, n_exact = self.neumann_terms(10, 10)
+        z, log_det = res_flow_estimate(apply_fun, n_terms, n_exact, params, state, x, rng, batch_info)
 
       finalize(params, state)
 
@@ -446,9 +440,16 @@ class ResidualFlow(Layer):
     # Make sure we don't use a different random key at every step of the fixed point iterations.
     deterministic_apply_fun = lambda params, state, x: apply_fun(params, state, x, rng)
 
-    # Run the fixed point iterations to invert at z.  We can do reverse-mode through this!
-    x = fixed_point(deterministic_apply_fun, params, state, z, rng)
-    return x
+    solver = util.get_fixed_point_solver(self.fixed_point_solver,
+                                         max_iters=self.fixed_point_iters,
+                                         atol=self.fixed_point_tol,
+                                         batch_ndim=len(self.batch_shape),
+                                         compact_fraction=self.fixed_point_compact_fraction,
+                                         **self.fixed_point_solver_kwargs)
+
+    # Run the fixed point iterations to invert at z.  fixed_point_bwd isn't implemented yet.
+    x, n_iters = fixed_point(deterministic_apply_fun, solver, params, state, z, rng)
+    return x, n_iters
 
   def call(self,
            inputs: Mapping[str, jnp.ndarray],
@@ -467,6 +468,11 @@ class ResidualFlow(Layer):
     self.res_block = _res_block
     # self.res_block = lambda x, rng : scale*self.unscaled_res_block(x, rng, **kwargs)
 
+    # Diagnostics of the last inverse.  These are state instead of outputs so that the layer
+    # returns the same keys as every other layer.
+    if self.track_fixed_point_iters:
+      hk.get_state("fixed_point_iters", (), jnp.int32, init=jnp.zeros)
+
     if res_block_only:
       x = inputs["x"]
       gx = self.auto_batched_res_block(x, rng)
@@ -487,7 +493,9 @@ class ResidualFlow(Layer):
       outputs = {"x": z, "log_det": log_det}
     else:
       z = inputs["x"]
-      x = self.invert(z, rng)
+      x, n_iters = self.invert(z, rng)
+      if self.track_fixed_point_iters:
+        hk.set_state("fixed_point_iters", jnp.max(n_iters).astype(jnp.int32))
 
       if self.exact_log_det or use_exact_log_det:
         _, log_det = self.exact_forward(x, rng)
@@ -495,7 +503,6 @@ class ResidualFlow(Layer):
         self.res_block(x, rng)
         _, log_det = self.forward(x, rng)
 
-
       outputs = {"x": x, "log_det": log_det}
 
     return outputs
@@ -6,6 +6,12 @@ import haiku as hk
 from typing import Optional, Mapping, Type, Callable, Iterable, Any, Sequence, Union, Tuple
 import nux.util as util
 from nux.internal.layer import Layer
+from nux.internal.base import get_module_prefixes
+from nux.internal.functional import make_pure_functions
+from nux.internal.invertible import invertible_chain
+from nux.internal.remat import remat_selects, remat_call
+import haiku._src.base as hk_base
+from haiku._src import data_structures
 import nux
 
 __all__ = ["sequential",
@@ -16,19 +22,69 @@ __all__ = ["sequential",
 
 ################################################################################################################
 
+def rename_module(name: str,
+                  from_prefixes: Sequence[str],
+                  to_prefixes: Sequence[str]) -> Optional[str]:
+  """ Swap the longest prefix of name in from_prefixes with the corresponding prefix
+      in to_prefixes.  Returns None if name doesn't belong to any of from_prefixes.
+  """
+  best = None
+  for i, prefix in enumerate(from_prefixes):
+    if name == prefix or name.startswith(prefix + "/"):
+      if best is None or len(prefix) > len(from_prefixes[best]):
+        best = i
+  if best is None:
+    return None
+  return to_prefixes[best] + name[len(from_prefixes[best]):]
+
+def extract_modules(tree: Mapping[str, Any],
+                    from_prefixes: Sequence[str],
+                    to_prefixes: Sequence[str]) -> Mapping[str, Any]:
+  """ Take the modules of tree that belong to from_prefixes and rename them to to_prefixes """
+  extracted = {}
+  for name, value in tree.items():
+    new_name = rename_module(name, from_prefixes, to_prefixes)
+    if new_name is not None:
+      extracted[new_name] = value
+  return extracted
+
+################################################################################################################
+
 class sequential(Layer):
 
   def __init__(self,
                *layers: Iterable[Callable],
+               scan_layers: bool=False,
+               invertible_ad: bool=False,
+               remat: Optional[Any]=None,
                name: str="sequential"
   ):
     """ Create a flow sequentially
     Args:
-      layers: An iterable that contains flow layers
-      name  : Optional name for this module.
+      layers       : An iterable that contains flow layers
+      scan_layers  : Whether to run the layers with a lax.scan over their stacked parameters
+                     instead of unrolling them.  The layers must be structurally identical
+                     (the same layer type with the same settings).  Repeated blocks can be
+                     passed as identical sequential layers.  Keeps compile time independent of depth.
+                     The parameters are stored stacked under "<name>/~scan/" after initialization.
+      invertible_ad: Whether to backpropagate through the layers by reconstructing the input of every
+                     layer from its output instead of storing activations.  Memory then doesn't grow
+                     with the number of layers.  Every layer must be exactly invertible.  Can't be
+                     combined with scan_layers.
+      remat        : Which layers to checkpoint so that their activations are recomputed during the
+                     backward pass.  True for every layer, k for every k-th layer, a tuple of layer
+                     classes or a function (index, layer) -> bool.  Use for layers without a cheap
+                     inverse.  See Flow.memory_report for the resulting peak memory.  With scan_layers,
+                     the policy must select all of the layers or none of them.  Can't be combined with
+                     invertible_ad, which doesn't store the activations in the first place.
+      name         : Optional name for this module.
     """
-    super().__init__(name=name)
+    assert not (invertible_ad and remat not in (None, False)), "remat can't be used with invertible_ad.  invertible_ad already recomputes every layer during the backward pass."
+    assert not (invertible_ad and scan_layers), "scan_layers can't be used with invertible_ad.  invertible_ad unrolls the layers, which don't have their own parameters after initialization."
+    super().__init__(name=name, invertible_ad=invertible_ad)
     self.layers = tuple(layers)
+    self.scan_layers = scan_layers
+    self.remat = remat
 
   def call(self,
            inputs: Mapping[str, jnp.ndarray],
@@ -38,6 +94,10 @@ class sequential(Layer):
            **kwargs
   ) -> Mapping[str, jnp.ndarray]:
 
+    # Initialization unrolls the layers so that data dependent init sees the correct inputs
+    if self.scan_layers and len(self.layers) > 1 and (hk_base.params_frozen() or self.layers_are_stacked()):
+      return self.scan_call(inputs, rng, sample=sample, accumulate=accumulate, **kwargs)
+
     n_layers = len(self.layers)
     iter_layers = self.layers if sample == False else self.layers[::-1]
 
@@ -52,7 +112,11 @@ class sequential(Layer):
     # Run the rest of the layers
     layer_inputs = inputs.copy()
     for i, (layer, rng) in enumerate(zip(iter_layers, rngs)):
-      outputs = layer(layer_inputs, rng, sample=sample, **kwargs)
+      index = i if sample == False else n_layers - 1 - i
+      if remat_selects(self.remat, index, layer):
+        outputs = remat_call(layer, layer_inputs, rng, sample=sample, **kwargs)
+      else:
+        outputs = layer(layer_inputs, rng, sample=sample, **kwargs)
       layer_inputs["x"] = outputs["x"]
       final_outputs.update(outputs)
 
@@ -67,6 +131,146 @@ class sequential(Layer):
       if accumulated_found[name]:
         final_outputs[name] = val
 
+    if self.scan_layers and n_layers > 1:
+      self.stack_layers()
+
+    return final_outputs
+
+  @property
+  def scan_prefix(self) -> str:
+    return f"{self.module_name}/~scan/"
+
+  def layers_are_stacked(self) -> bool:
+    frame = hk_base.current_frame()
+    names = list(frame.params.keys()) + list(frame.state.keys())
+    return any([name.startswith(self.scan_prefix) for name in names])
+
+  def stack_layers(self):
+    """ Replace the parameters and state of every layer with a single copy that has a leading
+        layer axis and the template's names under scan_prefix.  This happens once at the end of
+        initialization so that scan_call doesn't have to stack them on every call.
+    """
+    n_layers = len(self.layers)
+    frame = hk_base.current_frame()
+    layer_prefixes = [get_module_prefixes(layer) for layer in self.layers]
+    template_prefixes = layer_prefixes[0]
+    scan_prefixes = [self.scan_prefix + prefix for prefix in template_prefixes]
+
+    # The parameter and state shapes and per-layer constants (like the shapes from get_constant) must match the template's
+    layer_params = [extract_modules(frame.params, prefixes, template_prefixes) for prefixes in layer_prefixes]
+    layer_states = [extract_modules(frame.state, prefixes, template_prefixes) for prefixes in layer_prefixes]
+    layer_constants = [extract_modules(frame.constants, prefixes, template_prefixes) for prefixes in layer_prefixes]
+    for i in range(1, n_layers):
+      assert util.tree_shapes(layer_params[i]) == util.tree_shapes(layer_params[0]) and \
+             util.tree_shapes(layer_states[i]) == util.tree_shapes(layer_states[0]), \
+             f"scan_layers needs structurally identical layers.  Layer {i} has different parameters than layer 0."
+      assert util.trees_equal(layer_constants[i], layer_constants[0]), \
+             f"scan_layers needs structurally identical layers.  Layer {i} has different constants than layer 0."
+
+    stack = lambda *xs: jnp.stack(xs, axis=0)
+    for tree, layer_trees in [(frame.params, layer_params), (frame.state, layer_states)]:
+      stacked = jax.tree_multimap(stack, *layer_trees)
+      for name in list(tree.keys()):
+        if any([rename_module(name, prefixes, prefixes) is not None for prefixes in layer_prefixes]):
+          del tree[name]
+      tree.update(extract_modules(stacked, template_prefixes, scan_prefixes))
+
+  def invertible_call(self,
+                      inputs: Mapping[str, jnp.ndarray],
+                      rng: jnp.ndarray=None,
+                      sample: Optional[bool]=False,
+                      accumulate: Iterable[str]=["log_det"],
+                      **kwargs
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Only save the output of the last layer and reconstruct the rest during the backward pass """
+    n_layers = len(self.layers)
+    iter_layers = self.layers if sample == False else self.layers[::-1]
+
+    inverse_kwargs = kwargs.copy()
+    inverse_kwargs["reconstruction"] = True
+    apply_funs = [partial(layer, sample=sample, **kwargs) for layer in iter_layers]
+    inverse_funs = [partial(layer, sample=not sample, **inverse_kwargs) for layer in iter_layers]
+
+    with make_pure_functions(apply_funs + inverse_funs) as (pure_funs, params, state, constants, frame_rng, finalize):
+      rngs = random.split(rng, n_layers) if rng is not None else None
+      outputs, state, frame_rng = invertible_chain(pure_funs[:n_layers],
+                                                   pure_funs[n_layers:],
+                                                   params,
+                                                   state,
+                                                   constants,
+                                                   frame_rng,
+                                                   inputs,
+                                                   rngs,
+                                                   accumulate=accumulate)
+      finalize(params, state, frame_rng)
+
+    return outputs
+
+  def scan_call(self,
+                inputs: Mapping[str, jnp.ndarray],
+                rng: jnp.ndarray=None,
+                sample: Optional[bool]=False,
+                accumulate: Iterable[str]=["log_det"],
+                **kwargs
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Run every layer using the first layer as a template and scan over the
+        stacked parameters and state of all of the layers.
+    """
+    n_layers = len(self.layers)
+    template = self.layers[0]
+    template_prefixes = get_module_prefixes(template)
+    scan_prefixes = [self.scan_prefix + prefix for prefix in template_prefixes]
+
+    def apply_template(inputs, rng):
+      return template(inputs, rng, sample=sample, **kwargs)
+
+    with make_pure_functions([apply_template]) as ([apply_fun], params, state, constants, frame_rng, finalize):
+
+      # stack_layers stored every layer's parameters and state with a leading layer axis
+      stacked_params = extract_modules(params, scan_prefixes, template_prefixes)
+      stacked_states = extract_modules(state, scan_prefixes, template_prefixes)
+
+      # Layer i gets the same key as it would in the unrolled loop
+      if rng is not None:
+        rngs = random.split(rng, n_layers)
+        rngs = rngs[::-1] if sample else rngs
+      else:
+        rngs = None
+
+      # Every iteration runs the same function, so remat applies to all of the layers or none of them
+      selected = [remat_selects(self.remat, i, layer) for i, layer in enumerate(self.layers)]
+      if all(selected):
+        layer_fun = jax.checkpoint(apply_fun)
+      elif any(selected):
+        assert 0, "scan_layers can only checkpoint all of the layers or none of them.  Use remat=True or a layer type."
+      else:
+        layer_fun = apply_fun
+
+      # Each layer advances the frame key like it does in the unrolled loop
+      def scan_body(carry, scan_inputs):
+        x, frame_rng = carry
+        params_i, state_i, rng_i = scan_inputs
+        layer_inputs = inputs.copy()
+        layer_inputs["x"] = x
+        params_i = data_structures.to_immutable_dict(params_i)
+        outputs, updated_state, frame_rng = layer_fun(params_i, state_i, frame_rng, layer_inputs, rng_i)
+        outputs = outputs.copy()
+        x = outputs.pop("x")
+        updated_state = extract_modules(updated_state, template_prefixes, template_prefixes)
+        return (x, frame_rng), (outputs, updated_state)
+
+      # Iterate over the layers backwards when sampling
+      scan_inputs = (stacked_params, stacked_states, rngs)
+      (z, frame_rng), (stacked_outputs, stacked_states) = jax.lax.scan(scan_body, (inputs["x"], frame_rng), scan_inputs, length=n_layers, reverse=sample)
+      finalize({}, extract_modules(stacked_states, template_prefixes, scan_prefixes), frame_rng)
+
+    # Accumulate over the layers or keep the output of the last layer that ran
+    last_index = 0 if sample else -1
+    final_outputs = inputs.copy()
+    for name, val in stacked_outputs.items():
+      final_outputs[name] = val.sum(axis=0) if name in accumulate else val[last_index]
+    final_outputs["x"] = z
+
     return final_outputs
 
 ################################################################################################################
@@ -156,16 +360,19 @@ class multi_scale(Layer):
 
   def __init__(self,
                flow,
+               remat: Optional[Any]=None,
                name: str="multi_scale",
   ):
     """ Use a flow in a multiscale architecture as described in RealNVP https://arxiv.org/pdf/1605.08803.pdf
         Factors half of the dimensions.
     Args:
-      flow: The flow to use
-      name: Optional name for this module.
+      flow : The flow to use
+      remat: Whether to checkpoint flow.  Same options as the remat policy of sequential.
+      name : Optional name for this module.
     """
     super().__init__(name=name)
     self.flow = flow
+    self.remat = remat
 
   def call(self,
            inputs: Mapping[str, jnp.ndarray],
@@ -181,7 +388,10 @@ class multi_scale(Layer):
     # Run a flow on only one half
     factored_inputs = inputs.copy()
     factored_inputs["x"] = xb
-    outputs = self.flow(factored_inputs, rng, sample=sample, **kwargs)
+    if remat_selects(self.remat, 0, self.flow):
+      outputs = remat_call(self.flow, factored_inputs, rng, sample=sample, **kwargs)
+    else:
+      outputs = self.flow(factored_inputs, rng, sample=sample, **kwargs)
 
     z = jnp.concatenate([xa, outputs["x"]], axis=-1)
 
@@ -1,3 +1,19 @@
-from nux.internal.base import *
-from nux.internal.functional import *
-from nux.internal.layer import *
\ No newline at end of file
+from nux.lazy import lazy_exports
+
+# The internals import haiku, so they are only imported the first time that they are used
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.internal.base",
+                                     "nux.internal.functional",
+                                     "nux.internal.compile_cache",
+                                     "nux.internal.persistent_cache",
+                                     "nux.internal.bucketing",
+                                     "nux.internal.invertible",
+                                     "nux.internal.remat",
+                                     "nux.internal.precision",
+                                     "nux.internal.flow_norm_init",
+                                     "nux.internal.abstract",
+                                     "nux.internal.profiler",
+                                     "nux.internal.layer"],
+                                    submodules=["base", "functional", "compile_cache", "persistent_cache", "bucketing",
+                                                "invertible", "remat", "precision", "flow_norm_init", "abstract",
+                                                "profiler", "layer"])
@@ -0,0 +1,45 @@
+import jax.numpy as jnp
+import jax
+import numpy as np
+from typing import Optional, Callable, Any
+
+__all__ = ["is_abstract",
+           "materialize_tree"]
+
+""" Abstract initialization traces a flow with jax.eval_shape, so parameters and state are
+    jax.ShapeDtypeStruct trees that describe the arrays without allocating them.  They are turned
+    into real arrays later, for example from a checkpoint or from sharded values. """
+
+################################################################################################################
+
+def is_abstract(pytree: Any) -> bool:
+  """ Whether any leaf of pytree is a ShapeDtypeStruct """
+  return any([isinstance(x, jax.ShapeDtypeStruct) for x in jax.tree_leaves(pytree)])
+
+def materialize_tree(abstract_tree: Any,
+                     values: Optional[Any]=None,
+                     fill: Optional[Callable]=None,
+                     device_put: bool=True
+) -> Any:
+  """ Replace the ShapeDtypeStructs of abstract_tree with arrays.
+  Args:
+    abstract_tree: Tree of ShapeDtypeStructs from an abstract init.
+    values       : Tree with the same structure that holds the arrays to use, like the
+                   parameters of a checkpoint.  Their shapes and dtypes must match.
+    fill         : Function (shape, dtype) -> array used for the leaves when values is None.
+                   Must be passed explicitly because constant fills are rarely valid parameters.
+    device_put   : Whether to copy values to the device.
+  """
+  if values is None:
+    assert fill is not None, "Pass the values or a fill function"
+    return jax.tree_map(lambda x: fill(x.shape, x.dtype), abstract_tree)
+
+  abstract_leaves, treedef = jax.tree_util.tree_flatten(abstract_tree)
+  value_leaves, value_treedef = jax.tree_util.tree_flatten(values)
+  assert treedef == value_treedef, f"Expected a tree with structure {treedef}, got {value_treedef}"
+
+  for abstract, value in zip(abstract_leaves, value_leaves):
+    assert tuple(abstract.shape) == tuple(np.shape(value)), f"Expected shape {abstract.shape}, got {np.shape(value)}"
+    assert jnp.dtype(abstract.dtype) == jnp.result_type(value), f"Expected dtype {abstract.dtype}, got {jnp.result_type(value)}"
+
+  return jax.device_put(values) if device_put else values
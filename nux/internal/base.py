@@ -198,3 +198,18 @@ def get_constant(name: str, value: Any, init=None, do_not_set=False):
     value = saved_value
 
   return value
+
+################################################################################################################
+
+def get_module_prefixes(module: hk.Module) -> Sequence[str]:
+  """ Names of the modules that hold the parameters of module.  Flow layers are
+      constructed outside of the layer that contains them, so the names of child layers
+      are not nested under the name of their parent.
+  """
+  prefixes = [module.module_name]
+  for value in vars(module).values():
+    children = value if isinstance(value, (tuple, list)) else (value,)
+    for child in children:
+      if isinstance(child, hk.Module) and child is not module:
+        prefixes.extend(get_module_prefixes(child))
+  return prefixes
@@ -0,0 +1,101 @@
+import jax.numpy as jnp
+import jax
+import numpy as np
+from typing import Optional, Mapping, Sequence, Tuple, Any
+
+__all__ = ["ShapeBucketer"]
+
+################################################################################################################
+
+class ShapeBucketer():
+
+  def __init__(self,
+               bucket_sizes: Sequence[int]):
+    """ Pads the innermost batch axis of inputs up to a small set of sizes so that ragged batches
+        (like the last batch of an epoch) reuse an executable instead of triggering a compile.
+        Outer batch axes (like the scan axis of doubly-batched inputs) are left alone, since
+        padding them would add whole iterations that also update the state.
+        Sizes that are larger than the largest bucket are rounded up to a multiple of it.
+        Padded rows are copies of the last real row so that they stay numerically valid.
+    Args:
+      bucket_sizes: The sizes that the innermost batch axis can be padded to.
+    """
+    assert len(bucket_sizes) > 0
+    self.bucket_sizes = tuple(sorted(bucket_sizes))
+
+    # Keep track of the shapes that we've seen
+    self.seen_batch_shapes   = set()
+    self.padded_batch_shapes = set()
+
+  @property
+  def compiles_saved(self):
+    """ Number of distinct batch shapes that didn't need their own executable """
+    return len(self.seen_batch_shapes) - len(self.padded_batch_shapes)
+
+  def stats(self):
+    return {"batch_shapes": len(self.seen_batch_shapes),
+            "bucket_shapes": len(self.padded_batch_shapes),
+            "compiles_saved": self.compiles_saved}
+
+  def bucket_size(self, size: int) -> int:
+    for bucket in self.bucket_sizes:
+      if size <= bucket:
+        return bucket
+    largest = self.bucket_sizes[-1]
+    return -(-size//largest)*largest
+
+  def padded_batch_shape(self, batch_shape: Sequence[int]) -> Tuple[int]:
+    batch_shape = tuple(batch_shape)
+    if len(batch_shape) == 0:
+      return batch_shape
+    return batch_shape[:-1] + (self.bucket_size(batch_shape[-1]),)
+
+  def pad(self,
+          inputs: Mapping[str, jnp.ndarray],
+          n_batch_dims: int
+  ) -> Tuple[Mapping[str, jnp.ndarray], jnp.ndarray]:
+    """ Pad the last of the first n_batch_dims axes of every leaf of inputs.
+        Returns the padded inputs and a mask that is True at the real rows.
+    """
+    batch_shape = inputs["x"].shape[:n_batch_dims]
+    padded_batch_shape = self.padded_batch_shape(batch_shape)
+    self.seen_batch_shapes.add(batch_shape)
+    self.padded_batch_shapes.add(padded_batch_shape)
+
+    # Build the mask on the host so that it costs nothing to create
+    mask = np.zeros(padded_batch_shape, dtype=bool)
+    mask[tuple([slice(0, s) for s in batch_shape])] = True
+
+    if padded_batch_shape == batch_shape:
+      return inputs, jnp.array(mask)
+
+    pad_widths = [(0, p - s) for s, p in zip(batch_shape, padded_batch_shape)]
+
+    def pad_leaf(x):
+      if x.shape[:n_batch_dims] != batch_shape:
+        return x
+      widths = pad_widths + [(0, 0)]*(x.ndim - n_batch_dims)
+      return jnp.pad(x, widths, mode="edge")
+
+    padded_inputs = jax.tree_map(pad_leaf, inputs)
+    return padded_inputs, jnp.array(mask)
+
+  def unpad(self,
+            outputs: Mapping[str, jnp.ndarray],
+            batch_shape: Sequence[int]
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Remove the padded rows from every leaf that has a padded batch shape """
+    batch_shape = tuple(batch_shape)
+    padded_batch_shape = self.padded_batch_shape(batch_shape)
+    if padded_batch_shape == batch_shape:
+      return outputs
+
+    n_batch_dims = len(batch_shape)
+    index = tuple([slice(0, s) for s in batch_shape])
+
+    def unpad_leaf(x):
+      if jnp.ndim(x) < n_batch_dims or x.shape[:n_batch_dims] != padded_batch_shape:
+        return x
+      return x[index]
+
+    return jax.tree_map(unpad_leaf, outputs)
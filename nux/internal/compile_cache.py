@@ -0,0 +1,108 @@
+from functools import partial
+import jax.numpy as jnp
+import jax
+from jax import jit
+import collections
+import warnings
+import time
+from nux.util.compile_tracking import get_compile_tracker, describe_call
+from typing import Optional, Mapping, Callable, Any, Hashable, Tuple
+
+__all__ = ["CompiledFunctionCache"]
+
+################################################################################################################
+
+def freeze_static_value(value: Any) -> Hashable:
+  # Static kwargs like accumulate=["log_det"] are passed as lists, so make them hashable
+  if isinstance(value, (list, tuple)):
+    return tuple([freeze_static_value(v) for v in value])
+  if isinstance(value, Mapping):
+    return tuple(sorted([(k, freeze_static_value(v)) for k, v in value.items()]))
+  return value
+
+def tree_signature(pytree: Any) -> Tuple[Any, Tuple]:
+  """ The part of a pytree that determines which executable XLA will build """
+  leaves, treedef = jax.tree_util.tree_flatten(pytree)
+  shapes_and_dtypes = tuple([(jnp.shape(x), jnp.result_type(x).name) for x in leaves])
+  return treedef, shapes_and_dtypes
+
+################################################################################################################
+
+class CompiledFunctionCache():
+
+  def __init__(self,
+               fun: Callable,
+               max_size: Optional[int]=32,
+               name: Optional[str]=None):
+    """ Holds jit compiled versions of fun.  Every entry is keyed by the shapes and dtypes
+        of the positional arguments and the (hashable) values of the keyword arguments.
+        The keyword arguments are treated as static, so fun is compiled with them filled in.
+        Entries are evicted in least-recently-used order once there are more than max_size.
+    Args:
+      fun     : The function to compile.  Must accept arrays as positional arguments and
+                python values as keyword arguments.
+      max_size: Max number of executables to hold.  None means that the cache is unbounded.
+      name    : Optional name used in warnings and in the compile tracker.
+    """
+    self.fun      = fun
+    self.max_size = max_size
+    self.name     = name if name is not None else getattr(fun, "__name__", "function")
+
+    self.cache = collections.OrderedDict()
+    self.hits      = 0
+    self.misses    = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.cache)
+
+  def clear(self):
+    self.cache.clear()
+
+  def get_key(self, args, kwargs):
+    static_kwargs = tuple(sorted([(k, freeze_static_value(v)) for k, v in kwargs.items()]))
+    hash(static_kwargs)
+    return tree_signature(args), static_kwargs
+
+  def compile(self, kwargs):
+    # Traces are recorded under the same name as the compiles and hits
+    def traced_fun(*args):
+      get_compile_tracker().record_trace(self.name, describe_call(args, kwargs))
+      return self.fun(*args, **kwargs)
+    return jit(traced_fun)
+
+  def __call__(self, *args, **kwargs):
+    try:
+      key = self.get_key(args, kwargs)
+    except TypeError:
+      # Can't use an unhashable keyword argument as a static value
+      warnings.warn(f"Unhashable keyword argument passed to {self.name}.  Running it without compiling.")
+      return self.fun(*args, **kwargs)
+
+    compiled_fun = self.cache.get(key, None)
+    if compiled_fun is None:
+      self.misses += 1
+      compiled_fun = self.compile(kwargs)
+      self.cache[key] = compiled_fun
+
+      # Evict the least recently used executable
+      if self.max_size is not None and len(self.cache) > self.max_size:
+        self.cache.popitem(last=False)
+        self.evictions += 1
+
+      # The first call traces and compiles
+      start = time.perf_counter()
+      out = compiled_fun(*args)
+      get_compile_tracker().record_compile(self.name, time.perf_counter() - start)
+      return out
+
+    self.hits += 1
+    self.cache.move_to_end(key)
+    get_compile_tracker().record_hit(self.name)
+    return compiled_fun(*args)
+
+  def stats(self):
+    return {"size": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions}
@@ -0,0 +1,166 @@
+from functools import partial
+import contextlib
+import jax.numpy as jnp
+import jax
+from jax import random, jit
+from typing import Optional, Mapping, Callable, Any, NamedTuple, Tuple, Sequence, Iterable, Union
+import nux.util as util
+
+__all__ = ["FlowNormInitOptions",
+           "set_flow_norm_init_options",
+           "get_flow_norm_init_options",
+           "stacked_init_batches",
+           "init_batches_are_stacked",
+           "split_init_batches",
+           "fit_flow_norm_init"]
+
+################################################################################################################
+
+class FlowNormInitOptions(NamedTuple):
+  """ n_steps        - Largest number of optimization steps.
+      learning_rate  - Adam learning rate.
+      n_batches      - Number of chunks to split the initialization batch into.  All of the batch
+                       axes are split, so this also works with multiple batch axes.  Each step
+                       uses one chunk, so the statistics come from all of them.
+      tol            - Relative decrease of the smoothed loss that counts as an improvement.
+      patience       - Stop after this many steps without an improvement.
+      smoothing      - Exponential moving average factor for the loss.
+  """
+  n_steps: int = 200
+  learning_rate: float = 1e-4
+  n_batches: int = 1
+  tol: float = 1e-4
+  patience: int = 20
+  smoothing: float = 0.9
+
+_options = FlowNormInitOptions()
+
+def set_flow_norm_init_options(**kwargs):
+  """ Change how layers with use_flow_norm_init are initialized.  Takes the fields of
+      FlowNormInitOptions.  Call before initializing the flow.
+  """
+  global _options
+  _options = _options._replace(**kwargs)
+
+def get_flow_norm_init_options() -> FlowNormInitOptions:
+  return _options
+
+_stacked_init_batches = False
+
+@contextlib.contextmanager
+def stacked_init_batches():
+  """ While active, the leading batch axis of the initialization inputs indexes separate batches,
+      like the ones passed to Flow(..., init_batches=...).  Each optimization step of flow_norm_init
+      then uses one of those batches instead of a chunk of a single batch.
+  """
+  global _stacked_init_batches
+  previous = _stacked_init_batches
+  _stacked_init_batches = True
+  try:
+    yield
+  finally:
+    _stacked_init_batches = previous
+
+def init_batches_are_stacked() -> bool:
+  return _stacked_init_batches
+
+################################################################################################################
+
+def split_init_batches(batches: Union[Mapping[str, jnp.ndarray], Iterable[Mapping[str, jnp.ndarray]]],
+                       n_batches: int=1,
+                       batch_shape: Optional[Sequence[int]]=None) -> Mapping[str, jnp.ndarray]:
+  """ Stack initialization batches along a new leading axis of chunks.
+  Args:
+    batches    : Either a single batch of inputs or a sequence/iterator of batches with the same shapes.
+                 A single batch is split into n_batches chunks along its batch axes, which are
+                 flattened first.  Leaves without the batch axes are given to every chunk.
+    n_batches  : Number of chunks to split a single batch into.
+    batch_shape: The batch shape of a single batch.  Can be () for unbatched inputs.
+  """
+  if isinstance(batches, Mapping):
+    assert batch_shape is not None, "Need the batch shape to split a single batch"
+    batch_shape = tuple(batch_shape)
+    batch_size = int(util.list_prod(batch_shape))
+    assert batch_size%n_batches == 0, f"Can't split a batch of {batch_size} into {n_batches} chunks"
+    chunk_size = batch_size//n_batches
+
+    def split(x):
+      if jnp.ndim(x) < len(batch_shape) or x.shape[:len(batch_shape)] != batch_shape:
+        return [x]*n_batches
+      if n_batches == 1:
+        return [x]
+      x = x.reshape((batch_size,) + x.shape[len(batch_shape):])
+      return [x[i*chunk_size:(i + 1)*chunk_size] for i in range(n_batches)]
+
+    leaves, treedef = jax.tree_flatten(batches)
+    split_leaves = [split(x) for x in leaves]
+    batches = [jax.tree_unflatten(treedef, [chunks[i] for chunks in split_leaves]) for i in range(n_batches)]
+  else:
+    batches = list(batches)
+    assert len(batches) > 0, "Need at least one batch"
+
+  return jax.tree_multimap(lambda *xs: jnp.stack(xs, axis=0), *batches)
+
+def fit_flow_norm_init(loss_fun: Callable,
+                       params: Mapping[str, jnp.ndarray],
+                       state: Mapping[str, jnp.ndarray],
+                       inputs: Mapping[str, jnp.ndarray],
+                       rng: jnp.ndarray,
+                       options: Optional[FlowNormInitOptions]=None
+) -> Tuple[Mapping[str, jnp.ndarray], Mapping[str, jnp.ndarray], jnp.ndarray, jnp.ndarray]:
+  """ Minimize loss_fun with Adam in a single compiled while loop.  Stops early when an update
+      isn't finite (the update is not applied) or when the smoothed loss plateaus.
+  Args:
+    loss_fun: Function (params, state, inputs, rng) -> (loss, state).
+    params  : The parameters to optimize.
+    state   : The initial state.
+    inputs  : Inputs with a leading axis of chunks.  Step i uses chunk i%n_chunks.
+    rng     : JAX random key.
+    options : The stopping criteria and optimizer settings.  Uses the global options if None.
+  Returns:
+    The optimized parameters, the state, the number of steps taken and the final smoothed loss.
+  """
+  import optax
+  options = options if options is not None else get_flow_norm_init_options()
+  n_chunks = inputs["x"].shape[0]
+
+  opt_init, opt_update = optax.adam(learning_rate=options.learning_rate)
+  grad_fun = jax.value_and_grad(loss_fun, has_aux=True)
+
+  @jit
+  def run(params, state, inputs, rng):
+
+    def cond(carry):
+      i, _, _, _, _, _, n_no_improvement, done = carry
+      return (i < options.n_steps) & (n_no_improvement < options.patience) & ~done
+
+    def body(carry):
+      i, params, state, opt_state, smoothed_loss, best_loss, n_no_improvement, done = carry
+      chunk = jax.tree_map(lambda x: x[i%n_chunks], inputs)
+
+      (loss, new_state), grad = grad_fun(params, state, chunk, random.fold_in(rng, i))
+      updates, new_opt_state = opt_update(grad, opt_state, params)
+
+      # Stay on the device instead of checking for nans on the host
+      finite = jnp.isfinite(loss)
+      for u in jax.tree_leaves(updates):
+        finite = finite & jnp.all(jnp.isfinite(u))
+
+      keep = lambda new, old: jax.tree_multimap(partial(jnp.where, finite), new, old)
+      params = keep(optax.apply_updates(params, updates), params)
+      state = keep(new_state, state)
+      opt_state = keep(new_opt_state, opt_state)
+
+      # Plateau check on a moving average of the loss so that the chunks don't add noise
+      smoothed_loss = jnp.where(i == 0, loss, options.smoothing*smoothed_loss + (1 - options.smoothing)*loss)
+      improved = ~jnp.isfinite(best_loss) | (smoothed_loss < best_loss - options.tol*jnp.abs(best_loss))
+      best_loss = jnp.where(improved, smoothed_loss, best_loss)
+      n_no_improvement = jnp.where(improved, 0, n_no_improvement + 1)
+
+      return i + 1, params, state, opt_state, smoothed_loss, best_loss, n_no_improvement, done | ~finite
+
+    carry = (jnp.array(0), params, state, opt_init(params), jnp.array(jnp.inf), jnp.array(jnp.inf), jnp.array(0), jnp.array(False))
+    i, params, state, _, smoothed_loss, _, _, _ = jax.lax.while_loop(cond, body, carry)
+    return params, state, i, smoothed_loss
+
+  return run(params, state, inputs, rng)
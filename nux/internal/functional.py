@@ -19,6 +19,7 @@ T = TypeVar("T")
 
 __all__ = ["make_functional_modules_init",
            "make_functional_modules",
+           "make_pure_functions",
            # "make_functional_modules_from_fixed_frame_data",
            "make_functional_modules_with_fixed_state"]
 
@@ -95,6 +96,33 @@ def make_functional_modules(modules):
 
 ################################################################################################################
 
+@contextlib.contextmanager
+def make_pure_functions(modules):
+  """ make_functional_modules for functions that go through a JAX transformation (jit, checkpoint,
+      scan, custom_vjp, etc.).  The constants are python values (like the shapes from get_constant),
+      so they are closed over instead of being passed as arguments.  Yields
+
+        pure_funs, params, state, constants, frame_rng, finalize
+
+      where pure_funs[i](params, state, frame_rng, x, rng) -> (out, state, frame_rng)
+      and finalize(params, state, frame_rng) must be called before leaving the with statement.
+  """
+  with make_functional_modules(modules) as (wrapped_modules, params, bundled_state, finalize):
+    state, constants, frame_rng = bundled_state
+
+    def make_pure(wrapped):
+      def pure_fun(params, state, frame_rng, x, rng):
+        out, (state, _, frame_rng) = wrapped(params, (state, constants, frame_rng), x, rng)
+        return out, state, frame_rng
+      return pure_fun
+
+    def finalize_pure(params, state, frame_rng):
+      finalize(params, (state, constants, frame_rng))
+
+    yield [make_pure(wrapped) for wrapped in wrapped_modules], params, state, constants, frame_rng, finalize_pure
+
+################################################################################################################
+
 # @contextlib.contextmanager
 # def make_functional_modules(modules):
 
@@ -0,0 +1,164 @@
+import jax.numpy as jnp
+import jax
+import numpy as np
+import haiku._src.base as hk_base
+from typing import Optional, Mapping, Callable, Sequence, Any, Tuple
+from nux.internal.base import CustomFrame
+
+__all__ = ["invertible_chain"]
+
+""" Backpropagation through a chain of bijective layers without storing the intermediate activations.
+    Only the output of the chain is saved.  During the backward pass, the input of each layer is
+    reconstructed from its output with the layer's inverse and then the layer is run again to get its
+    vector-Jacobian product.  This trades one extra inverse and forward pass per layer for memory that
+    doesn't grow with the number of layers. """
+
+################################################################################################################
+
+def is_differentiable(x):
+  return jnp.issubdtype(jnp.result_type(x), jnp.inexact)
+
+def zeros_like_cotangent(x):
+  # Integer outputs (like labels) need float0 cotangents
+  if is_differentiable(x) == False:
+    return np.zeros(jnp.shape(x), dtype=jax.dtypes.float0)
+  return jnp.zeros_like(x)
+
+def invertible_chain(apply_funs: Sequence[Callable],
+                     inverse_funs: Sequence[Callable],
+                     params: Mapping[str, Any],
+                     state: Mapping[str, Any],
+                     constants: Mapping[str, Any],
+                     frame_rng: Any,
+                     inputs: Mapping[str, jnp.ndarray],
+                     rngs: Optional[jnp.ndarray],
+                     accumulate: Sequence[str]=["log_det"]
+) -> Tuple[Mapping[str, jnp.ndarray], Mapping[str, Any], Any]:
+  """ Run apply_funs in order, like sequential does, with a custom VJP that reconstructs
+      the intermediate values with inverse_funs.  Only "x" is passed from one layer to the next.
+      The gradient is taken with respect to params, inputs["x"] and the floating point values of
+      the other inputs, like a condition that every layer sees.
+  Args:
+    apply_funs  : Pure functions from make_pure_functions.
+    inverse_funs: The inverses of apply_funs.  inverse_funs[i] must recover the input of apply_funs[i]
+                  from its output using the same parameters, state and key.
+    params      : Parameters of the layers.
+    state       : State of the layers.
+    constants   : Constants of the layers.  Needed to run the layers during the backward pass.
+    frame_rng   : The frame's key from make_pure_functions.
+    inputs      : The inputs to the first layer.
+    rngs        : One key for each layer or None.
+    accumulate  : Outputs that are summed over the layers.
+  Returns:
+    The outputs, the updated state and the updated frame key.
+  """
+  n_layers = len(apply_funs)
+  other_inputs = inputs.copy()
+  x = other_inputs.pop("x")
+
+  # The output keys of each layer are found while tracing the forward pass
+  output_keys = [None]*n_layers
+
+  def get_rng(rngs, i):
+    return None if rngs is None else rngs[i]
+
+  def run_layer(i, params, state, frame_rng, x, other_inputs, rngs):
+    layer_inputs = other_inputs.copy()
+    layer_inputs["x"] = x
+    return apply_funs[i](params, state, frame_rng, layer_inputs, get_rng(rngs, i))
+
+  def run_chain(params, state, frame_rng, x, other_inputs, rngs):
+    final_outputs = other_inputs.copy()
+    accumulated_outputs = {}
+
+    # The frame key that each layer starts with.  The backward pass replays them.
+    layer_frame_rngs = []
+    for i in range(n_layers):
+      layer_frame_rngs.append(frame_rng)
+      outputs, state, frame_rng = run_layer(i, params, state, frame_rng, x, other_inputs, rngs)
+      output_keys[i] = tuple(outputs.keys())
+      x = outputs["x"]
+      final_outputs.update(outputs)
+
+      for name in accumulate:
+        if name in outputs:
+          accumulated_outputs[name] = accumulated_outputs.get(name, 0.0) + outputs[name]
+
+    final_outputs.update(accumulated_outputs)
+    return final_outputs, state, frame_rng, layer_frame_rngs
+
+  @jax.custom_vjp
+  def chain(params, state, frame_rng, x, other_inputs, rngs):
+    final_outputs, state, frame_rng, _ = run_chain(params, state, frame_rng, x, other_inputs, rngs)
+    return final_outputs, state, frame_rng
+
+  def chain_fwd(params, state, frame_rng, x, other_inputs, rngs):
+    final_outputs, new_state, new_frame_rng, layer_frame_rngs = run_chain(params, state, frame_rng, x, other_inputs, rngs)
+
+    # Only save the output of the chain and the keys.  Every layer sees the state that was passed in.
+    ctx = params, state, layer_frame_rngs, final_outputs["x"], other_inputs, rngs
+    return (final_outputs, new_state, new_frame_rng), ctx
+
+  def chain_bwd(ctx, g):
+    params, state, layer_frame_rngs, z, other_inputs, rngs = ctx
+    g_outputs, _, _ = g
+
+    # Find the layer whose output ends up in the final outputs
+    last_layer = {}
+    for i in range(n_layers):
+      for name in output_keys[i]:
+        last_layer[name] = i
+
+    # The other inputs are passed to every layer and also end up in the final outputs
+    # unless a layer outputs a value with the same name
+    differentiable_names = [name for name, val in other_inputs.items() if is_differentiable(val)]
+    d_other_inputs = {}
+    for name, val in other_inputs.items():
+      if name in differentiable_names and name not in last_layer:
+        d_other_inputs[name] = g_outputs[name]
+      else:
+        d_other_inputs[name] = zeros_like_cotangent(val)
+
+    with hk_base.frame_stack(CustomFrame.create_from_params_and_state(params, (state, constants, layer_frame_rngs[0]))):
+      dparams = jax.tree_map(jnp.zeros_like, params)
+      dz = g_outputs["x"]
+
+      for i in reversed(range(n_layers)):
+        frame_rng = layer_frame_rngs[i]
+
+        # Reconstruct the input to this layer
+        layer_inputs = other_inputs.copy()
+        layer_inputs["x"] = z
+        inverse_outputs, _, _ = inverse_funs[i](params, state, frame_rng, layer_inputs, get_rng(rngs, i))
+        x = jax.lax.stop_gradient(inverse_outputs["x"])
+
+        def layer_fun(params, x, differentiable_inputs):
+          layer_other_inputs = other_inputs.copy()
+          layer_other_inputs.update(differentiable_inputs)
+          outputs, _, _ = run_layer(i, params, state, frame_rng, x, layer_other_inputs, rngs)
+          return outputs
+
+        differentiable_inputs = {name: other_inputs[name] for name in differentiable_names}
+        outputs, vjp_fun = jax.vjp(layer_fun, params, x, differentiable_inputs)
+
+        # Cotangent for each of this layer's outputs
+        g_layer = {}
+        for name, val in outputs.items():
+          if name == "x":
+            g_layer[name] = dz
+          elif name in accumulate or last_layer[name] == i:
+            g_layer[name] = g_outputs[name]
+          else:
+            g_layer[name] = zeros_like_cotangent(val)
+
+        dparams_i, dz, d_differentiable_i = vjp_fun(g_layer)
+        dparams = jax.tree_multimap(lambda x, y: x + y, dparams, dparams_i)
+        for name, val in d_differentiable_i.items():
+          d_other_inputs[name] = d_other_inputs[name] + val
+        z = x
+
+    return dparams, None, None, dz, d_other_inputs, None
+
+  chain.defvjp(chain_fwd, chain_bwd)
+
+  return chain(params, state, frame_rng, x, other_inputs, rngs)
@@ -5,10 +5,16 @@ from jax import random, jit, vmap
 import haiku as hk
 from abc import ABC, abstractmethod
 import warnings
+import threading
+import contextlib
+import sys
 from typing import Optional, Mapping, Type, Callable, Iterable, Any, Sequence, Union, Tuple, MutableMapping, NamedTuple, Set, TypeVar
 import nux.util as util
 from nux.internal.base import get_constant, new_custom_context
-from nux.internal.functional import make_functional_modules
+from nux.internal.functional import make_pure_functions
+from nux.internal.compile_cache import CompiledFunctionCache
+from nux.internal.abstract import is_abstract, materialize_tree
+import haiku._src.base as hk_base
 
 from haiku._src.typing import PRNGKey, Params, State
 from haiku._src.transform import TransformedWithState, \
@@ -19,11 +25,21 @@ from haiku._src.transform import TransformedWithState, \
                                  APPLY_RNG_ERROR
 
 __all__ = ["Layer",
+           "TransformedFlow",
            "transform_flow",
            "Flow"]
 
 ################################################################################################################
 
+""" The optional parts of a flow (the persistent compilation cache, bucketing, invertible_ad, remat,
+    data dependent init and profiling) are imported by the methods that use them so that using a
+    layer only imports what it needs. """
+
+def active_profiler():
+  # A profiler can only be active once its module was imported
+  profiler_module = sys.modules.get("nux.internal.profiler", None)
+  return profiler_module.LayerProfiler.active if profiler_module is not None else None
+
 def get_tree_shapes(name: str,
                     pytree: Any,
                     batch_axes: Optional[Sequence[int]] = (),
@@ -46,10 +62,21 @@ class Layer(hk.Module, ABC):
 
   batch_axes = ()
 
+  # How auto_batch handles multiple batch axes.  "nested_vmap" uses one vmap per axis and
+  # "collapse" reshapes them into one axis, which traces faster but computes batch statistics
+  # over the merged axis.  See auto_batch.
+  auto_batch_strategy = "nested_vmap"
+
   def __init__(self, name=None, invertible_ad=False, use_flow_norm_init=False):
     """ This base class will keep track of the input and output shapes of each function call
         so that we can know the batch size of inputs and automatically use vmap to make unbatched
         code work with batched code.
+    Args:
+      name              : Optional name for this module.
+      invertible_ad     : Whether to backpropagate by reconstructing the input of this layer with its
+                          inverse instead of storing the intermediate activations.  Only valid for layers
+                          whose inverse exactly recovers their input.
+      use_flow_norm_init: Whether to use data dependent initialization.
     """
     super().__init__(name=name)
     self.invertible_ad = invertible_ad
@@ -68,6 +95,11 @@ class Layer(hk.Module, ABC):
                **kwargs
     ) -> Mapping[str, jnp.ndarray]:
 
+    # Let an active profiler time this call
+    profiler = active_profiler()
+    if profiler is not None and profiler.should_profile(self, inputs):
+      return profiler.profile_call(self, inputs, rng, sample=sample, **kwargs)
+
     batch_axes = Layer.batch_axes
 
     if sample == False:
@@ -83,11 +115,11 @@ class Layer(hk.Module, ABC):
     else:
       self.batch_shape = inputs["x"].shape[:-len(self.unbatched_output_shapes["x"])]
 
-    # Run the actual function
-    if self.invertible_ad == False:
+    # Run the actual function.  Initialization always runs the regular call.
+    if self.invertible_ad == False or hk_base.params_frozen() == False:
       outputs = self.call(inputs, rng, sample=sample, **kwargs)
     else:
-      assert 0, "Not implemented"
+      outputs = self.invertible_call(inputs, rng, sample=sample, **kwargs)
 
     if sample == False:
       # Keep track of the initial output shapes
@@ -100,7 +132,97 @@ class Layer(hk.Module, ABC):
 
     return outputs
 
+  def invertible_call(self,
+                      inputs: Mapping[str, jnp.ndarray],
+                      rng: jnp.ndarray=None,
+                      sample: Optional[bool]=False,
+                      **kwargs
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Run call, but backpropagate by reconstructing the input from the output with the inverse
+        of this layer so that none of the intermediate activations need to be stored.
+    """
+    # The backward pass is traced later, so remember the shapes that call uses
+    shapes = self.unbatched_input_shapes, self.unbatched_output_shapes, self.batch_shape
+
+    def apply_fun(inputs, rng):
+      self.unbatched_input_shapes, self.unbatched_output_shapes, self.batch_shape = shapes
+      return self.call(inputs, rng, sample=sample, **kwargs)
+
+    def inverse_fun(inputs, rng):
+      self.unbatched_input_shapes, self.unbatched_output_shapes, self.batch_shape = shapes
+      inverse_kwargs = kwargs.copy()
+      inverse_kwargs["reconstruction"] = True
+      return self.call(inputs, rng, sample=not sample, **inverse_kwargs)
+
+    from nux.internal.invertible import invertible_chain
+    with make_pure_functions([apply_fun, inverse_fun]) as ([apply_fun, inverse_fun], params, state, constants, frame_rng, finalize):
+      rngs = rng[None] if rng is not None else None
+      outputs, state, frame_rng = invertible_chain([apply_fun], [inverse_fun], params, state, constants, frame_rng, inputs, rngs, accumulate=[])
+      finalize(params, state, frame_rng)
+
+    return outputs
+
   def auto_batch(self, fun, in_axes=None, out_axes=None, expected_depth=None):
+    """ Make fun, which expects expected_depth batch axes (None for unbatched code), work with
+        the batch shape of this layer.  in_axes says which arguments are batched (0) and which
+        aren't (None).  out_axes says which outputs are batched in the same way.  Every output is
+        batched if out_axes is None.
+
+        With the "collapse" strategy, a function that expects fewer batch axes than the layer has
+        is run once over a batch whose extra leading axes are merged into one.  Batched outputs must
+        have the merged axis first.  Statistics that fun computes over its batch axis, like the data
+        dependent initialization of ActNorm or the mixture flows and spectral norm updates, are then
+        taken over the merged batch instead of separately for each of the outer batch indices.
+    """
+    if Layer.auto_batch_strategy == "nested_vmap":
+      return self.nested_vmap_auto_batch(fun, in_axes=in_axes, out_axes=out_axes, expected_depth=expected_depth)
+
+    # Collapsing only works when the batch axes lead
+    if in_axes is not None and any([ax not in (0, None) for ax in in_axes]):
+      return self.nested_vmap_auto_batch(fun, in_axes=in_axes, out_axes=out_axes, expected_depth=expected_depth)
+
+    batch_depth = len(self.batch_shape)
+    if expected_depth is None and batch_depth > 0:
+      n_collapse, use_vmap = batch_depth, True
+    elif expected_depth is not None and expected_depth < batch_depth:
+      n_collapse, use_vmap = batch_depth - expected_depth + 1, False
+    else:
+      # Nothing to collapse.  Dummy axes are added by the vmap version.
+      return self.nested_vmap_auto_batch(fun, in_axes=in_axes, out_axes=out_axes, expected_depth=expected_depth)
+
+    def collapsed_fun(*args, **kwargs):
+      args_axes = in_axes if in_axes is not None else (0,)*len(args)
+
+      # Find the shape of the axes that we're collapsing
+      lead_shapes = [x.shape[:n_collapse] for ax, arg in zip(args_axes, args) if ax is not None for x in jax.tree_leaves(arg)]
+      lead_shape = lead_shapes[0]
+      assert all([shape == lead_shape for shape in lead_shapes]), f"Inconsistent batch shapes {lead_shapes}"
+      n_lead = int(util.list_prod(lead_shape))
+
+      # Merge the leading axes into one
+      def collapse(x):
+        return x.reshape((n_lead,) + x.shape[n_collapse:])
+      args = tuple([jax.tree_map(collapse, arg) if ax is not None else arg for ax, arg in zip(args_axes, args)])
+
+      # Run the function once over the merged axis
+      if use_vmap:
+        vmap_kwargs = {"in_axes": in_axes} if in_axes is not None else {}
+        out = vmap(partial(fun, **kwargs), **vmap_kwargs)(*args)
+      else:
+        out = fun(*args, **kwargs)
+
+      # Split the merged axis.  vmap batches every output, otherwise out_axes says which outputs are batched.
+      def expand(x):
+        assert jnp.ndim(x) > 0 and x.shape[0] == n_lead, f"Expected a batched output with {n_lead} elements in its first axis, but got shape {jnp.shape(x)}.  Set its out_axes entry to None if it isn't batched."
+        return x.reshape(lead_shape + x.shape[1:])
+
+      if use_vmap == False and out_axes is not None:
+        return type(out)([jax.tree_map(expand, o) if ax is not None else o for ax, o in zip(out_axes, out)])
+      return jax.tree_map(expand, out)
+
+    return collapsed_fun
+
+  def nested_vmap_auto_batch(self, fun, in_axes=None, out_axes=None, expected_depth=None):
 
     vmap_kwargs = {}
     if in_axes is not None:
@@ -176,7 +298,8 @@ class Layer(hk.Module, ABC):
                      rng: jnp.ndarray=None,
                      sample: Optional[bool]=False,
                      **kwargs):
-    """ Initialize this layer so that its outputs are normally distributed
+    """ Initialize this layer so that its outputs are normally distributed.  The optimization runs
+        as one compiled loop and is configured with set_flow_norm_init_options.
     """
 
     # Check if we've set flow norm (will be False the first time)
@@ -186,6 +309,8 @@ class Layer(hk.Module, ABC):
     get_constant("flow_norm_set", True, do_not_set=False)
 
     if not flow_norm_set:
+      from nux.internal.flow_norm_init import get_flow_norm_init_options, split_init_batches, fit_flow_norm_init, init_batches_are_stacked
+
       # Train this layer over the input batch to generate a unit normal output
 
       def loss_fun(inputs, rng, sample=False, **kwargs):
@@ -200,35 +325,34 @@ class Layer(hk.Module, ABC):
         log_px = log_pz + outputs["log_det"]
         return -log_px.mean()
 
-      with make_functional_modules([loss_fun]) as ([apply_fun], \
-                                                   params, \
-                                                   state, \
-                                                   finalize_params_and_state):
-        import optax
-        opt_init, opt_update = optax.adam(learning_rate=1e-4)
-        opt_state = opt_init(params)
-        opt_update = jit(opt_update)
+      options = get_flow_norm_init_options()
 
-        grad_fun = jax.value_and_grad(apply_fun, has_aux=True)
-        grad_fun = partial(grad_fun, sample=sample, **kwargs)
-        grad_fun = jit(grad_fun)
+      with make_pure_functions([partial(loss_fun, sample=sample, **kwargs)]) as ([apply_fun], params, state, _, frame_rng, finalize):
 
-        import tqdm
-        pbar = tqdm.tqdm(list(enumerate(random.split(rng, 200))))
-        for i, rng in pbar:
-          (loss, state), grad = grad_fun(params, state, inputs, rng)
-          updates, opt_state = opt_update(grad, opt_state, params)
-          if jnp.any(jnp.isnan(jax.flatten_util.ravel_pytree(updates)[0])):
-            break
-          params = jit(optax.apply_updates)(params, updates)
+        def chunk_loss(params, state, inputs, rng):
+          loss, state, _ = apply_fun(params, state, frame_rng, inputs, rng)
+          return loss, state
 
-          pbar.set_description(f"loss: {loss}")
+        # Every optimization step uses one chunk of the batch or one of the stacked init batches
+        if init_batches_are_stacked():
+          chunked_inputs = inputs
+        else:
+          chunked_inputs = split_init_batches(inputs, options.n_batches, self.batch_shape)
+        params, state, _, _ = fit_flow_norm_init(chunk_loss, params, state, chunked_inputs, rng, options)
 
-        finalize_params_and_state(params, state)
+        finalize(params, state, frame_rng)
 
 ################################################################################################################
 
-def transform_flow(create_fun) -> TransformedWithState:
+class TransformedFlow(NamedTuple):
+  """ TransformedWithState with an abstract init.  abstract_init has the same signature as init,
+      but returns ShapeDtypeStruct trees for the parameters and state plus the shape constants.
+  """
+  init: Callable
+  apply: Callable
+  abstract_init: Callable
+
+def transform_flow(create_fun) -> TransformedFlow:
 
   # We will keep the expected shapes for the flow here so that
   # JAX will compile these constants
@@ -282,7 +406,26 @@ def transform_flow(create_fun) -> TransformedWithState:
       out = model(inputs, key, **kwargs)
     return out, ctx.collect_state()
 
-  return TransformedWithState(init_fn, apply_fn)
+  def abstract_init_fn(rng: Optional[Union[PRNGKey]],
+                       inputs: Mapping[str, jnp.ndarray],
+                       batch_axes=(),
+                       return_initial_output=False,
+                       **kwargs
+  ) -> Tuple[Params, State, Mapping[str, Any]]:
+    """ Trace init with jax.eval_shape so that nothing is allocated or computed, including the data
+        dependent initializations.  inputs can be arrays or ShapeDtypeStructs.  The constants are
+        python values, so they are real after tracing and apply can be used once the parameters
+        and state are materialized.
+    """
+    init = partial(init_fn, batch_axes=batch_axes, return_initial_output=True, **kwargs)
+    params, state, outputs = jax.eval_shape(init, rng, inputs)
+
+    if return_initial_output:
+      return params, state, constants, outputs
+
+    return params, state, constants
+
+  return TransformedFlow(init_fn, apply_fn, abstract_init_fn)
 
 ################################################################################################################
 
@@ -290,32 +433,147 @@ class Flow():
   """ Convenience class to wrap a Layer class
 
       Args:
-          flow     - A Flow object.
-          clip     - How much to clip gradients.  This is crucial for stable training!
-          warmup   - How much to warm up the learning rate.
-          lr_decay - Learning rate decay.
-          lr       - Max learning rate.
+          flow                  - A Flow object.
+          clip                  - How much to clip gradients.  This is crucial for stable training!
+          warmup                - How much to warm up the learning rate.
+          lr_decay              - Learning rate decay.
+          lr                    - Max learning rate.
+          cache_size            - Max number of compiled executables to keep for apply and scan_apply.
+          compilation_cache_dir - If set, serialize compiled executables here so that they
+                                  can be reloaded the next time the process starts.
+          model_config          - Json serializable description of the model that goes into
+                                  the compilation cache fingerprint.
+          bucket_sizes          - If set, pad the innermost batch axis of inputs up to one of these
+                                  sizes so that ragged batches don't trigger a new compile.  Only
+                                  calls with is_training=False are padded, because the padded rows
+                                  would take part in the state updates of training calls.
+          abstract_init         - If True, only trace the flow to find the shapes of the parameters
+                                  and state.  params and state are ShapeDtypeStruct trees until
+                                  materialize or load is called.
+          init_batches          - Optional iterable of batches with the same shapes as inputs.  If set,
+                                  the data dependent initialization runs on these instead of inputs.
+                                  Layers with use_flow_norm_init take one optimization step per batch.
   """
   def __init__(self,
                create_fun: Callable,
                key: PRNGKey,
                inputs: Mapping[str,jnp.ndarray],
                batch_axes: Sequence[int],
+               cache_size: Optional[int]=32,
+               compilation_cache_dir: Optional[str]=None,
+               model_config: Optional[Any]=None,
+               bucket_sizes: Optional[Sequence[int]]=None,
+               abstract_init: bool=False,
+               init_batches: Optional[Iterable[Mapping[str, jnp.ndarray]]]=None,
                **kwargs):
 
     self._flow = transform_flow(create_fun)
-    self.params, self.state, outputs = self._flow.init(key,
-                                                       inputs,
-                                                       batch_axes=batch_axes,
-                                                       return_initial_output=True)
-    self.data_shape   = inputs["x"].shape[len(batch_axes):]
-    self.latent_shape = outputs["x"].shape[len(batch_axes):]
+
+    # Several init batches are stacked along a new leading batch axis
+    if init_batches is not None:
+      from nux.internal.flow_norm_init import split_init_batches
+      init_inputs = split_init_batches(init_batches)
+      init_batch_axes = (0,) + tuple([ax + 1 for ax in batch_axes])
+    else:
+      init_inputs, init_batch_axes = inputs, batch_axes
+    self._init_args = (key, init_inputs, init_batch_axes, init_batches is not None) if abstract_init else None
+
+    # The fingerprint only needs shapes, so it is computed lazily unless the compilation cache needs it
+    self.model_config = model_config
+    self._fingerprint_inputs = jax.tree_map(lambda x: jax.ShapeDtypeStruct(jnp.shape(x), jnp.result_type(x)), inputs)
+    self._fingerprint = None
+
+    with self.init_context(init_batches is not None):
+      if abstract_init:
+        self.params, self.state, self.constants, outputs = self._flow.abstract_init(key,
+                                                                                    init_inputs,
+                                                                                    batch_axes=init_batch_axes,
+                                                                                    return_initial_output=True)
+      else:
+        self.params, self.state, outputs = self._flow.init(key,
+                                                           init_inputs,
+                                                           batch_axes=init_batch_axes,
+                                                           return_initial_output=True)
+    self.data_shape   = init_inputs["x"].shape[len(init_batch_axes):]
+    self.latent_shape = outputs["x"].shape[len(init_batch_axes):]
+
+    # Reload executables that were compiled by a previous process.  The fingerprint uses the
+    # shapes from the init above, so the cache is active before apply compiles anything.
+    self.compilation_cache = None
+    if compilation_cache_dir is not None:
+      from nux.internal.persistent_cache import PersistentCompilationCache
+      self.compilation_cache = PersistentCompilationCache(compilation_cache_dir, self.fingerprint)
+
+    # Compiled executables keyed on the input shapes and the static kwargs
+    # (sample, reconstruction, t, accumulate, etc.)
+    self._compiled_apply = CompiledFunctionCache(self._flow.apply, max_size=cache_size, name="apply")
+    self._compiled_scan_apply = CompiledFunctionCache(self._scan_apply_fun, max_size=cache_size, name="scan_apply")
+
+    # Cap the number of compiles at the number of buckets
+    self.bucketer = None
+    if bucket_sizes is not None:
+      from nux.internal.bucketing import ShapeBucketer
+      self.bucketer = ShapeBucketer(bucket_sizes)
+
+    # Background copy of a lazily loaded checkpoint to the device
+    self._load_thread = None
+    self._load_error = None
+
+  @property
+  def fingerprint(self) -> str:
+    """ Hash of the shapes of the parameters, state and inputs.  Names the compilation cache. """
+    if self._fingerprint is None:
+      from nux.internal.persistent_cache import flow_fingerprint
+      self._fingerprint = flow_fingerprint(self.params, self.state, self._fingerprint_inputs, config=self.model_config)
+    return self._fingerprint
+
+  @staticmethod
+  def init_context(stacked: bool):
+    if stacked == False:
+      return contextlib.nullcontext()
+    from nux.internal.flow_norm_init import stacked_init_batches
+    return stacked_init_batches()
+
+  @property
+  def is_abstract(self):
+    return is_abstract((self.params, self.state))
+
+  def materialize(self,
+                  params: Optional[Params]=None,
+                  state: Optional[State]=None,
+                  run_init: bool=False):
+    """ Replace the ShapeDtypeStructs of an abstract flow with arrays.
+    Args:
+      params  : Parameters to use, like ones that were restored or sharded.  Their shapes and dtypes
+                are checked against the abstract parameters.
+      state   : State to use.
+      run_init: If True, run the regular (data dependent) initialization for whatever wasn't passed
+                in.  Otherwise params and state must be passed.  There is no cheap default because
+                zeros aren't valid values (singular weight matrices, NaN spectral norm state).
+    """
+    if self.is_abstract == False:
+      return
+
+    missing = [name for name, tree, value in [("params", self.params, params), ("state", self.state, state)] if is_abstract(tree) and value is None]
+    if len(missing) > 0 and run_init == False:
+      assert 0, f"Pass {' and '.join(missing)} or use run_init=True to materialize an abstract flow"
+
+    if run_init and (params is None or state is None):
+      key, inputs, batch_axes, stacked = self._init_args
+      with self.init_context(stacked):
+        init_params, init_state = self._flow.init(key, inputs, batch_axes=batch_axes)
+      params = init_params if params is None else params
+      state = init_state if state is None else state
+
+    self.params = materialize_tree(self.params, params) if is_abstract(self.params) else self.params
+    self.state = materialize_tree(self.state, state) if is_abstract(self.state) else self.state
 
   def to_bits_per_dim(self, log_likelihood):
     return log_likelihood/util.list_prod(self.data_shape)/jnp.log(2)
 
-  def get_batch_shape(self, inputs):
-    return inputs["x"].shape[-len(self.data_shape):]
+  def get_batch_shape(self, inputs, sample=False):
+    x_shape = self.latent_shape if sample else self.data_shape
+    return inputs["x"].shape[:inputs["x"].ndim - len(x_shape)]
 
   #############################################################################
 
@@ -335,12 +593,37 @@ class Flow():
   def _apply_fun(self):
     return self._flow.apply
 
+  def pads_inputs(self, **kwargs) -> bool:
+    """ Whether a call with these kwargs pads its inputs to a bucket size.  Padded rows would
+        bias data dependent state (like batch statistics), so training calls are never padded.
+    """
+    return self.bucketer is not None and kwargs.get("is_training", True) == False
+
+  def bucketed_call(self,
+                    compiled_fun: Callable,
+                    state: State,
+                    key: PRNGKey,
+                    inputs: Mapping[str, jnp.ndarray],
+                    **kwargs
+  ) -> Tuple[Mapping[str, jnp.ndarray], State]:
+    """ Pad the innermost batch axis to a bucket size, call the compiled function and then
+        remove the padding.
+    """
+    self.check_load()
+    if self.pads_inputs(**kwargs) == False:
+      return compiled_fun(self.params, state, key, inputs, **kwargs)
+
+    batch_shape = self.get_batch_shape(inputs, sample=kwargs.get("sample", False))
+    padded_inputs, _ = self.bucketer.pad(inputs, len(batch_shape))
+    outputs, state = compiled_fun(self.params, state, key, padded_inputs, **kwargs)
+    return self.bucketer.unpad(outputs, batch_shape), state
+
   def apply(self,
             key: PRNGKey,
             inputs: Mapping[str, jnp.ndarray],
             **kwargs
   ) -> Mapping[str, jnp.ndarray]:
-    outputs, self.state = self._flow.apply(self.params, self.state, key, inputs, **kwargs)
+    outputs, self.state = self.bucketed_call(self._compiled_apply, self.state, key, inputs, **kwargs)
     return self.process_outputs(outputs)
 
   def stateful_apply(self,
@@ -349,32 +632,43 @@ class Flow():
                      state: State,
                      **kwargs
   ) -> Mapping[str, jnp.ndarray]:
-    outputs, state = self._flow.apply(self.params, state, key, inputs, **kwargs)
+    outputs, state = self.bucketed_call(self._compiled_apply, state, key, inputs, **kwargs)
     return self.process_outputs(outputs), state
 
   #############################################################################
 
-  def scan_apply(self,
-                 key: PRNGKey,
-                 inputs: Mapping[str, jnp.ndarray],
-                 **kwargs
-  ) -> Mapping[str, jnp.ndarray]:
-    """ Applies a lax.scan loop to the first batch axis
-    """
-    if len(inputs["x"].shape) == len(self.data_shape):
-      assert 0, "Expect a batched or doubly-batched input"
+  def _scan_apply_fun(self,
+                      params: Params,
+                      state: State,
+                      key: PRNGKey,
+                      inputs: Mapping[str, jnp.ndarray],
+                      **kwargs
+  ) -> Tuple[Mapping[str, jnp.ndarray], State]:
 
     def scan_body(carry, scan_inputs):
       key, _inputs = scan_inputs
       state = carry
-      outputs, state = self.stateful_apply(key, _inputs, state, **kwargs)
+      outputs, state = self._flow.apply(params, state, key, _inputs, **kwargs)
       return state, outputs
 
     # Get the inputs for the scan loop
     n_iters = inputs["x"].shape[0]
     keys = random.split(key, n_iters)
     scan_inputs = (keys, inputs)
-    self.state, outputs = jax.lax.scan(scan_body, self.state, scan_inputs)
+    state, outputs = jax.lax.scan(scan_body, state, scan_inputs)
+    return outputs, state
+
+  def scan_apply(self,
+                 key: PRNGKey,
+                 inputs: Mapping[str, jnp.ndarray],
+                 **kwargs
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Applies a lax.scan loop to the first batch axis
+    """
+    if len(inputs["x"].shape) == len(self.data_shape):
+      assert 0, "Expect a batched or doubly-batched input"
+
+    outputs, self.state = self.bucketed_call(self._compiled_scan_apply, self.state, key, inputs, **kwargs)
     return self.process_outputs(outputs)
 
   #############################################################################
@@ -393,6 +687,46 @@ class Flow():
       outputs = self.scan_apply(key, {"x": dummy_z}, sample=True, **kwargs)
     return self.process_outputs(outputs)
 
+  def sample_stream(self,
+                    key: PRNGKey,
+                    n_samples: int,
+                    chunk_size: int=1000,
+                    sink: Optional[Any]=None,
+                    **kwargs
+  ) -> Iterable[Mapping[str, jnp.ndarray]]:
+    """ Generator that yields {"x", "log_px"} for chunks of chunk_size samples so that only
+        a couple of chunks are in memory at a time.  Chunk i uses random.fold_in(key, i), so every
+        chunk has an independent random stream.  The next chunk is started before the current one is
+        yielded so that sampling overlaps with whatever the caller does with the samples.
+    Args:
+      key       : JAX random key.
+      n_samples : Total number of samples.
+      chunk_size: Number of samples in each chunk.  The last chunk is smaller if needed.
+      sink      : Optional object with write(chunk) and close(), like util.NpySink or util.ShardedNpySink.
+                  It is closed even if sampling fails or the generator isn't run to the end.
+    """
+    n_chunks = -(-n_samples//chunk_size)
+
+    def start_chunk(i):
+      # Always sample a full chunk so that the last chunk doesn't need its own compile
+      outputs = self.sample(random.fold_in(key, i), chunk_size, **kwargs)
+      size = min(chunk_size, n_samples - i*chunk_size)
+      return {"x": outputs["x"][:size], "log_px": outputs["log_px"][:size]}
+
+    try:
+      next_chunk = start_chunk(0) if n_chunks > 0 else None
+      for i in range(n_chunks):
+        chunk = next_chunk
+        if i + 1 < n_chunks:
+          next_chunk = start_chunk(i + 1)
+
+        if sink is not None:
+          sink.write(chunk)
+        yield chunk
+    finally:
+      if sink is not None:
+        sink.close()
+
   def reconstruct(self,
                   key: PRNGKey,
                   inputs: Mapping[str, jnp.ndarray],
@@ -407,12 +741,103 @@ class Flow():
 
   #############################################################################
 
+  def memory_report(self,
+                    key: PRNGKey,
+                    inputs: Mapping[str, jnp.ndarray],
+                    **kwargs
+  ) -> Mapping[str, int]:
+    """ Estimate the peak memory of a gradient step on the negative log likelihood of inputs.
+        Use this to compare remat policies and batch sizes.
+    """
+    def loss(params, state, key, inputs):
+      outputs, _ = self._flow.apply(params, state, key, inputs, **kwargs)
+      log_px = outputs.get("log_pz", 0.0) + outputs.get("log_det", 0.0)
+      return -jnp.mean(log_px)
+
+    # Liveness estimate from the jaxpr, not XLA's actual allocation
+    from nux.internal.remat import peak_memory_bytes
+    peak_bytes = peak_memory_bytes(jax.grad(loss), self.params, self.state, key, inputs)
+    return {"estimated_peak_bytes": peak_bytes,
+            "param_bytes": util.tree_bytes(self.params),
+            "input_bytes": util.tree_bytes(inputs)}
+
+  def profile(self,
+              key: PRNGKey,
+              inputs: Mapping[str, jnp.ndarray],
+              n_runs: int=10,
+              **kwargs
+  ) -> "LayerProfiler":
+    """ Time every layer in both directions and get XLA's cost analysis for them.
+        Use report(), to_json or to_chrome_trace on the result.
+    """
+    from nux.internal.profiler import profile_flow
+    return profile_flow(self, key, inputs, n_runs=n_runs, **kwargs)
+
+  #############################################################################
+
   def save(self, path: str=None):
+    self.wait_until_loaded()
     save_items = {"params": self.params,
                   "state": self.state}
     util.save_pytree(save_items, path, overwrite=True)
 
-  def load(self, path: str=None):
-    loaded_items = util.load_pytree(path)
+  def wait_until_loaded(self):
+    """ Wait for a lazy load to finish copying the checkpoint to the device.  Raises the
+        exception of the copy if it failed, in which case the flow still holds the memory mapped arrays.
+    """
+    if self._load_thread is not None:
+      self._load_thread.join()
+      self._load_thread = None
+
+    if self._load_error is not None:
+      error, self._load_error = self._load_error, None
+      raise RuntimeError("Failed to copy the lazily loaded checkpoint to the device") from error
+
+  def check_load(self):
+    """ Raise the error of a lazy load that already finished without waiting for one that is running """
+    if self._load_thread is not None and self._load_thread.is_alive() == False:
+      self.wait_until_loaded()
+
+  def load(self, path: str=None, lazy: bool=False):
+    """ Load parameters and state that were saved with save.
+    Args:
+      path: Path of the checkpoint.
+      lazy: If True, return right away with memory mapped arrays so that the flow can be used
+            before the whole checkpoint is read.  The arrays are copied to the device in a
+            background thread and swapped in when they are ready.  Call wait_until_loaded
+            to wait for them.  Otherwise the arrays are on the device when load returns.
+    """
+    # A load that is still running would overwrite this one
+    self.wait_until_loaded()
+    loaded_items = util.load_pytree(path, mmap=True)
+
+    # Make sure that the checkpoint matches the shapes from an abstract init
+    if self.is_abstract:
+      materialize_tree((self.params, self.state), (loaded_items["params"], loaded_items["state"]), device_put=False)
     self.params = loaded_items["params"]
     self.state = loaded_items["state"]
+
+    # Nothing is abstract anymore, so materialize has nothing left to initialize
+    self._init_args = None
+
+    if lazy == False:
+      self.params, self.state = jax.device_put((self.params, self.state))
+      return
+
+    def materialize(params, state):
+      try:
+        device_params, device_state = jax.device_put((params, state))
+        jax.tree_map(lambda x: x.block_until_ready(), (device_params, device_state))
+      except Exception as e:
+        # Raised by the next wait_until_loaded, save or apply
+        self._load_error = e
+        return
+
+      # Don't overwrite parameters that were changed in the meantime
+      if self.params is params:
+        self.params = device_params
+      if self.state is state:
+        self.state = device_state
+
+    self._load_thread = threading.Thread(target=materialize, args=(self.params, self.state), daemon=True)
+    self._load_thread.start()
@@ -0,0 +1,147 @@
+import jax.numpy as jnp
+import jax
+import jaxlib
+import hashlib
+import json
+import time
+import warnings
+from pathlib import Path
+from typing import Optional, Mapping, Any, Union
+
+__all__ = ["flow_fingerprint",
+           "PersistentCompilationCache"]
+
+""" XLA executables are serialized by JAX's compilation cache.  This file decides which
+    directory they go in so that every model/JAX version gets its own cache. """
+
+# JAX can only initialize its compilation cache once per process
+_active_cache_dir = None
+
+# The versions of JAX that this repo targets only write executables for these backends
+PERSISTENT_CACHE_PLATFORMS = ("tpu",)
+
+################################################################################################################
+
+def tree_shape_description(pytree: Any) -> Any:
+  """ Nested dictionaries of "shape:dtype" strings.  Used to fingerprint a model """
+  def describe(x):
+    # Also works with the ShapeDtypeStructs of an abstract init
+    if isinstance(x, jax.ShapeDtypeStruct):
+      return f"{tuple(x.shape)}:{jnp.dtype(x.dtype).name}"
+    return f"{tuple(jnp.shape(x))}:{jnp.result_type(x).name}"
+
+  if isinstance(pytree, Mapping):
+    return {str(k): tree_shape_description(v) for k, v in pytree.items()}
+
+  leaves, treedef = jax.tree_util.tree_flatten(pytree)
+  return {"treedef": str(treedef), "leaves": [describe(x) for x in leaves]}
+
+def flow_fingerprint(params: Any,
+                     state: Any,
+                     inputs: Mapping[str, jnp.ndarray],
+                     config: Optional[Any]=None) -> str:
+  """ Hash the parts of a flow that change its compiled executables.
+  Args:
+    params: The parameters of the flow.  Only the tree structure, shapes and dtypes are used.
+    state : The state of the flow.  Only the tree structure, shapes and dtypes are used.
+    inputs: Example inputs.  Only the shapes and dtypes are used.
+    config: Anything json serializable that describes the model, like the network kwargs.
+  """
+  description = dict(params=tree_shape_description(params),
+                     state=tree_shape_description(state),
+                     inputs=tree_shape_description(inputs),
+                     config=config,
+                     jax=jax.__version__,
+                     jaxlib=jaxlib.__version__)
+  serialized = json.dumps(description, sort_keys=True, default=str)
+  return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:32]
+
+################################################################################################################
+
+class PersistentCompilationCache():
+
+  def __init__(self,
+               cache_dir: Union[str, Path],
+               fingerprint: str,
+               max_cache_size_bytes: Optional[int]=None):
+    """ Store the XLA executables of a flow in cache_dir/fingerprint.  Executables compiled by this
+        process (transform_flow's apply_fn, MaximumLikelihoodTrainer.valgrad, etc.) are written there
+        and are loaded instead of recompiled the next time a process with the same fingerprint starts.
+        Tracing still happens on every start, but that is cheap compared to XLA compilation.
+    Args:
+      cache_dir           : Root directory of the cache.
+      fingerprint         : Output of flow_fingerprint.
+      max_cache_size_bytes: Passed to JAX's compilation cache.  None uses JAX's default.
+    """
+    self.fingerprint = fingerprint
+    self.path        = Path(cache_dir)/fingerprint
+    self.platform    = jax.default_backend()
+    self.persists    = self.platform in PERSISTENT_CACHE_PLATFORMS
+
+    # Activate first because the directory in use can be a different one
+    self.activate(max_cache_size_bytes)
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.manifest = self.update_manifest()
+
+    # Count the executables that are already there before this process adds any.  A directory that
+    # is shared with other fingerprints doesn't say which of its executables are ours.
+    self.owns_directory    = self.path == Path(cache_dir)/fingerprint
+    self.n_initial_entries = len(self.cache_entries())
+
+  @property
+  def manifest_path(self):
+    # Keyed on the fingerprint because a process that already initialized JAX's cache
+    # stores every flow's executables in the same directory
+    return self.path/"manifests"/f"{self.fingerprint}.json"
+
+  def cache_entries(self):
+    """ The serialized executables in the cache directory """
+    return [path for path in self.path.iterdir() if path.is_file()]
+
+  @property
+  def is_warm(self):
+    """ Whether a previous process with this fingerprint already wrote executables here that
+        this backend will read
+    """
+    return self.persists and self.owns_directory and self.n_initial_entries > 0
+
+  def activate(self, max_cache_size_bytes):
+    global _active_cache_dir
+    from jax.experimental.compilation_cache import compilation_cache
+
+    if self.persists == False:
+      warnings.warn(f"JAX's compilation cache doesn't store executables for the {self.platform} backend.  Every process will compile again.")
+
+    if _active_cache_dir is None:
+      cache_kwargs = {}
+      if max_cache_size_bytes is not None:
+        cache_kwargs["max_cache_size_bytes"] = max_cache_size_bytes
+      compilation_cache.initialize_cache(str(self.path), **cache_kwargs)
+      _active_cache_dir = self.path
+    elif _active_cache_dir != self.path:
+      # JAX can't switch directories.  Executables are keyed on their HLO too, so sharing a
+      # directory is still correct, it just isn't the one a new process with this fingerprint reads.
+      warnings.warn(f"The compilation cache is already using {_active_cache_dir}.  Will store executables for {self.fingerprint} there.")
+      self.path = _active_cache_dir
+
+  def update_manifest(self):
+    if self.manifest_path.exists():
+      with open(self.manifest_path, "r") as file:
+        manifest = json.load(file)
+    else:
+      manifest = dict(fingerprint=self.fingerprint,
+                      jax=jax.__version__,
+                      jaxlib=jaxlib.__version__,
+                      created=time.time(),
+                      n_starts=0)
+
+    manifest["n_starts"] += 1
+    manifest["last_start"] = time.time()
+
+    # Write to a temporary file first so that concurrent workers never see a partial manifest
+    self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = self.manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+      json.dump(manifest, file, indent=2)
+    tmp_path.replace(self.manifest_path)
+    return manifest
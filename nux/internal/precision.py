@@ -0,0 +1,78 @@
+from functools import partial
+import jax.numpy as jnp
+import jax
+import haiku._src.base as hk_base
+from typing import Optional, Mapping, Callable, Any, NamedTuple
+from nux.internal.functional import make_pure_functions
+
+__all__ = ["PrecisionPolicy",
+           "set_precision_policy",
+           "get_precision_policy",
+           "MixedPrecisionNetwork"]
+
+################################################################################################################
+
+class PrecisionPolicy(NamedTuple):
+  """ compute_dtype is used inside of the conditioner networks and output_dtype is what the
+      networks return.  None means the dtype of the network's input, so the default policy
+      changes nothing.  Everything else (the bijective math, log_det and log_pz) uses the input dtype.
+  """
+  compute_dtype: Any = None
+  output_dtype: Any = None
+
+_policy = PrecisionPolicy()
+
+def set_precision_policy(compute_dtype: Any=None, output_dtype: Any=None):
+  """ Set the dtype that the conditioner networks run in.  For example, use
+      set_precision_policy(jnp.bfloat16, jnp.float32) to run them in bfloat16 and return float32.
+      Call before building the flow.  set_precision_policy() goes back to the input dtype.
+  """
+  global _policy
+  _policy = PrecisionPolicy(compute_dtype=compute_dtype, output_dtype=output_dtype)
+
+def get_precision_policy() -> PrecisionPolicy:
+  return _policy
+
+def cast_floating(pytree: Any, dtype: Any) -> Any:
+  def cast(x):
+    if jnp.issubdtype(jnp.result_type(x), jnp.floating):
+      return jnp.asarray(x).astype(dtype)
+    return x
+  return jax.tree_map(cast, pytree)
+
+################################################################################################################
+
+class MixedPrecisionNetwork():
+
+  def __init__(self, network: Callable, policy: Optional[PrecisionPolicy]=None):
+    """ Run a conditioner network with the compute dtype of a precision policy.  The parameters are
+        created and stored in full precision and are only cast when the network is applied, so the
+        gradients and optimizer updates stay in full precision.
+    Args:
+      network: The network.  Called as network(x, rng, **kwargs).
+      policy : The precision policy.  Uses the global policy if None.
+    """
+    self.network = network
+    self.policy  = policy if policy is not None else get_precision_policy()
+
+  def __call__(self, x, rng, **kwargs):
+    input_dtype = jnp.result_type(x)
+    compute_dtype = jnp.dtype(self.policy.compute_dtype) if self.policy.compute_dtype is not None else input_dtype
+    output_dtype = jnp.dtype(self.policy.output_dtype) if self.policy.output_dtype is not None else input_dtype
+    if compute_dtype == input_dtype:
+      out = self.network(x, rng, **kwargs)
+      return out if output_dtype == input_dtype else cast_floating(out, output_dtype)
+
+    # Create the parameters in full precision
+    if hk_base.params_frozen() == False:
+      return cast_floating(self.network(x, rng, **kwargs), output_dtype)
+
+    with make_pure_functions([partial(self.network, **kwargs)]) as ([apply_fun], params, state, _, frame_rng, finalize):
+      low_precision_params = cast_floating(params, compute_dtype)
+      out, updated_state, frame_rng = apply_fun(low_precision_params, state, frame_rng, cast_floating(x, compute_dtype), rng)
+
+      # Keep the state (like batch norm statistics) in its original dtype
+      updated_state = jax.tree_multimap(lambda new, old: new.astype(old.dtype), updated_state, state)
+      finalize(params, updated_state, frame_rng)
+
+    return cast_floating(out, output_dtype)
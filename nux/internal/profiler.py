@@ -0,0 +1,234 @@
+from functools import partial
+import jax.numpy as jnp
+import jax
+import numpy as np
+import contextlib
+import json
+import time
+from pathlib import Path
+from typing import Optional, Mapping, Callable, Any, Sequence, Union
+from nux.internal.functional import make_pure_functions
+from nux.internal.base import get_module_prefixes
+from nux.util import block, tree_bytes
+import haiku._src.base as hk_base
+
+__all__ = ["LayerProfiler",
+           "profile_flow",
+           "xla_cost_analysis"]
+
+""" Per-layer profiling.  While a LayerProfiler is active, every Layer.__call__ that runs on concrete
+    arrays is timed in place (which includes its children) and then compiled by itself to measure
+    its steady state run time and XLA's cost analysis.  Layers that run inside of a jit, scan,
+    checkpoint or custom_vjp only see tracers, so they are covered by the layer that contains them. """
+
+################################################################################################################
+
+def named_scope(name: str):
+  """ jax.named_scope on versions of JAX that have it """
+  if hasattr(jax, "named_scope"):
+    return jax.named_scope(name)
+  return contextlib.nullcontext()
+
+def xla_cost_analysis(fun: Callable, *args) -> Mapping[str, float]:
+  """ FLOPs and bytes accessed that XLA estimates for fun(*args).  NaN if the backend can't tell. """
+  try:
+    if hasattr(jax.jit(fun), "lower"):
+      cost = jax.jit(fun).lower(*args).compile().cost_analysis()
+    else:
+      from jax.lib import xla_bridge, xla_client
+      computation = jax.xla_computation(fun)(*args)
+      cost = xla_client._xla.hlo_module_cost_analysis(xla_bridge.get_backend(), computation.as_hlo_module())
+    if isinstance(cost, (list, tuple)):
+      cost = cost[0]
+    return {"flops": float(cost.get("flops", np.nan)),
+            "bytes_accessed": float(cost.get("bytes accessed", np.nan))}
+  except Exception:
+    return {"flops": np.nan, "bytes_accessed": np.nan}
+
+################################################################################################################
+
+class LayerProfiler():
+
+  # The profiler that Layer.__call__ reports to
+  active = None
+
+  def __init__(self, n_runs: int=10, cost_analysis: bool=True):
+    """ Collect a row for every layer call while active:
+
+          with LayerProfiler() as profiler:
+            flow._flow.apply(flow.params, flow.state, key, inputs)
+          print(profiler.report())
+
+        The flow must be applied without jit so that the layers see concrete arrays.
+    Args:
+      n_runs       : Number of runs to average the compiled time of each layer over.
+      cost_analysis: Whether to ask XLA for the FLOPs and bytes of each layer.
+    """
+    self.n_runs        = n_runs
+    self.cost_analysis = cost_analysis
+    self.records       = []
+    self.stack         = []
+    self.paused        = False
+    self.start_time    = time.perf_counter()
+
+  def __enter__(self):
+    assert LayerProfiler.active is None, "Can't nest profilers"
+    LayerProfiler.active = self
+    return self
+
+  def __exit__(self, *args):
+    LayerProfiler.active = None
+
+  def should_profile(self, layer: Callable, inputs: Mapping[str, jnp.ndarray]) -> bool:
+    if self.paused or any([layer is l for l in self.stack]) or hk_base.params_frozen() == False:
+      return False
+    return not any([isinstance(x, jax.core.Tracer) for x in jax.tree_leaves(inputs)])
+
+  def count_params(self, layer: Callable) -> int:
+    # Child layers aren't nested under the name of their parent
+    prefixes = get_module_prefixes(layer)
+    params = hk_base.current_frame().params
+    n_params = 0
+    for module_name, module_params in params.items():
+      if any([module_name == p or module_name.startswith(p + "/") for p in prefixes]):
+        n_params += sum([x.size for x in jax.tree_leaves(module_params)])
+    return int(n_params)
+
+  def profile_call(self,
+                   layer: Callable,
+                   inputs: Mapping[str, jnp.ndarray],
+                   rng: jnp.ndarray=None,
+                   sample: Optional[bool]=False,
+                   **kwargs
+  ) -> Mapping[str, jnp.ndarray]:
+    """ Called by Layer.__call__ instead of running the layer """
+    path = "/".join([l.module_name for l in self.stack] + [layer.module_name])
+    depth = len(self.stack)
+
+    # Run the layer in place.  Its children are profiled by this call.
+    self.stack.append(layer)
+    start = time.perf_counter()
+    try:
+      with named_scope(path):
+        outputs = layer(inputs, rng, sample=sample, **kwargs)
+      block(outputs)
+    finally:
+      self.stack.pop()
+    end = time.perf_counter()
+
+    record = {"path": path,
+              "kind": type(layer).__name__,
+              "depth": depth,
+              "sample": bool(sample),
+              "start": start - self.start_time,
+              "eager_time": end - start,
+              "n_params": self.count_params(layer),
+              "output_bytes": tree_bytes(outputs)}
+    record.update(self.measure(layer, path, inputs, rng, sample=sample, **kwargs))
+    self.records.append(record)
+    return outputs
+
+  def measure(self, layer, path, inputs, rng, sample=False, **kwargs):
+    """ Compile the layer by itself and time it """
+    self.paused = True
+    try:
+      with make_pure_functions([partial(layer, sample=sample, **kwargs)]) as ([apply_fun], params, state, _, frame_rng, finalize):
+
+        def fun(params, state, inputs, rng):
+          with named_scope(path):
+            outputs, state, _ = apply_fun(params, state, frame_rng, inputs, rng)
+          return outputs, state
+
+        jitted = jax.jit(fun)
+        block(jitted(params, state, inputs, rng))
+
+        start = time.perf_counter()
+        for _ in range(self.n_runs):
+          block(jitted(params, state, inputs, rng))
+        measurements = {"time": (time.perf_counter() - start)/self.n_runs}
+
+        if self.cost_analysis:
+          measurements.update(xla_cost_analysis(fun, params, state, inputs, rng))
+
+        # Profiling shouldn't change the state
+        finalize(params, state, frame_rng)
+    finally:
+      self.paused = False
+    return measurements
+
+  #############################################################################
+
+  def table(self) -> Sequence[Mapping[str, Any]]:
+    """ One row per layer call, in call order, with the forward and inverse measurements side by side """
+    rows, seen = {}, {}
+    for record in sorted(self.records, key=lambda r: r["start"]):
+      # Layers can be called more than once in a pass
+      occurrence_key = (record["path"], record["sample"])
+      seen[occurrence_key] = seen.get(occurrence_key, -1) + 1
+      key = (record["path"], seen[occurrence_key])
+
+      row = rows.setdefault(key, {"path": record["path"],
+                                  "kind": record["kind"],
+                                  "depth": record["depth"],
+                                  "n_params": record["n_params"]})
+      prefix = "inv" if record["sample"] else "fwd"
+      for name in ["time", "flops", "bytes_accessed", "output_bytes"]:
+        row[f"{prefix}_{name}"] = record.get(name, np.nan)
+    return list(rows.values())
+
+  def report(self) -> str:
+    columns = [("fwd_time", "fwd ms", 1000), ("inv_time", "inv ms", 1000),
+               ("fwd_flops", "fwd MFLOP", 1e-6), ("inv_flops", "inv MFLOP", 1e-6),
+               ("fwd_bytes_accessed", "fwd MB acc", 1e-6), ("inv_bytes_accessed", "inv MB acc", 1e-6),
+               ("n_params", "params", 1), ("fwd_output_bytes", "out MB", 1e-6)]
+    rows = self.table()
+    names = ["  "*row["depth"] + f"{row['path'].split('/')[-1]} ({row['kind']})" for row in rows]
+    width = max([len(name) for name in names] + [5])
+
+    lines = [f"{'layer':<{width}}" + "".join([f"{title:>12}" for _, title, _ in columns])]
+    for name, row in zip(names, rows):
+      values = [row.get(key, np.nan)*scale for key, _, scale in columns]
+      lines.append(f"{name:<{width}}" + "".join([f"{value:>12.3f}" if isinstance(value, float) else f"{value:>12}" for value in values]))
+    return "\n".join(lines)
+
+  def to_json(self, path: Union[str, Path]):
+    with open(path, "w") as file:
+      json.dump({"records": self.records, "table": self.table()}, file, indent=2, default=float)
+
+  def to_chrome_trace(self, path: Union[str, Path]):
+    """ Write the in-place timings as a trace that can be opened in chrome://tracing or Perfetto.
+        Forward calls go on thread 0 and inverse calls on thread 1.
+    """
+    events = []
+    for record in self.records:
+      args = {name: record.get(name) for name in ["kind", "time", "flops", "bytes_accessed", "n_params", "output_bytes"]}
+      events.append({"name": record["path"],
+                     "cat": "inverse" if record["sample"] else "forward",
+                     "ph": "X",
+                     "ts": record["start"]*1e6,
+                     "dur": record["eager_time"]*1e6,
+                     "pid": 0,
+                     "tid": int(record["sample"]),
+                     "args": args})
+    with open(path, "w") as file:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, default=float)
+
+################################################################################################################
+
+def profile_flow(flow: Any,
+                 key: jnp.ndarray,
+                 inputs: Mapping[str, jnp.ndarray],
+                 n_runs: int=10,
+                 cost_analysis: bool=True,
+                 **kwargs) -> LayerProfiler:
+  """ Profile every layer of a Flow with sample=False on inputs and then with sample=True
+      on the latents that came out.
+  """
+  with LayerProfiler(n_runs=n_runs, cost_analysis=cost_analysis) as profiler:
+    outputs, _ = flow._flow.apply(flow.params, flow.state, key, inputs, **kwargs)
+
+    inverse_inputs = dict(inputs)
+    inverse_inputs.update(outputs)
+    flow._flow.apply(flow.params, flow.state, key, inverse_inputs, sample=True, reconstruction=True, **kwargs)
+
+  return profiler
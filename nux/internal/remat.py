@@ -0,0 +1,124 @@
+from functools import partial
+import jax.numpy as jnp
+import jax
+import numpy as np
+import haiku._src.base as hk_base
+from typing import Optional, Mapping, Callable, Sequence, Any, Union, Type
+from nux.internal.functional import make_pure_functions
+
+__all__ = ["remat_selects",
+           "remat_call",
+           "jaxpr_peak_bytes",
+           "peak_memory_bytes"]
+
+""" Gradient checkpointing for layers that don't have a cheap inverse (like ResidualFlow or MAF)
+    so that invertible_ad can't be used.  A checkpointed layer only saves its inputs and
+    recomputes its intermediate activations during the backward pass. """
+
+RematPolicy = Optional[Union[bool, int, Sequence[Type], Callable]]
+
+################################################################################################################
+
+def remat_selects(policy: RematPolicy, index: int, layer: Callable) -> bool:
+  """ Whether the policy says to checkpoint a layer.
+  Args:
+    policy: None or False to not checkpoint anything, True to checkpoint every layer, k to checkpoint
+            every k-th layer, a sequence of layer classes to checkpoint the layers of those types,
+            or a function (index, layer) -> bool.
+    index : The position of the layer in its container.
+    layer : The layer.
+  """
+  if policy is None or policy is False:
+    return False
+  if policy is True:
+    return True
+  if isinstance(policy, int):
+    assert policy > 0, "Checkpoint every k-th layer needs k > 0"
+    return index%policy == 0
+  if isinstance(policy, (tuple, list)):
+    return isinstance(layer, tuple(policy))
+  if isinstance(policy, type):
+    return isinstance(layer, policy)
+  if callable(policy):
+    return policy(index, layer)
+  assert 0, f"Invalid remat policy {policy}"
+
+def remat_call(layer: Callable,
+               inputs: Mapping[str, jnp.ndarray],
+               rng: jnp.ndarray=None,
+               **kwargs
+) -> Mapping[str, jnp.ndarray]:
+  """ Call layer under jax.checkpoint """
+
+  # Initialization creates the parameters, so can't be made functional
+  if hk_base.params_frozen() == False:
+    return layer(inputs, rng, **kwargs)
+
+  with make_pure_functions([partial(layer, **kwargs)]) as ([apply_fun], params, state, _, frame_rng, finalize):
+    outputs, state, frame_rng = jax.checkpoint(apply_fun)(params, state, frame_rng, inputs, rng)
+    finalize(params, state, frame_rng)
+
+  return outputs
+
+################################################################################################################
+
+def var_bytes(var) -> int:
+  aval = var.aval
+  if not hasattr(aval, "shape"):
+    return 0
+  return int(np.prod(aval.shape))*np.dtype(aval.dtype).itemsize
+
+def sub_jaxprs(eqn):
+  # Jaxprs of call primitives, control flow and checkpoints
+  for value in eqn.params.values():
+    values = value if isinstance(value, (tuple, list)) else (value,)
+    for v in values:
+      if isinstance(v, jax.core.Jaxpr):
+        yield v
+      elif hasattr(v, "jaxpr") and isinstance(v.jaxpr, jax.core.Jaxpr):
+        yield v.jaxpr
+
+def jaxpr_peak_bytes(jaxpr: jax.core.Jaxpr) -> int:
+  """ Estimate the peak memory of a jaxpr by keeping track of the size of the values
+      that are live after each equation.  The inputs are live the whole time.  This doesn't
+      know about XLA's fusion or buffer reuse, so it is only useful to compare programs.
+  """
+  is_var = lambda v: isinstance(v, jax.core.Var)
+
+  # Find the last equation that uses each value
+  last_use = {}
+  for i, eqn in enumerate(jaxpr.eqns):
+    for v in filter(is_var, eqn.invars):
+      last_use[v] = i
+  for v in filter(is_var, jaxpr.outvars):
+    last_use[v] = len(jaxpr.eqns)
+
+  live = sum([var_bytes(v) for v in list(jaxpr.invars) + list(jaxpr.constvars)])
+  peak = live
+  inputs = set(jaxpr.invars) | set(jaxpr.constvars)
+
+  for i, eqn in enumerate(jaxpr.eqns):
+
+    # The inner program's inputs are already live
+    inner = 0
+    for sub in sub_jaxprs(eqn):
+      inner = max(inner, jaxpr_peak_bytes(sub) - sum([var_bytes(v) for v in sub.invars]))
+
+    out_bytes = sum([var_bytes(v) for v in eqn.outvars])
+    peak = max(peak, live + inner, live + out_bytes)
+    live += out_bytes
+
+    # Free the values that aren't needed anymore
+    for v in set(filter(is_var, eqn.invars)):
+      if last_use[v] == i and v not in inputs:
+        live -= var_bytes(v)
+    for v in eqn.outvars:
+      if v not in last_use:
+        live -= var_bytes(v)
+
+  return peak
+
+def peak_memory_bytes(fun: Callable, *args, **kwargs) -> int:
+  """ Estimated peak memory of fun(*args, **kwargs) in bytes """
+  closed_jaxpr = jax.make_jaxpr(partial(fun, **kwargs))(*args)
+  return jaxpr_peak_bytes(closed_jaxpr.jaxpr)
@@ -0,0 +1,104 @@
+import ast
+import importlib
+from pathlib import Path
+from typing import Sequence, Mapping, Callable, Tuple
+
+__all__ = ["lazy_exports"]
+
+""" Packages like nux.flows export the public names of their modules, but importing those modules
+    is slow (they import haiku, optax, every network, etc.).  lazy_exports gives a package a
+    module level __getattr__ (PEP 562) so that a module is only imported the first time one
+    of its names is used.  The names are found by reading the modules' source, so nothing is
+    imported to build the table. """
+
+################################################################################################################
+
+def module_source_path(module_name: str) -> Path:
+  # importlib.util.find_spec would import the parent packages
+  parts = module_name.split(".")
+  assert parts[0] == "nux", f"Can only lazily import nux modules, not {module_name}"
+  path = Path(__file__).parent.joinpath(*parts[1:])
+  if path.is_dir():
+    return path/"__init__.py"
+  return path.with_suffix(".py")
+
+def exported_names(module_name: str) -> Sequence[str]:
+  """ The names that "from module_name import *" would give.  Follows the "from x import *"
+      statements and lazy_exports calls of packages.
+  """
+  with open(module_source_path(module_name), "r") as file:
+    tree = ast.parse(file.read())
+
+  names, has_all = [], False
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and any([isinstance(t, ast.Name) and t.id == "__all__" for t in node.targets]):
+      names.extend(ast.literal_eval(node.value))
+      has_all = True
+    elif isinstance(node, ast.ImportFrom) and any([alias.name == "*" for alias in node.names]):
+      names.extend(exported_names(node.module))
+    elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) and getattr(node.value.func, "id", None) == "lazy_exports":
+      for lazy_module in ast.literal_eval(node.value.args[1]):
+        names.extend(exported_names(lazy_module))
+      for keyword in node.value.keywords:
+        if keyword.arg == "names":
+          names.extend(ast.literal_eval(keyword.value).keys())
+      has_all = True
+
+  # Without __all__, import * gives every public name.  Only keep the ones defined in the module.
+  if has_all == False:
+    for node in tree.body:
+      if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name.startswith("_") == False:
+        names.append(node.name)
+  return names
+
+def lazy_exports(package_name: str,
+                 modules: Sequence[str],
+                 submodules: Sequence[str]=(),
+                 names: Mapping[str, str]=None
+) -> Tuple[Callable, Callable]:
+  """ Build the __getattr__ and __dir__ of a package.  __getattr__ also provides __all__, which is
+      every name in the lazy table, so "from package import *" still exports them.  Like a
+      sequence of "from module import *" statements, a name that several modules export comes
+      from the last of them.
+  Args:
+    package_name: __name__ of the package.
+    modules     : Modules whose exported names should be attributes of the package.
+    submodules  : Short names of submodules that should be imported when they are accessed.
+    names       : Single names to export, mapped to the module that defines them.
+                  These come before the names of modules.
+  """
+  name_to_module = None
+
+  def get_name_to_module() -> Mapping[str, str]:
+    nonlocal name_to_module
+    if name_to_module is None:
+      name_to_module = dict(names) if names is not None else {}
+      for module_name in modules:
+        for name in exported_names(module_name):
+          name_to_module[name] = module_name
+    return name_to_module
+
+  def __getattr__(name):
+    if name == "__all__":
+      value = sorted(get_name_to_module().keys())
+      setattr(importlib.import_module(package_name), name, value)
+      return value
+
+    if name in submodules:
+      return importlib.import_module(f"{package_name}.{name}")
+
+    module_name = get_name_to_module().get(name, None)
+    if module_name is None:
+      raise AttributeError(f"module {package_name!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(module_name), name)
+
+    # Cache the value on the package so that __getattr__ isn't called again
+    setattr(importlib.import_module(package_name), name, value)
+    return value
+
+  def __dir__():
+    package = importlib.import_module(package_name)
+    return sorted(set(package.__dict__.keys()) | set(get_name_to_module().keys()) | set(submodules))
+
+  return __getattr__, __dir__
@@ -1 +1,5 @@
-from nux.models.image_architectures import *
+from nux.lazy import lazy_exports
+
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.models.image_architectures"],
+                                    submodules=["image_architectures"])
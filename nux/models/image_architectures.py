@@ -14,11 +14,27 @@ def build_architecture(architecture: Sequence[Callable],
                        actnorm: bool=False,
                        actnorm_axes: Sequence[int]=-1,
                        glow: bool=True,
-                       one_dim: bool=False):
+                       one_dim: bool=False,
+                       scan_blocks: bool=False):
   n_squeeze = 0
 
   layers = []
+  blocks = []
+  block_kind = None
+
+  def flush_blocks():
+    # Consecutive blocks of the same kind are structurally identical, so we can scan over them
+    nonlocal blocks
+    if len(blocks) > 1:
+      layers.append(nux.sequential(*blocks, scan_layers=True))
+    else:
+      layers.extend(blocks)
+    blocks = []
+
   for i, layer in list(enumerate(architecture)):
+    if scan_blocks and layer != block_kind:
+      flush_blocks()
+      block_kind = layer
 
     # We don't want to put anything in front of the squeeze
     if layer == "sq":
@@ -34,24 +50,27 @@ def build_architecture(architecture: Sequence[Callable],
                                       actnorm=actnorm,
                                       actnorm_axes=actnorm_axes,
                                       glow=glow,
-                                      one_dim=one_dim)
+                                      one_dim=one_dim,
+                                      scan_blocks=scan_blocks)
       layers.append(nux.multi_scale(inner_flow))
       break
 
+    block = layers if scan_blocks == False else []
+
     # Actnorm.  Not needed if we're using 1x1 conv because the 1x1
     # conv is initialized with weight normalization so that its outputs
     # have 0 mean and 1 stddev.
     if actnorm:
-      layers.append(nux.ActNorm(axis=actnorm_axes))
+      block.append(nux.ActNorm(axis=actnorm_axes))
 
     # Use a dense connection instead of reverse?
     if glow:
       if one_dim:
-        layers.append(nux.AffineLDU())
+        block.append(nux.AffineLDU())
       else:
-        layers.append(nux.OneByOneConv())
+        block.append(nux.OneByOneConv())
     else:
-      layers.append(nux.Reverse())
+      block.append(nux.Reverse())
 
     # Create the layer
     if layer == "chk":
@@ -60,7 +79,13 @@ def build_architecture(architecture: Sequence[Callable],
       alg = coupling_algorithm(split_kind="channel")
     else:
       assert 0
-    layers.append(alg)
+    block.append(alg)
+
+    if scan_blocks:
+      blocks.append(nux.sequential(*block))
+
+  if scan_blocks:
+    flush_blocks()
 
   # Remember to unsqueeze so that we end up with the same shaped output
   for i in range(n_squeeze):
@@ -76,7 +101,8 @@ def multiscale_architecture(coupling_algorithm,
                             n_scales=1,
                             actnorm=True,
                             actnorm_axes=-1,
-                            glow=True):
+                            glow=True,
+                            scan_blocks=False):
   assert n_scales > 0, "Use n_scales=1 to not have any multiscale factors"
 
   architecture = ["chk"]*n_checkerboard_splits + ["sq"] + ["chnl"]*n_channel_splits
@@ -88,7 +114,8 @@ def multiscale_architecture(coupling_algorithm,
                             actnorm=actnorm,
                             actnorm_axes=actnorm_axes,
                             glow=glow,
-                            one_dim=False)
+                            one_dim=False,
+                            scan_blocks=scan_blocks)
 
 def RealNVP(n_checkerboard_splits=3,
             n_channel_splits=3,
@@ -97,7 +124,8 @@ def RealNVP(n_checkerboard_splits=3,
             apply_transform_to_both_halves=False,
             network_kwargs=None,
             create_network=None,
-            one_dim=False):
+            one_dim=False,
+            scan_blocks=False):
 
   coupling_algorithm = partial(nux.Coupling,
                                kind="affine",
@@ -111,7 +139,8 @@ def RealNVP(n_checkerboard_splits=3,
                                  n_channel_splits=n_channel_splits,
                                  n_scales=n_scales,
                                  actnorm=False,
-                                 glow=False)
+                                 glow=False,
+                                 scan_blocks=scan_blocks)
 
 def GLOW(n_checkerboard_splits=3,
          n_channel_splits=3,
@@ -120,7 +149,8 @@ def GLOW(n_checkerboard_splits=3,
          apply_transform_to_both_halves=False,
          network_kwargs=None,
          create_network=None,
-         one_dim=False):
+         one_dim=False,
+         scan_blocks=False):
 
   coupling_algorithm = partial(nux.Coupling,
                                kind="affine",
@@ -134,7 +164,8 @@ def GLOW(n_checkerboard_splits=3,
                                  n_channel_splits=n_channel_splits,
                                  n_scales=n_scales,
                                  actnorm=True,
-                                 glow=True)
+                                 glow=True,
+                                 scan_blocks=scan_blocks)
 
 ################################################################################################################
 
@@ -146,7 +177,8 @@ def FlowPlusPlus(n_components=32,
                  apply_transform_to_both_halves=False,
                  network_kwargs=None,
                  create_network=None,
-                 one_dim=False):
+                 one_dim=False,
+                 scan_blocks=False):
 
   coupling_algorithm = partial(nux.CouplingLogitsticMixtureLogit,
                                n_components=n_components,
@@ -165,4 +197,5 @@ def FlowPlusPlus(n_components=32,
                             actnorm=True,
                             actnorm_axes=(-3, -2, -1),
                             glow=True,
-                            one_dim=False)
+                            one_dim=False,
+                            scan_blocks=scan_blocks)
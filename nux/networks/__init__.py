@@ -1,5 +1,9 @@
-from nux.networks.cnn import *
-from nux.networks.mlp import *
-from nux.networks.resnet import *
-from nux.networks.se import *
-from nux.networks.made import *
+from nux.lazy import lazy_exports
+
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.networks.cnn",
+                                     "nux.networks.mlp",
+                                     "nux.networks.resnet",
+                                     "nux.networks.se",
+                                     "nux.networks.made"],
+                                    submodules=["cnn", "mlp", "resnet", "se", "made"])
@@ -0,0 +1 @@
+from nux.serving.scoring_server import *
@@ -0,0 +1,204 @@
+import jax.numpy as jnp
+import jax
+from jax import random
+import numpy as np
+import asyncio
+import time
+from typing import Optional, Mapping, Sequence, Any, Union
+from nux.internal.layer import Flow
+from nux.internal.bucketing import ShapeBucketer
+
+__all__ = ["LatencyHistogram",
+           "ScoringServer"]
+
+################################################################################################################
+
+class LatencyHistogram():
+
+  def __init__(self, bucket_edges: Sequence[float]=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)):
+    """ Counts of values that fall between the edges.  The last bucket holds everything above
+        the largest edge.
+    Args:
+      bucket_edges: Upper edges of the buckets.
+    """
+    self.bucket_edges = tuple(bucket_edges)
+    self.counts = [0]*(len(self.bucket_edges) + 1)
+    self.values_sum = 0.0
+    self.n = 0
+
+  def observe(self, value: float):
+    index = int(np.searchsorted(self.bucket_edges, value))
+    self.counts[index] += 1
+    self.values_sum += value
+    self.n += 1
+
+  def quantile(self, q: float) -> float:
+    """ Upper edge of the bucket that contains the q-th quantile """
+    if self.n == 0:
+      return float("nan")
+    cumulative = np.cumsum(self.counts)
+    index = int(np.searchsorted(cumulative, q*self.n))
+    return self.bucket_edges[index] if index < len(self.bucket_edges) else float("inf")
+
+  def summary(self) -> Mapping[str, Any]:
+    labels = [f"<={edge}" for edge in self.bucket_edges] + [f">{self.bucket_edges[-1]}"]
+    return {"count": self.n,
+            "mean": self.values_sum/self.n if self.n > 0 else float("nan"),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(labels, self.counts))}
+
+################################################################################################################
+
+class ScoringServer():
+
+  def __init__(self,
+               flow: Flow,
+               key: jnp.ndarray,
+               max_batch_size: int=64,
+               max_latency_ms: float=5.0,
+               bucket_sizes: Optional[Sequence[int]]=None,
+               **apply_kwargs):
+    """ Scores single examples with log_px by coalescing concurrent requests into batches.
+        A batch is run once it has max_batch_size requests or once its oldest request has
+        waited max_latency_ms.  Batches are padded up to a bucket size so that every batch
+        reuses one of a few compiled executables.  Everything runs in the current event loop,
+        so it can be used and tested in-process:
+
+          async with ScoringServer(flow, key) as server:
+            log_pxs = await asyncio.gather(*[server.score(x) for x in xs])
+
+    Args:
+      flow          : The flow to score with.
+      key           : JAX random key.  Each batch gets its own key.
+      max_batch_size: Largest number of requests in a batch.
+      max_latency_ms: Longest time that a request waits for its batch to fill up.
+      bucket_sizes  : Batch sizes to pad to.  Defaults to powers of 2 up to max_batch_size.
+      apply_kwargs  : Passed to the flow's apply.
+    """
+    self.flow           = flow
+    self.key            = key
+    self.max_batch_size = max_batch_size
+    self.max_latency    = max_latency_ms/1000
+    self.apply_kwargs   = apply_kwargs
+
+    if bucket_sizes is None:
+      bucket_sizes = [2**i for i in range(int(np.ceil(np.log2(max_batch_size))) + 1)]
+      bucket_sizes = [min(size, max_batch_size) for size in bucket_sizes]
+    self.bucketer = ShapeBucketer(bucket_sizes)
+
+    self.queue = None
+    self.batcher_task = None
+    self.n_batches = 0
+
+    # Requests that the batcher has taken off of the queue but not answered yet
+    self.requests = []
+
+    self.latency_ms = LatencyHistogram()
+    self.queue_depth = LatencyHistogram(bucket_edges=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+    self.batch_sizes = LatencyHistogram(bucket_edges=tuple(sorted(set(bucket_sizes))))
+
+  async def __aenter__(self):
+    await self.start()
+    return self
+
+  async def __aexit__(self, *args):
+    await self.stop()
+
+  async def start(self):
+    self.queue = asyncio.Queue()
+    self.batcher_task = asyncio.ensure_future(self.batcher())
+
+  async def stop(self):
+    """ Stop the batcher.  Requests that haven't been scored yet, including the ones in a
+        partially filled batch, fail with a RuntimeError.
+    """
+    if self.batcher_task is not None:
+      self.batcher_task.cancel()
+      try:
+        await self.batcher_task
+      except asyncio.CancelledError:
+        pass
+      self.batcher_task = None
+
+    pending, self.requests = self.requests, []
+    while self.queue is not None and self.queue.empty() == False:
+      pending.append(self.queue.get_nowait())
+
+    for _, future, _ in pending:
+      if not future.done():
+        future.set_exception(RuntimeError("ScoringServer stopped before the request was scored"))
+
+  async def score(self, inputs: Union[Mapping[str, Any], Any]) -> float:
+    """ log_px of a single unbatched example.  inputs is x or a dictionary of unbatched inputs. """
+    assert self.batcher_task is not None, "Call start first"
+    if not isinstance(inputs, Mapping):
+      inputs = {"x": inputs}
+    future = asyncio.get_event_loop().create_future()
+    await self.queue.put((inputs, future, time.perf_counter()))
+    return await future
+
+  def run_batch(self, batch_inputs: Sequence[Mapping[str, Any]]) -> np.ndarray:
+    """ Stack, pad and score a batch.  Runs in a worker thread so that the event loop can keep
+        accepting requests.
+    """
+    inputs = {name: np.stack([np.asarray(x[name]) for x in batch_inputs], axis=0) for name in batch_inputs[0].keys()}
+    padded_inputs, _ = self.bucketer.pad(inputs, n_batch_dims=1)
+
+    # stateful_apply leaves flow.state alone, so scoring doesn't race with other users of the flow
+    key = random.fold_in(self.key, self.n_batches)
+    outputs, _ = self.flow.stateful_apply(key, padded_inputs, self.flow.state, **self.apply_kwargs)
+    return np.asarray(outputs["log_px"])[:len(batch_inputs)]
+
+  async def batcher(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      # Wait for the first request of the batch.  self.requests is the same list, so stop
+      # can fail the requests in a partially filled batch.
+      self.requests = requests = [await self.queue.get()]
+      deadline = requests[0][2] + self.max_latency
+
+      # Fill the batch until it is full or the oldest request has waited long enough
+      while len(requests) < self.max_batch_size:
+        # Requests that are already waiting never delay the batch
+        if self.queue.empty() == False:
+          requests.append(self.queue.get_nowait())
+          continue
+
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+          break
+        try:
+          requests.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+          break
+
+      self.queue_depth.observe(self.queue.qsize())
+      self.batch_sizes.observe(len(requests))
+
+      try:
+        log_px = await loop.run_in_executor(None, self.run_batch, [inputs for inputs, _, _ in requests])
+      except Exception as e:
+        for _, future, _ in requests:
+          if not future.done():
+            future.set_exception(e)
+        self.requests = []
+        continue
+      finally:
+        self.n_batches += 1
+
+      # Send the results back to the callers
+      now = time.perf_counter()
+      for (_, future, start_time), value in zip(requests, log_px):
+        self.latency_ms.observe((now - start_time)*1000)
+        if not future.done():
+          future.set_result(float(value))
+      self.requests = []
+
+  def stats(self) -> Mapping[str, Any]:
+    return {"n_batches": self.n_batches,
+            "queue_size": self.queue.qsize() if self.queue is not None else 0,
+            "latency_ms": self.latency_ms.summary(),
+            "queue_depth": self.queue_depth.summary(),
+            "batch_size": self.batch_sizes.summary(),
+            "compiled_batch_shapes": self.bucketer.stats()}
@@ -4,6 +4,8 @@ from jax import random
 from jax.flatten_util import ravel_pytree
 from functools import partial
 import nux.util as util
+from nux.internal.base import get_module_prefixes
+from nux.flows.compose import extract_modules
 
 import nux
 
@@ -74,3 +76,186 @@ def flow_test(create_fun, inputs, rng):
   # reconstruction_test(create_fun, inputs_doubly_batched, rng, batch_axes=(0, 1)) # This causes problems with data dependent init!  Find a work-around in the future.
 
   log_det_test(create_fun, inputs, rng)
+
+def invertible_ad_test(create_fun, inputs, rng):
+  """
+  Check that backpropagating by reconstructing the inputs of each layer gives the same gradients as regular autodiff.
+  """
+  flow = nux.transform_flow(lambda: nux.sequential(create_fun()))
+  invertible_flow = nux.transform_flow(lambda: nux.sequential(create_fun(), invertible_ad=True))
+  params, state = flow.init(rng, inputs)
+
+  def loss(flow, params, x):
+    flow_inputs = inputs.copy()
+    flow_inputs["x"] = x
+    outputs, _ = flow.apply(params, state, rng, flow_inputs)
+    return jnp.sum(outputs["x"]**2) + jnp.sum(outputs["log_det"])
+
+  grads = jax.grad(partial(loss, flow), argnums=(0, 1))(params, inputs["x"])
+  invertible_grads = jax.grad(partial(loss, invertible_flow), argnums=(0, 1))(params, inputs["x"])
+
+  flat_grads, _ = ravel_pytree(grads)
+  flat_invertible_grads, _ = ravel_pytree(invertible_grads)
+  if jnp.allclose(flat_grads, flat_invertible_grads, atol=1e-04) == False:
+    print("Failed invertible ad test!", jnp.abs(flat_grads - flat_invertible_grads).max())
+    assert 0
+  print("Passed invertible ad tests")
+
+def remat_test(create_fun, inputs, rng, remat=True):
+  """
+  Check that checkpointing the layers of a sequential flow gives the same gradients as storing their activations.
+  """
+  flow = nux.transform_flow(lambda: nux.sequential(*create_fun()))
+  remat_flow = nux.transform_flow(lambda: nux.sequential(*create_fun(), remat=remat))
+  params, state = flow.init(rng, inputs)
+
+  def loss(flow, params, x):
+    flow_inputs = inputs.copy()
+    flow_inputs["x"] = x
+    outputs, _ = flow.apply(params, state, rng, flow_inputs)
+    return jnp.sum(outputs["x"]**2) + jnp.sum(outputs["log_det"])
+
+  grads = jax.grad(partial(loss, flow), argnums=(0, 1))(params, inputs["x"])
+  remat_grads = jax.grad(partial(loss, remat_flow), argnums=(0, 1))(params, inputs["x"])
+
+  flat_grads, _ = ravel_pytree(grads)
+  flat_remat_grads, _ = ravel_pytree(remat_grads)
+  if jnp.allclose(flat_grads, flat_remat_grads, atol=1e-05) == False:
+    print("Failed remat test!", jnp.abs(flat_grads - flat_remat_grads).max())
+    assert 0
+  print("Passed remat tests")
+
+def bisection_compaction_test(create_fun, inputs, rng, compact_fraction=0.5):
+  """
+  Check that compacting the elements that are still running in the bisection inverse doesn't change it.
+  create_fun takes the bisection_compact_fraction.
+  """
+  flow = nux.transform_flow(lambda: create_fun(None))
+  compact_flow = nux.transform_flow(lambda: create_fun(compact_fraction))
+  params, state = flow.init(rng, inputs)
+
+  outputs, _ = flow.apply(params, state, rng, inputs)
+  inverse_inputs = inputs.copy()
+  inverse_inputs["x"] = outputs["x"]
+  reconstr, _ = flow.apply(params, state, rng, inverse_inputs, sample=True, reconstruction=True)
+  compact_reconstr, _ = compact_flow.apply(params, state, rng, inverse_inputs, sample=True, reconstruction=True)
+
+  for name in ["x", "log_det"]:
+    if jnp.allclose(reconstr[name], compact_reconstr[name], atol=1e-05) == False:
+      print(f"Failed bisection compaction test on {name}!", jnp.abs(reconstr[name] - compact_reconstr[name]).max())
+      assert 0
+  print("Passed bisection compaction tests")
+
+def invertible_ad_condition_test(create_fun, inputs, rng):
+  """
+  Same as invertible_ad_test, but also compare the gradient with respect to inputs["condition"],
+  which every layer sees and which also ends up in the outputs.
+  """
+  assert "condition" in inputs
+  flow = nux.transform_flow(lambda: nux.sequential(create_fun(), create_fun()))
+  invertible_flow = nux.transform_flow(lambda: nux.sequential(create_fun(), create_fun(), invertible_ad=True))
+  params, state = flow.init(rng, inputs)
+
+  def loss(flow, params, x, condition):
+    flow_inputs = inputs.copy()
+    flow_inputs["x"] = x
+    flow_inputs["condition"] = condition
+    outputs, _ = flow.apply(params, state, rng, flow_inputs)
+    return jnp.sum(outputs["x"]**2) + jnp.sum(outputs["log_det"]) + jnp.sum(jnp.sin(outputs["condition"]))
+
+  grads = jax.grad(partial(loss, flow), argnums=(0, 1, 2))(params, inputs["x"], inputs["condition"])
+  invertible_grads = jax.grad(partial(loss, invertible_flow), argnums=(0, 1, 2))(params, inputs["x"], inputs["condition"])
+
+  flat_grads, _ = ravel_pytree(grads)
+  flat_invertible_grads, _ = ravel_pytree(invertible_grads)
+  if jnp.allclose(flat_grads, flat_invertible_grads, atol=1e-04) == False:
+    print("Failed invertible ad condition test!", jnp.abs(flat_grads - flat_invertible_grads).max())
+    assert 0
+  print("Passed invertible ad condition tests")
+
+def auto_batch_strategy_test(create_fun, inputs, rng):
+  """
+  Check that the "collapse" and "nested_vmap" auto_batch strategies give the same outputs and
+  state on inputs with several batch axes.
+  """
+  batch_axes = tuple(range(inputs["x"].ndim - 1))
+  assert len(batch_axes) > 1
+  flow = nux.transform_flow(create_fun)
+  params, state = flow.init(rng, inputs, batch_axes=batch_axes)
+
+  default_strategy = nux.Layer.auto_batch_strategy
+  results = []
+  try:
+    for strategy in ["nested_vmap", "collapse"]:
+      nux.Layer.auto_batch_strategy = strategy
+      outputs, updated_state = flow.apply(params, state, rng, inputs)
+      results.append((outputs["x"], outputs["log_det"], updated_state))
+  finally:
+    nux.Layer.auto_batch_strategy = default_strategy
+
+  flat_vmap, _ = ravel_pytree(results[0])
+  flat_collapse, _ = ravel_pytree(results[1])
+  if flat_vmap.shape != flat_collapse.shape or jnp.allclose(flat_vmap, flat_collapse, atol=1e-05) == False:
+    print("Failed auto batch strategy test!")
+    assert 0
+  print("Passed auto batch strategy tests")
+
+def scan_layers_test(create_fun, inputs, rng, n_layers=3):
+  """
+  Check that scanning over the stacked parameters of identical layers gives the same outputs and
+  updated state as unrolling the same layers with the same parameters.
+  """
+  modules = []
+  def create_unrolled():
+    layers = [create_fun() for _ in range(n_layers)]
+    modules.append((nux.sequential(*layers), layers))
+    return modules[-1][0]
+
+  flow = nux.transform_flow(create_unrolled)
+  scan_flow = nux.transform_flow(lambda: nux.sequential(*[create_fun() for _ in range(n_layers)], scan_layers=True))
+  params, state = flow.init(rng, inputs)
+  scan_params, scan_state = scan_flow.init(rng, inputs)
+
+  # Stack the trees of the unrolled layers the same way that stack_layers does
+  chain, layers = modules[-1]
+  layer_prefixes = [get_module_prefixes(layer) for layer in layers]
+  scan_prefixes = [chain.scan_prefix + prefix for prefix in layer_prefixes[0]]
+  def stack(tree):
+    layer_trees = [extract_modules(tree, prefixes, layer_prefixes[0]) for prefixes in layer_prefixes]
+    stacked = jax.tree_multimap(lambda *xs: jnp.stack(xs, axis=0), *layer_trees)
+    return extract_modules(stacked, layer_prefixes[0], scan_prefixes)
+
+  def trees_close(a, b):
+    # Compare module by module so that the mapping types don't matter
+    a = dict([((module, name), value) for module, values in a.items() for name, value in values.items()])
+    b = dict([((module, name), value) for module, values in b.items() for name, value in values.items()])
+    if sorted(a.keys()) != sorted(b.keys()):
+      return False
+    return all([a[key].shape == b[key].shape and jnp.allclose(a[key], b[key], atol=1e-05) for key in a.keys()])
+
+  assert trees_close(stack(params), scan_params), "The stacked parameters don't match the unrolled ones"
+
+  flow_inputs = inputs
+  for sample in [False, True]:
+    outputs, updated_state = flow.apply(params, state, rng, flow_inputs, sample=sample)
+    scan_outputs, scan_updated_state = scan_flow.apply(scan_params, scan_state, rng, flow_inputs, sample=sample)
+    pick = lambda outputs: {"outputs": {"x": outputs["x"], "log_det": outputs["log_det"]}}
+    if trees_close(pick(outputs), pick(scan_outputs)) == False or \
+       trees_close(stack(updated_state), scan_updated_state) == False:
+      print(f"Failed scan layers test with sample={sample}!")
+      assert 0
+
+    # Invert the outputs of the forward pass
+    flow_inputs = inputs.copy()
+    flow_inputs["x"] = outputs["x"]
+  print("Passed scan layers tests")
+
+if __name__ == "__main__":
+  rng = random.PRNGKey(0)
+  x = random.normal(rng, (3, 8, 4))
+  auto_batch_strategy_test(lambda: nux.sequential(nux.Coupling(), nux.Reverse(), nux.Coupling()), {"x": x}, rng)
+  scan_layers_test(lambda: nux.sequential(nux.Coupling(), nux.Reverse()), {"x": x[0]}, rng)
+  invertible_ad_test(lambda: nux.sequential(nux.Coupling(), nux.Reverse(), nux.Coupling()), {"x": x[0]}, rng)
+  remat_test(lambda: (nux.Coupling(), nux.Reverse(), nux.Coupling()), {"x": x[0]}, rng, remat=2)
+  bisection_compaction_test(lambda fraction: nux.LogitsticMixtureLogit(n_components=8, bisection_compact_fraction=fraction), {"x": x[0]}, rng)
+  invertible_ad_condition_test(lambda: nux.Coupling(use_condition=True), {"x": x[0], "condition": x[1]}, rng)
@@ -0,0 +1,43 @@
+import jax
+import jax.numpy as jnp
+from jax import random
+from jax.flatten_util import ravel_pytree
+import nux
+
+def flow_norm_init_batches_test(create_fun, batches, rng):
+  """
+  Initialize a flow whose layers use flow_norm_init on several real batches.  Every batch must
+  take part, so the result has to differ from initializing on the first batch alone.  The flow
+  is then applied to a single regular batch.
+  """
+  assert len(batches) > 1
+
+  def create_flow_norm_fun():
+    layer = create_fun()
+    layer.use_flow_norm_init = True
+    return layer
+
+  options = nux.get_flow_norm_init_options()
+  nux.set_flow_norm_init_options(n_steps=20, patience=20)
+  try:
+    flow = nux.Flow(create_flow_norm_fun, rng, batches[0], batch_axes=(0,), init_batches=batches)
+    first_only = nux.Flow(create_flow_norm_fun, rng, batches[0], batch_axes=(0,), init_batches=batches[:1])
+  finally:
+    nux.set_flow_norm_init_options(**options._asdict())
+
+  assert flow.data_shape == first_only.data_shape == batches[0]["x"].shape[1:]
+  flat_params, _ = ravel_pytree(flow.params)
+  flat_first_only, _ = ravel_pytree(first_only.params)
+  assert jnp.all(jnp.isfinite(flat_params))
+  if jnp.allclose(flat_params, flat_first_only):
+    print("Failed flow norm init batches test!  Only the first batch was used.")
+    assert 0
+
+  outputs = flow.apply(rng, batches[1], is_training=False)
+  assert outputs["x"].shape == batches[1]["x"].shape
+  print("Passed flow norm init batches tests")
+
+if __name__ == "__main__":
+  keys = random.split(random.PRNGKey(0), 4)
+  batches = [{"x": random.normal(key, (16, 4))*(i + 1)} for i, key in enumerate(keys)]
+  flow_norm_init_batches_test(lambda: nux.Coupling(), batches, random.PRNGKey(1))
@@ -0,0 +1,19 @@
+import nux
+
+""" Flows that more than one test module uses """
+
+def batch_norm_network_kwargs():
+  # A small resnet whose batch norm gives the flow state that is updated during training
+  return dict(n_blocks=1,
+              hidden_channel=8,
+              nonlinearity="relu",
+              normalization="batch_norm",
+              parameter_norm="weight_norm",
+              block_type="reverse_bottleneck",
+              squeeze_excite=False,
+              zero_init=False,
+              dropout_rate=None)
+
+def create_batch_norm_flow():
+  """ A flow with state for image inputs (H, W, C) """
+  return nux.sequential(nux.ActNorm(), nux.Coupling(network_kwargs=batch_norm_network_kwargs()))
@@ -0,0 +1,188 @@
+import jax
+import jax.numpy as jnp
+from jax import random
+import numpy as np
+import tempfile
+from pathlib import Path
+import jax.flatten_util
+import haiku as hk
+from nux.internal.compile_cache import CompiledFunctionCache
+from nux.internal.bucketing import ShapeBucketer
+from nux.tests.helpers import create_batch_norm_flow
+import nux
+
+def compiled_function_cache_test():
+  """
+  Check that calls with the same shapes and static kwargs reuse an executable and that the least
+  recently used executable is evicted first.
+  """
+  cache = CompiledFunctionCache(lambda x, scale=1.0: x*scale, max_size=2, name="compiled_function_cache_test")
+
+  cache(jnp.ones(3))
+  cache(jnp.zeros(3))
+  assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}, cache.stats()
+
+  # A new shape and a new static kwarg each compile
+  cache(jnp.ones(4))
+  out = cache(jnp.ones(3), scale=2.0)
+  assert jnp.allclose(out, 2.0)
+  assert cache.stats() == {"size": 2, "hits": 1, "misses": 3, "evictions": 1}, cache.stats()
+
+  # (3,) without kwargs was the least recently used, so it has to compile again
+  cache(jnp.ones(3))
+  assert cache.misses == 4 and cache.evictions == 2 and len(cache) == 2, cache.stats()
+
+  # (3,) with scale=2.0 was used more recently than (4,), so it is still there
+  cache(jnp.ones(3), scale=2.0)
+  assert cache.hits == 2, cache.stats()
+
+  # The compile tracker has the traces, compiles and hits on one row
+  stats = nux.util.get_compile_tracker().stats()["compiled_function_cache_test"]
+  assert (stats["traces"], stats["compiles"], stats["hits"]) == (cache.misses, cache.misses, cache.hits), stats
+  print("Passed compiled function cache tests")
+
+def shape_bucketer_test():
+  """
+  Check that only the innermost batch axis is padded, that the padding copies the last real row
+  and that unpad recovers the original values.
+  """
+  bucketer = ShapeBucketer([4, 8])
+  x = random.normal(random.PRNGKey(0), (3, 5, 2))
+  inputs = {"x": x, "condition": jnp.ones(7)}
+
+  padded, mask = bucketer.pad(inputs, n_batch_dims=2)
+  assert padded["x"].shape == (3, 8, 2), padded["x"].shape
+  assert padded["condition"].shape == (7,)
+  assert mask.shape == (3, 8) and int(mask.sum()) == 15
+  assert jnp.allclose(padded["x"][:, 5:], x[:, -1:])
+
+  recovered = bucketer.unpad(padded, (3, 5))
+  assert jnp.allclose(recovered["x"], x)
+
+  # Sizes past the largest bucket round up to a multiple of it
+  assert bucketer.bucket_size(9) == 16
+  assert bucketer.padded_batch_shape(()) == ()
+
+  # Batches of 5 and 6 share a bucket
+  bucketer.pad({"x": jnp.ones((3, 6, 2))}, n_batch_dims=2)
+  assert bucketer.compiles_saved == 1, bucketer.stats()
+  print("Passed shape bucketer tests")
+
+def bucketed_apply_test(create_fun, inputs, rng):
+  """
+  A flow with bucket_sizes must give the same outputs and state as one without them.  Only
+  calls with is_training=False are padded.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  bucketed = nux.Flow(create_fun, rng, inputs, batch_axes=(0,), bucket_sizes=[inputs["x"].shape[0] + 3])
+
+  for is_training in [False, True]:
+    n_padded = len(bucketed.bucketer.padded_batch_shapes)
+    outputs, state = flow.stateful_apply(rng, inputs, flow.state, is_training=is_training)
+    bucketed_outputs, bucketed_state = bucketed.stateful_apply(rng, inputs, bucketed.state, is_training=is_training)
+    assert len(bucketed.bucketer.padded_batch_shapes) == n_padded + (0 if is_training else 1)
+
+    for name in ["x", "log_px"]:
+      assert bucketed_outputs[name].shape == outputs[name].shape
+      assert jnp.allclose(bucketed_outputs[name], outputs[name], atol=1e-5)
+    flat_state, _ = jax.flatten_util.ravel_pytree(state)
+    flat_bucketed_state, _ = jax.flatten_util.ravel_pytree(bucketed_state)
+    if jnp.allclose(flat_state, flat_bucketed_state, atol=1e-5) == False:
+      print(f"Failed bucketed apply test with is_training={is_training}!")
+      assert 0
+  print("Passed bucketed apply tests")
+
+def abstract_init_test(create_fun, inputs, rng):
+  """
+  An abstract flow must have the same parameter and state shapes as a regular one, and materialize
+  must only accept complete trees.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  abstract_flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,), abstract_init=True)
+  assert abstract_flow.is_abstract and flow.is_abstract == False
+
+  shapes = lambda tree: jax.tree_map(lambda x: (tuple(x.shape), jnp.dtype(x.dtype)), tree)
+  assert shapes(abstract_flow.params) == shapes(flow.params)
+  assert shapes(abstract_flow.state) == shapes(flow.state)
+
+  def is_rejected(**kwargs):
+    try:
+      abstract_flow.materialize(**kwargs)
+    except AssertionError:
+      return True
+    return False
+
+  # Missing state, a missing module and a parameter with the wrong shape
+  first_module = list(flow.params.keys())[0]
+  partial_params = hk.data_structures.filter(lambda module, name, value: module != first_module, flow.params)
+  wrong_shape = jax.tree_map(lambda x: jnp.zeros(x.shape + (1,), x.dtype), flow.params)
+  assert is_rejected(params=flow.params)
+  assert is_rejected(params=partial_params, state=flow.state)
+  assert is_rejected(params=wrong_shape, state=flow.state)
+  assert abstract_flow.is_abstract
+
+  abstract_flow.materialize(params=flow.params, state=flow.state)
+  assert abstract_flow.is_abstract == False
+  outputs = flow.apply(rng, inputs, is_training=False)
+  abstract_outputs = abstract_flow.apply(rng, inputs, is_training=False)
+  if jnp.allclose(outputs["log_px"], abstract_outputs["log_px"]) == False:
+    print("Failed abstract init test!")
+    assert 0
+  print("Passed abstract init tests")
+
+def lazy_load_test(create_fun, inputs, rng):
+  """
+  A lazily loaded checkpoint must end up on the device in an abstract flow and give the same outputs.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  loaded_flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,), abstract_init=True)
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = str(Path(directory)/"flow")
+    flow.save(path)
+    loaded_flow.load(path, lazy=True)
+    assert loaded_flow.is_abstract == False
+    loaded_flow.wait_until_loaded()
+
+  assert all([isinstance(x, np.memmap) == False for x in jax.tree_leaves((loaded_flow.params, loaded_flow.state))])
+  outputs = flow.apply(rng, inputs, is_training=False)
+  loaded_outputs = loaded_flow.apply(rng, inputs, is_training=False)
+  if jnp.allclose(outputs["log_px"], loaded_outputs["log_px"]) == False:
+    print("Failed lazy load test!")
+    assert 0
+  print("Passed lazy load tests")
+
+def layer_profiler_test(create_fun, inputs, rng, layer_kinds):
+  """
+  The profiler report must have a row for every layer with both its forward and inverse timings.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  profiler = flow.profile(rng, inputs, n_runs=2, cost_analysis=False)
+
+  rows = profiler.table()
+  kinds = [row["kind"] for row in rows]
+  assert all([kind in kinds for kind in layer_kinds]), kinds
+  for row in rows:
+    if np.isfinite(row.get("fwd_time", np.nan)) == False or np.isfinite(row.get("inv_time", np.nan)) == False:
+      print(f"Failed layer profiler test!  {row['path']} is missing a direction.")
+      assert 0
+
+  report = profiler.report().split("\n")
+  assert len(report) == len(rows) + 1
+  assert all([any([f"({kind})" in line for line in report]) for kind in layer_kinds])
+  print("Passed layer profiler tests")
+
+if __name__ == "__main__":
+  compiled_function_cache_test()
+  shape_bucketer_test()
+
+  # Batch norm gives the flow state.  A batch of 5 is padded to the bucket of 8.
+  rng = random.PRNGKey(0)
+  create_fun = create_batch_norm_flow
+  bucketed_apply_test(create_fun, {"x": random.normal(rng, (5, 4, 4, 2))}, rng)
+  abstract_init_test(create_fun, {"x": random.normal(rng, (5, 4, 4, 2))}, rng)
+  lazy_load_test(create_fun, {"x": random.normal(rng, (5, 4, 4, 2))}, rng)
+  layer_profiler_test(lambda: nux.sequential(nux.ActNorm(), nux.Coupling(), nux.Reverse()),
+                      {"x": random.normal(rng, (5, 4))},
+                      rng,
+                      layer_kinds=["sequential", "ActNorm", "Coupling", "Reverse"])
@@ -0,0 +1,50 @@
+import jax
+import jax.numpy as jnp
+from jax import random
+import numpy as np
+import asyncio
+from nux.serving.scoring_server import ScoringServer
+
+import nux
+
+def scoring_server_test(create_fun, inputs, rng, n_examples=5):
+  """
+  Score a few examples concurrently and check that the coalesced batches give the same log_px as
+  applying the flow to all of the examples at once.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  expected = flow.stateful_apply(rng, inputs, flow.state, is_training=False)[0]["log_px"][:n_examples]
+
+  async def score_all():
+    async with ScoringServer(flow, rng, max_batch_size=4, is_training=False) as server:
+      return await asyncio.gather(*[server.score(inputs["x"][i]) for i in range(n_examples)])
+
+  log_pxs = np.array(asyncio.get_event_loop().run_until_complete(score_all()))
+  if np.allclose(log_pxs, expected, atol=1e-4) == False:
+    print("Failed scoring server test!", log_pxs - expected)
+    assert 0
+  print("Passed scoring server tests")
+
+def scoring_server_stop_test(create_fun, inputs, rng):
+  """
+  Requests that are still waiting when the server stops must fail instead of hanging.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+
+  async def stop_early():
+    server = ScoringServer(flow, rng, max_batch_size=64, max_latency_ms=1e5, is_training=False)
+    await server.start()
+    futures = [asyncio.ensure_future(server.score(inputs["x"][i])) for i in range(3)]
+    await asyncio.sleep(0.01)
+    await server.stop()
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+  results = asyncio.get_event_loop().run_until_complete(stop_early())
+  assert all(isinstance(result, RuntimeError) for result in results), results
+  print("Passed scoring server stop tests")
+
+if __name__ == "__main__":
+  rng = random.PRNGKey(0)
+  inputs = {"x": random.normal(rng, (8, 4))}
+  scoring_server_test(lambda: nux.Coupling(), inputs, rng)
+  scoring_server_stop_test(lambda: nux.Coupling(), inputs, rng)
@@ -0,0 +1,180 @@
+import jax
+import jax.numpy as jnp
+from jax import random
+import numpy as np
+import tempfile
+import time
+from nux.training.metrics import MetricsBuffer
+from nux.training.prefetch import PrefetchIterator
+from nux.training.checkpoint import CheckpointManager
+from nux.training.flow_trainer import MaximumLikelihoodTrainer
+from nux.tests.helpers import create_batch_norm_flow
+import nux.util as util
+import nux
+
+def metrics_buffer_test():
+  """
+  Write more steps than the device buffer holds, with single steps and with scan loop vectors,
+  and check that the history has every step in order.
+  """
+  metrics = MetricsBuffer(names=("loss", "grad_norm"), capacity=8, flush_every=5)
+  expected = []
+  for i in range(13):
+    metrics.write({"loss": float(i)})
+    expected.append(float(i))
+
+  # A scan loop writes several steps at once.  This one doesn't fit in the space that is left.
+  metrics.write({"loss": jnp.arange(13, 19, dtype=jnp.float32), "grad_norm": 1.0})
+  expected.extend(range(13, 19))
+
+  # Longer than the buffer, so it skips it
+  metrics.write({"loss": jnp.arange(19, 30, dtype=jnp.float32)})
+  expected.extend(range(19, 30))
+
+  assert len(metrics) == len(expected)
+  assert np.array_equal(metrics.history("loss"), np.array(expected, dtype=np.float32)), metrics.history("loss")
+
+  # Missing metrics are nan
+  grad_norm = metrics.history("grad_norm")
+  assert np.all(np.isnan(grad_norm[:13])) and np.all(grad_norm[13:19] == 1.0) and np.all(np.isnan(grad_norm[19:]))
+
+  # Restoring a history and continuing appends to it
+  metrics.load_history({"loss": np.arange(3)})
+  metrics.write({"loss": 3.0})
+  assert np.array_equal(metrics.history("loss"), np.arange(4, dtype=np.float32)), metrics.history("loss")
+  print("Passed metrics buffer tests")
+
+def prefetch_iterator_test():
+  """
+  Check that batches come out in order with several threads, that n_iters stacks them and that
+  an exception in the source iterator is raised in the consumer.
+  """
+  def source(n):
+    for i in range(n):
+      # Make the threads finish out of order
+      if i%3 == 0:
+        time.sleep(0.01)
+      yield {"x": np.full((2,), i)}
+
+  xs = [int(inputs["x"][0]) for inputs in PrefetchIterator(source(20), queue_depth=2, n_threads=4)]
+  assert xs == list(range(20)), xs
+
+  stacks = list(PrefetchIterator(source(10), n_iters=4, n_threads=2))
+  assert [s["x"].shape for s in stacks] == [(4, 2), (4, 2), (2, 2)]
+  assert np.array_equal(np.concatenate([s["x"][:, 0] for s in stacks]), np.arange(10))
+
+  stacks = list(PrefetchIterator(source(10), n_iters=4, drop_remainder=True))
+  assert len(stacks) == 2
+
+  def failing_source():
+    yield {"x": np.zeros(2)}
+    raise ValueError("Broken source")
+
+  try:
+    list(PrefetchIterator(failing_source(), n_threads=2))
+    assert 0, "Expected the source's exception"
+  except ValueError:
+    pass
+
+  # Leaving a with statement early stops the threads
+  with PrefetchIterator(source(100), queue_depth=2, n_threads=3) as batches:
+    assert int(next(batches)["x"][0]) == 0
+  assert all([thread.is_alive() == False for thread in batches.threads])
+  assert batches.queue.empty() and len(batches.ready) == 0
+  print("Passed prefetch iterator tests")
+
+def checkpoint_manager_test():
+  """
+  Only the most recent checkpoints are kept and unchanged arrays are linked instead of rewritten.
+  """
+  with tempfile.TemporaryDirectory() as directory:
+    manager = CheckpointManager(directory, keep=2)
+    params = {"w": jnp.ones((3, 3)), "b": jnp.zeros(3)}
+    for step in range(4):
+      params = {"w": params["w"], "b": params["b"] + 1}
+      manager.save(step, {"params": params, "step": step})
+
+    assert manager.latest_step() == 3
+    assert manager.all_steps() == [2, 3], manager.all_steps()
+
+    restored = manager.restore()
+    assert restored["step"] == 3
+    assert np.array_equal(restored["params"]["b"], np.full((3,), 4.0))
+    assert np.array_equal(manager.restore(2)["params"]["b"], np.full((3,), 3.0))
+
+    # w never changed, so only the first checkpoint wrote it
+    assert manager.n_leaves_linked == 3, (manager.n_leaves_linked, manager.n_leaves_written)
+  print("Passed checkpoint manager tests")
+
+def data_parallel_test(create_fun, inputs, rng, n_steps=3):
+  """
+  On a single device, a data parallel step must give the same loss and parameters as the regular
+  step.  The data parallel step folds the device index into the key, so the regular step gets the
+  key of device 0.
+  """
+  if jax.local_device_count() != 1:
+    print("Skipping data parallel tests.  They compare against one device.")
+    return
+
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  parallel_flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  trainer = MaximumLikelihoodTrainer(flow, lr=1e-2, warmup=0)
+  parallel_trainer = MaximumLikelihoodTrainer(parallel_flow, lr=1e-2, warmup=0, data_parallel=True)
+
+  for key in random.split(rng, n_steps):
+    loss = trainer.grad_step(random.fold_in(key, 0), inputs)
+    parallel_loss = parallel_trainer.grad_step(key, inputs)
+    assert np.allclose(loss, parallel_loss, atol=1e-5), (loss, parallel_loss)
+
+  parallel_trainer.unreplicate_carry()
+  if util.trees_equal((flow.params, flow.state), (parallel_flow.params, parallel_flow.state), atol=1e-5) == False:
+    print("Failed data parallel test!")
+    assert 0
+  print("Passed data parallel tests")
+
+def loss_scale_overflow_test(create_fun, inputs, rng):
+  """
+  A step whose scaled loss overflows must leave the parameters, state and optimizer state as they were.
+  """
+  flow = nux.Flow(create_fun, rng, inputs, batch_axes=(0,))
+  trainer = MaximumLikelihoodTrainer(flow, lr=1e-2, warmup=0, loss_scale=float("inf"))
+  before = (flow.params, flow.state, trainer.opt_state)
+
+  loss = trainer.grad_step(rng, inputs)
+  assert np.isfinite(loss)
+  if util.trees_equal(before, (flow.params, flow.state, trainer.opt_state)) == False:
+    print("Failed loss scale overflow test!")
+    assert 0
+  print("Passed loss scale overflow tests")
+
+def evaluate_test_bucketing_test(create_fun, inputs, rng):
+  """
+  A ragged test set must be padded to the bucket size by default, so that eval_step only compiles once.
+  inputs is a (n_iters, batch, ...) stack of full batches.
+  """
+  batch_size = inputs["x"].shape[1]
+  flow = nux.Flow(create_fun, rng, jax.tree_map(lambda x: x[0], inputs), batch_axes=(0,), bucket_sizes=[batch_size])
+  trainer = MaximumLikelihoodTrainer(flow)
+
+  ragged = jax.tree_map(lambda x: x[:, :batch_size - 3], inputs)
+  nll = trainer.evaluate_test(rng, iter([inputs, inputs, ragged]), prefetch_depth=0)
+  assert jnp.isfinite(nll)
+  n_iters = inputs["x"].shape[0]
+  assert int(trainer.test_metrics[trainer.n_train_steps]["n_examples"]) == n_iters*(3*batch_size - 3)
+  if trainer.compiled_eval_step.misses != 1:
+    print("Failed evaluate test bucketing test!", trainer.compiled_eval_step.stats())
+    assert 0
+  print("Passed evaluate test bucketing tests")
+
+if __name__ == "__main__":
+  metrics_buffer_test()
+  prefetch_iterator_test()
+  checkpoint_manager_test()
+
+  # Batch norm updates the state during training
+  rng = random.PRNGKey(0)
+  create_fun = create_batch_norm_flow
+  inputs = {"x": random.normal(rng, (4, 4, 4, 2))}
+  data_parallel_test(create_fun, inputs, rng)
+  loss_scale_overflow_test(create_fun, inputs, rng)
+  evaluate_test_bucketing_test(create_fun, {"x": random.normal(rng, (2, 8, 4, 4, 2))}, rng)
@@ -0,0 +1,162 @@
+import jax
+import jax.numpy as jnp
+from jax import random
+import numpy as np
+import pickle
+import tempfile
+from pathlib import Path
+import nux.util as util
+
+def save_load_test():
+  """
+  Round trip a pytree through save_pytree/load_pytree, including paths with a .pickle suffix
+  and pickle files from before the directory format.
+  """
+  data = {"params": {"w": np.arange(6, dtype=np.float32).reshape((2, 3)), "b": np.zeros((0,), dtype=np.int32)},
+          "losses": [1.0, 2.0],
+          "step": 10,
+          "nothing": None}
+
+  def check(loaded):
+    assert np.array_equal(loaded["params"]["w"], data["params"]["w"])
+    assert loaded["params"]["b"].shape == (0,) and loaded["params"]["b"].dtype == np.int32
+    assert list(loaded["losses"]) == data["losses"]
+    assert loaded["step"] == 10 and loaded["nothing"] is None
+
+  with tempfile.TemporaryDirectory() as directory:
+    directory = Path(directory)
+
+    # The .pickle suffix is mapped to the same checkpoint directory on save and on load
+    util.save_pytree(data, directory/"model.pickle")
+    check(util.load_pytree(directory/"model.pickle"))
+    check(util.load_pytree(directory/"model.ckpt", mmap=False))
+
+    try:
+      util.save_pytree(data, directory/"model.ckpt")
+      assert 0, "Expected an error when overwriting without overwrite=True"
+    except RuntimeError:
+      pass
+    util.save_pytree(data, directory/"model.ckpt", overwrite=True)
+    check(util.load_pytree(directory/"model.ckpt"))
+
+    # Other suffixes are kept, so versions don't overwrite each other
+    util.save_pytree(data, directory/"model.v1")
+    util.save_pytree({"step": 11}, directory/"model.v2")
+    check(util.load_pytree(directory/"model.v1"))
+    assert util.load_pytree(directory/"model.v2")["step"] == 11
+
+    # Old pickle checkpoints
+    with open(directory/"legacy.pickle", "wb") as file:
+      pickle.dump(data, file)
+    check(util.load_pytree(directory/"legacy.pickle"))
+
+    # A crash between the renames of an overwrite only leaves .old behind
+    (directory/"model.ckpt").rename(directory/"model.ckpt.old")
+    check(util.load_pytree(directory/"model.ckpt"))
+
+  print("Passed save/load tests")
+
+def sinks_test():
+  """
+  Check that NpySink and ShardedNpySink write every chunk in order.
+  """
+  chunks = [{"x": np.full((4, 2), i, dtype=np.float32), "log_px": np.full((4,), -i, dtype=np.float32)} for i in range(3)]
+  chunks[-1] = {name: value[:2] for name, value in chunks[-1].items()}
+
+  with tempfile.TemporaryDirectory() as directory:
+    directory = Path(directory)
+
+    sink = util.NpySink(directory/"samples", n_samples=10)
+    for chunk in chunks:
+      sink.write(chunk)
+    sink.close()
+    x = np.load(directory/"samples_x.npy", mmap_mode="r")
+    log_px = np.load(directory/"samples_log_px.npy")
+    assert np.array_equal(x, np.concatenate([c["x"] for c in chunks]))
+    assert np.array_equal(log_px, np.concatenate([c["log_px"] for c in chunks]))
+
+    sharded = util.ShardedNpySink(directory/"shards")
+    for chunk in chunks:
+      sharded.write(chunk)
+    sharded.close()
+    shards = sorted((directory/"shards").glob("shard_*_x.npy"))
+    assert len(shards) == 3
+    assert np.array_equal(np.concatenate([np.load(path) for path in shards]), x)
+
+  print("Passed sink tests")
+
+def fixed_point_solvers_test():
+  """
+  Solve x = Ax + b for a batch of contractive A and check every solver against the exact solution.
+  """
+  n_examples, dim = 16, 5
+  k1, k2 = random.split(random.PRNGKey(0))
+  A = random.normal(k1, (n_examples, dim, dim))
+  A = 0.9*A/jnp.linalg.norm(A, ord=2, axis=(1, 2))[:, None, None]
+  b = random.normal(k2, (n_examples, dim))
+  expected = jnp.linalg.solve(jnp.eye(dim) - A, b[..., None])[..., 0]
+
+  def f(x, context):
+    A, b = context
+    return jnp.einsum("nij,nj->ni", A, x) + b
+
+  for name in ["banach", "anderson", "broyden"]:
+    for compact_fraction in [None, 0.5]:
+      solver = util.get_fixed_point_solver(name, max_iters=2000, atol=1e-6, batch_ndim=1, compact_fraction=compact_fraction)
+      x, n_iters, residual = solver(f, jnp.zeros_like(b), context=(A, b))
+      assert x.shape == b.shape and n_iters.shape == (n_examples,) and residual.shape == (n_examples,)
+      if jnp.allclose(x, expected, atol=1e-4) == False or jnp.any(residual > 1e-6):
+        print(f"Failed fixed point test with {name} and compact_fraction={compact_fraction}!", jnp.abs(x - expected).max())
+        assert 0
+
+  print("Passed fixed point solver tests")
+
+def masked_while_loop_test():
+  """
+  Count every example down to 0.  Examples that finish must stay frozen, with or without compaction.
+  """
+  start = jnp.arange(32)
+
+  def step_fun(carry, context):
+    value, n_steps = carry
+    return value - 1, n_steps + 1
+
+  is_converged = lambda carry: carry[0] <= 0
+
+  for compact_fraction in [None, 0.25]:
+    value, n_steps = util.masked_while_loop(step_fun, is_converged, (start, jnp.zeros_like(start)), max_iters=100, compact_fraction=compact_fraction, min_compact_size=4)
+    assert jnp.all(value == 0), value
+    assert jnp.array_equal(n_steps, start), n_steps
+
+  # max_iters caps the number of iterations
+  value, _ = util.masked_while_loop(step_fun, is_converged, (start, jnp.zeros_like(start)), max_iters=10)
+  assert jnp.array_equal(value, jnp.maximum(start - 10, 0)), value
+  print("Passed masked while loop tests")
+
+def compile_tracker_test():
+  """
+  A tracked function is traced and compiled once per input signature and hits the cache otherwise.
+  """
+  tracker = util.get_compile_tracker()
+  name = "compile_tracker_test_fun"
+  fun = util.tracked_jit(lambda x, y: x*y + 1, name=name)
+
+  for i in range(3):
+    fun(jnp.ones(3), jnp.float32(i))
+  stats = tracker.stats()[name]
+  assert (stats["traces"], stats["compiles"], stats["hits"], stats["unique_signatures"]) == (1, 1, 2, 1), stats
+
+  # A new shape traces again
+  fun(jnp.ones(4), jnp.float32(0))
+  fun(jnp.ones(4), jnp.float32(1))
+  stats = tracker.stats()[name]
+  assert (stats["traces"], stats["compiles"], stats["hits"], stats["unique_signatures"]) == (2, 2, 3, 2), stats
+  assert f'nux_traces_total{{function="{name}"}} 2' in tracker.to_prometheus()
+  print("Passed compile tracker tests")
+
+if __name__ == "__main__":
+  save_load_test()
+  sinks_test()
+  fixed_point_solvers_test()
+  masked_while_loop_test()
+  compile_tracker_test()
@@ -1 +1,8 @@
-from nux.training.flow_trainer import *
\ No newline at end of file
+from nux.lazy import lazy_exports
+
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.training.flow_trainer",
+                                     "nux.training.metrics",
+                                     "nux.training.prefetch",
+                                     "nux.training.checkpoint"],
+                                    submodules=["flow_trainer", "metrics", "prefetch", "checkpoint"])
@@ -0,0 +1,136 @@
+import jax.numpy as jnp
+import jax
+import numpy as np
+import threading
+import hashlib
+import shutil
+import os
+import re
+from pathlib import Path
+from typing import Optional, Mapping, Sequence, Any, Union
+import nux.util as util
+
+__all__ = ["CheckpointManager"]
+
+################################################################################################################
+
+def leaf_digest(array: np.ndarray):
+  """ Identifies the contents of an array without keeping a copy of it """
+  data = np.ascontiguousarray(array)
+  return data.shape, data.dtype.str, hashlib.blake2b(data.view(np.uint8).reshape(-1), digest_size=16).hexdigest()
+
+class CheckpointManager():
+
+  def __init__(self,
+               directory: Union[str, Path],
+               keep: int=3,
+               only_changed_leaves: bool=True):
+    """ Write checkpoints from a background thread so that training doesn't wait for the disk.
+        JAX arrays are immutable, so saving only holds on to the arrays that were passed in.
+        They are copied to the host and written by the background thread.
+    Args:
+      directory          : Where to put the checkpoints.  Each one is saved as ckpt_<step>.ckpt.
+      keep               : Number of checkpoints to keep.  Older ones are deleted.
+      only_changed_leaves: Whether to hard link arrays that didn't change since the last checkpoint
+                           instead of writing them again.
+    """
+    assert keep > 0
+    self.directory           = Path(directory)
+    self.keep                = keep
+    self.only_changed_leaves = only_changed_leaves
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+    self.thread = None
+    self.exception = None
+
+    # Digests of the arrays in the last checkpoint
+    self.previous_path = None
+    self.previous_digests = None
+    self.n_leaves_linked = 0
+    self.n_leaves_written = 0
+
+  def path_for_step(self, step: int) -> Path:
+    return self.directory/f"ckpt_{step:09d}{util.suffix}"
+
+  def all_steps(self) -> Sequence[int]:
+    steps = []
+    for path in self.directory.glob(f"ckpt_*{util.suffix}"):
+      match = re.fullmatch(rf"ckpt_(\d+){re.escape(util.suffix)}", path.name)
+      if match is not None:
+        steps.append(int(match.group(1)))
+    return sorted(steps)
+
+  def latest_step(self) -> Optional[int]:
+    self.wait()
+    steps = self.all_steps()
+    return steps[-1] if len(steps) > 0 else None
+
+  def save(self, step: int, items: Mapping[str, Any]):
+    """ Start writing a checkpoint and return right away.  Waits for the previous checkpoint
+        to finish first.  Values of items can be functions without arguments.  They are
+        called in the background thread, which is useful for work that would otherwise block.
+    """
+    self.wait()
+
+    # Start the device to host copies now so that they overlap with training
+    for leaf in jax.tree_leaves(items):
+      if hasattr(leaf, "copy_to_host_async"):
+        leaf.copy_to_host_async()
+
+    self.thread = threading.Thread(target=self.write, args=(step, items), daemon=True)
+    self.thread.start()
+
+  def wait(self):
+    """ Block until the checkpoint that is being written is done """
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.exception is not None:
+      exception, self.exception = self.exception, None
+      raise exception
+
+  def write(self, step, items):
+    try:
+      items = {name: value() if callable(value) else value for name, value in items.items()}
+      items = jax.device_get(items)
+      path = self.path_for_step(step)
+
+      digests = []
+      def link_leaf(index, array, file_path):
+        if self.only_changed_leaves == False:
+          self.n_leaves_written += 1
+          return False
+
+        digest = leaf_digest(array)
+        digests.append(digest)
+        if self.previous_digests is None or index >= len(self.previous_digests) or self.previous_digests[index] != digest:
+          self.n_leaves_written += 1
+          return False
+
+        # Share the file with the previous checkpoint.  Fall back to writing if linking isn't possible.
+        try:
+          os.link(self.previous_path/file_path.name, file_path)
+        except OSError:
+          self.n_leaves_written += 1
+          return False
+        self.n_leaves_linked += 1
+        return True
+
+      util.save_pytree(items, path, overwrite=True, link_leaf=link_leaf)
+      self.previous_path = path
+      self.previous_digests = digests if self.only_changed_leaves else None
+
+      # Only keep the most recent checkpoints.  Hard links keep shared files alive.
+      for old_step in self.all_steps()[:-self.keep]:
+        shutil.rmtree(self.path_for_step(old_step), ignore_errors=True)
+
+    except Exception as e:
+      self.exception = e
+
+  def restore(self, step: Optional[int]=None, mmap: bool=True) -> Mapping[str, Any]:
+    """ Load a checkpoint.  Loads the most recent one if step is None. """
+    if step is None:
+      step = self.latest_step()
+      assert step is not None, f"No checkpoints in {self.directory}"
+    self.wait()
+    return util.load_pytree(self.path_for_step(step), mmap=mmap)
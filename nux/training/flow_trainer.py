@@ -3,9 +3,15 @@ import jax.numpy as jnp
 import jax
 from jax import random, jit, vmap
 from nux.internal.layer import Flow
+from nux.internal.persistent_cache import PersistentCompilationCache
+from nux.internal.compile_cache import freeze_static_value, CompiledFunctionCache
+from nux.training.metrics import MetricsBuffer
+from nux.training.prefetch import PrefetchIterator
+from nux.training.checkpoint import CheckpointManager
 import nux.util as util
 from typing import Optional, Mapping, Callable, Sequence, Tuple, Any
 from haiku._src.typing import Params, State, PRNGKey
+import time
 import optax
 from optax._src import transform
 GradientTransformation = transform.GradientTransformation
@@ -18,18 +24,43 @@ class MaximumLikelihoodTrainer():
   """ Convenience class for training a flow with maximum likelihood.
 
       Args:
-          flow     - A Flow object.
-          clip     - How much to clip gradients.  This is crucial for stable training!
-          warmup   - How much to warm up the learning rate.
-          lr_decay - Learning rate decay.
-          lr       - Max learning rate.
+          flow                  - A Flow object.
+          clip                  - How much to clip gradients.  This is crucial for stable training!
+          warmup                - How much to warm up the learning rate.
+          lr_decay              - Learning rate decay.
+          lr                    - Max learning rate.
+          compilation_cache_dir - If set, serialize the compiled training step here
+                                  so that restarted workers don't recompile it.
+          data_parallel         - Split every batch over the local devices with pmap and average
+                                  the gradients.  To use several CPU cores, set
+                                  XLA_FLAGS=--xla_force_host_platform_device_count=<n_cores>
+                                  before JAX is imported.  The replicated parameters are only copied
+                                  back to flow.params when the trainer needs them (evaluation,
+                                  checkpoints).  Call unreplicate_carry before reading them directly.
+          loss_scale            - Multiply the loss by this before taking gradients and divide the
+                                  gradients by it after.  Steps with non-finite gradients are skipped.
+                                  Use with a float16 precision policy (see nux.set_precision_policy).
+          metrics_flush_every   - Number of steps between copies of the training metrics to the host.
+          checkpoint_dir        - If set, save writes checkpoints here from a background thread.
+          keep_checkpoints      - Number of checkpoints to keep in checkpoint_dir.
   """
   def __init__(self,
                flow: Flow,
                optimizer: GradientTransformation=None,
+               compilation_cache_dir: Optional[str]=None,
+               data_parallel: bool=False,
+               loss_scale: Optional[float]=None,
+               metrics_flush_every: int=100,
+               checkpoint_dir: Optional[str]=None,
+               keep_checkpoints: int=3,
                **kwargs):
     self.flow = flow
 
+    # valgrad is the most expensive function to compile, so reuse executables from previous runs.
+    # Activate the cache before anything below compiles.
+    if compilation_cache_dir is not None and self.flow.compilation_cache is None:
+      self.flow.compilation_cache = PersistentCompilationCache(compilation_cache_dir, self.flow.fingerprint)
+
     # Get the optimizer
     if optimizer is None:
       opt_init, opt_update = self.build_optimizer(**kwargs)
@@ -42,15 +73,61 @@ class MaximumLikelihoodTrainer():
     self.apply_updates = jit(optax.apply_updates)
 
     # Build the value and grad function
-    self.valgrad = jax.value_and_grad(self.nll, has_aux=True)
-    self.valgrad = jit(self.valgrad)
+    self.loss_scale = loss_scale
+    if loss_scale is None:
+      self.valgrad = jax.value_and_grad(self.nll, has_aux=True)
+    else:
+      self.valgrad = self.scaled_valgrad
+    self.valgrad = util.tracked_jit(self.valgrad, name="valgrad")
 
-    self.train_losses = jnp.array([])
+    # Loss, grad norm, bits/dim and step time of every training step
+    self.metrics = MetricsBuffer(capacity=max(1000, metrics_flush_every), flush_every=metrics_flush_every)
+    self.last_step_time = None
     self.test_losses = {}
 
+    # One compiled evaluation step per input shape
+    self.compiled_eval_step = CompiledFunctionCache(self.eval_step, name="eval_step")
+    self.test_metrics = {}
+
+    if checkpoint_dir is not None:
+      self.checkpoint_manager = CheckpointManager(checkpoint_dir, keep=keep_checkpoints)
+    else:
+      self.checkpoint_manager = None
+
+    # Replicated copies of the parameters, state and optimizer state for data parallel training
+    self.data_parallel = data_parallel
+    self.n_devices = jax.local_device_count() if data_parallel else 1
+    self.pmapped_steps = {}
+    self.replicated_carry = None
+    self.unreplicated_carry = None
+    self.carry_is_replicated = False
+
   @property
   def n_train_steps(self):
-    return self.train_losses.size
+    return len(self.metrics)
+
+  @property
+  def train_losses(self):
+    # Cached on the host, so reading it in the training loop only copies the new steps
+    return self.metrics.history("loss")
+
+  @train_losses.setter
+  def train_losses(self, train_losses):
+    self.metrics.load_history({"loss": train_losses})
+
+  def record_metrics(self, metrics):
+    """ Write the metrics of one or more training steps without waiting for them to finish.
+        The step time is the wall time between calls, which matches the time that a training
+        step takes once JAX's dispatch queue is full.
+    """
+    now = time.perf_counter()
+    n_steps = jnp.size(metrics["loss"])
+    metrics = metrics.copy()
+    metrics["bits_per_dim"] = self.flow.to_bits_per_dim(metrics["loss"])
+    if self.last_step_time is not None:
+      metrics["step_time"] = (now - self.last_step_time)/n_steps
+    self.last_step_time = now
+    self.metrics.write(metrics)
 
   def build_optimizer(self,
                       clip=15.0,
@@ -90,6 +167,36 @@ class MaximumLikelihoodTrainer():
     log_px = outputs.get("log_pz", 0.0) + outputs.get("log_det", 0.0)
     return -log_px.mean(), updated_state
 
+  def scaled_valgrad(self, params, state, key, inputs, **kwargs):
+    """ Same as the value and grad of nll, but scales the loss so that small
+        gradients don't underflow in low precision.
+    """
+    def scaled_nll(params):
+      loss, updated_state = self.nll(params, state, key, inputs, **kwargs)
+      return loss*self.loss_scale, (loss, updated_state)
+
+    (_, (loss, state)), grad = jax.value_and_grad(scaled_nll, has_aux=True)(params)
+    grad = jax.tree_map(lambda g: g/self.loss_scale, grad)
+    return (loss, state), grad
+
+  def apply_grad(self, grad, params, opt_state, new_state, state):
+    """ Update the parameters and optimizer state.  new_state is the state after the forward
+        pass and state is the one before it.
+    """
+    updates, new_opt_state = self.opt_update(grad, opt_state, params)
+    new_params = self.apply_updates(params, updates)
+
+    if self.loss_scale is None:
+      return new_params, new_state, new_opt_state
+
+    # Skip the whole step, including the state update, if the scaled loss overflowed
+    is_finite = jnp.all(jnp.array([jnp.all(jnp.isfinite(g)) for g in jax.tree_leaves(grad)]))
+    keep_finite = lambda new, old: jnp.where(is_finite, new, old)
+    new_params = jax.tree_multimap(keep_finite, new_params, params)
+    new_state = jax.tree_multimap(keep_finite, new_state, state)
+    new_opt_state = jax.tree_multimap(keep_finite, new_opt_state, opt_state)
+    return new_params, new_state, new_opt_state
+
   #############################################################################
 
   def scan_grad_step(self, carry, scan_inputs, **kwargs):
@@ -97,24 +204,28 @@ class MaximumLikelihoodTrainer():
     key, inputs = scan_inputs
 
     # Take a gradient step
-    (train_loss, state), grad = self.valgrad(params, state, key, inputs, **kwargs)
+    (train_loss, new_state), grad = self.valgrad(params, state, key, inputs, **kwargs)
 
     # Update the parameters and optimizer state
-    updates, opt_state = self.opt_update(grad, opt_state, params)
-    params = self.apply_updates(params, updates)
+    params, state, opt_state = self.apply_grad(grad, params, opt_state, new_state, state)
 
-    return (params, state, opt_state), train_loss
+    metrics = {"loss": train_loss, "grad_norm": optax.global_norm(grad)}
+    return (params, state, opt_state), metrics
 
   def grad_step(self,
                 key: PRNGKey,
                 inputs: Mapping[str, jnp.ndarray],
                 **kwargs):
-    carry = (self.flow.params, self.flow.state, self.opt_state)
-    carry, train_loss = self.scan_grad_step(carry, (key, inputs), **kwargs)
-    self.flow.params, self.flow.state, self.opt_state = carry
+    if self.data_parallel:
+      metrics = self.parallel_train(key, inputs, scan_loop=False, **kwargs)
+    else:
+      self.unreplicate_carry()
+      carry = (self.flow.params, self.flow.state, self.opt_state)
+      carry, metrics = self.scan_grad_step(carry, (key, inputs), **kwargs)
+      self.flow.params, self.flow.state, self.opt_state = carry
 
-    self.train_losses = jnp.hstack([self.train_losses, train_loss])
-    return train_loss
+    self.record_metrics(metrics)
+    return metrics["loss"]
 
   def grad_step_for_loop(self,
                          key: PRNGKey,
@@ -127,18 +238,18 @@ class MaximumLikelihoodTrainer():
     n_iters = inputs["x"].shape[0]
     keys = random.split(key, n_iters)
     scan_inputs = (keys, inputs)
+    self.unreplicate_carry()
     carry = (self.flow.params, self.flow.state, self.opt_state)
 
     train_losses = []
     for i, key in enumerate(keys):
       _inputs = jax.tree_map(lambda x: x[i], inputs)
-      carry, train_loss = self.scan_grad_step(carry, (key, _inputs), **kwargs)
-      train_losses.append(train_loss)
+      carry, metrics = self.scan_grad_step(carry, (key, _inputs), **kwargs)
+      train_losses.append(metrics["loss"])
       self.flow.params, self.flow.state, self.opt_state = carry
+      self.record_metrics(metrics)
 
-    train_losses = jnp.array(train_losses)
-    self.train_losses = jnp.hstack([self.train_losses, train_losses])
-    return train_losses
+    return jnp.array(train_losses)
 
   def grad_step_scan_loop(self,
                           key: PRNGKey,
@@ -147,62 +258,237 @@ class MaximumLikelihoodTrainer():
     if len(inputs["x"].shape) == len(self.flow.data_shape):
       assert 0, "Expect a batched or doubly-batched input"
 
+    if self.data_parallel:
+      metrics = self.parallel_train(key, inputs, scan_loop=True, **kwargs)
+      self.record_metrics(metrics)
+      return metrics["loss"]
+
     # Get the inputs for the scan loop
     n_iters = inputs["x"].shape[0]
     keys = random.split(key, n_iters)
     scan_inputs = (keys, inputs)
+    self.unreplicate_carry()
     carry = (self.flow.params, self.flow.state, self.opt_state)
 
     # Run the training steps
-    carry, train_losses = jax.lax.scan(self.scan_grad_step, carry, scan_inputs)
+    carry, metrics = jax.lax.scan(self.scan_grad_step, carry, scan_inputs)
     self.flow.params, self.flow.state, self.opt_state = carry
-    self.train_losses = jnp.hstack([self.train_losses, train_losses])
-    return train_losses
+    self.record_metrics(metrics)
+    return metrics["loss"]
 
   #############################################################################
 
-  def evaluate_test(self,
-                    key: PRNGKey,
-                    input_iterator,
-                    **kwargs):
+  def parallel_scan_grad_step(self, carry, scan_inputs, **kwargs):
+    params, state, opt_state = carry
+    key, inputs = scan_inputs
 
-    sum_log_px = 0.0
-    total_examples = 0
+    # Every device needs different randomness for its part of the batch
+    key = random.fold_in(key, jax.lax.axis_index("batch"))
+
+    # The loss is the mean over the local batch, so averaging over devices gives the loss of the full batch
+    (train_loss, new_state), grad = self.valgrad(params, state, key, inputs, **kwargs)
+    grad = jax.lax.pmean(grad, axis_name="batch")
+    train_loss = jax.lax.pmean(train_loss, axis_name="batch")
+
+    # Keep the replicas of the state identical
+    def sync(x):
+      if jnp.issubdtype(x.dtype, jnp.floating):
+        return jax.lax.pmean(x, axis_name="batch")
+      return x
+    new_state = jax.tree_map(sync, new_state)
+
+    params, state, opt_state = self.apply_grad(grad, params, opt_state, new_state, state)
+
+    metrics = {"loss": train_loss, "grad_norm": optax.global_norm(grad)}
+    return (params, state, opt_state), metrics
+
+  def get_pmapped_step(self, scan_loop, **kwargs):
+    key = (scan_loop, freeze_static_value(kwargs))
+    if key not in self.pmapped_steps:
+      step = partial(self.parallel_scan_grad_step, **kwargs)
+
+      if scan_loop:
+        def train_fun(carry, keys, inputs):
+          return jax.lax.scan(step, carry, (keys, inputs))
+      else:
+        def train_fun(carry, key, inputs):
+          return step(carry, (key, inputs))
+
+      # Only the inputs are split over the devices
+      self.pmapped_steps[key] = jax.pmap(train_fun, axis_name="batch", in_axes=(0, None, 0))
+    return self.pmapped_steps[key]
+
+  def shard_inputs(self, inputs, batch_axis):
+    """ Split the batch axis of inputs over the local devices """
+    def shard(x):
+      batch_size = x.shape[batch_axis]
+      assert batch_size%self.n_devices == 0, f"Batch size {batch_size} is not divisible by the number of devices {self.n_devices}"
+      x = x.reshape(x.shape[:batch_axis] + (self.n_devices, batch_size//self.n_devices) + x.shape[batch_axis + 1:])
+      return jnp.moveaxis(x, batch_axis, 0)
+    return jax.tree_map(shard, inputs)
+
+  def parallel_train(self,
+                     key: PRNGKey,
+                     inputs: Mapping[str, jnp.ndarray],
+                     scan_loop: bool=False,
+                     **kwargs):
+    # Only copy to the devices again if the parameters were changed outside of the trainer
+    if self.host_carry_changed():
+      carry = (self.flow.params, self.flow.state, self.opt_state)
+      self.replicated_carry = jax.device_put_replicated(carry, jax.local_devices())
+      self.unreplicated_carry = carry
+
+    if scan_loop:
+      n_iters = inputs["x"].shape[0]
+      keys = random.split(key, n_iters)
+      sharded_inputs = self.shard_inputs(inputs, batch_axis=1)
+      step_keys = keys
+    else:
+      sharded_inputs = self.shard_inputs(inputs, batch_axis=0)
+      step_keys = key
 
-    try:
-      while True:
-        key, test_key = random.split(key, 2)
-        inputs = next(input_iterator)
-        outputs = self.flow.scan_apply(test_key, inputs, **kwargs)
+    train_fun = self.get_pmapped_step(scan_loop, **kwargs)
+    self.replicated_carry, metrics = train_fun(self.replicated_carry, step_keys, sharded_inputs)
+    self.carry_is_replicated = True
 
-        # Accumulate the total sum of the log likelihoods in case the batch sizes differ
-        sum_log_px += outputs["log_px"].sum()
-        n_examples_in_batch = util.list_prod(self.flow.get_batch_shape(inputs))
-        total_examples += n_examples_in_batch
+    # Every device holds the same values.  Only the metrics are needed after every step.
+    return jax.tree_map(lambda x: x[0], metrics)
 
-    except StopIteration:
-      pass
+  def host_carry_changed(self) -> bool:
+    """ Whether flow.params, flow.state or opt_state were replaced since they were last replicated """
+    if self.unreplicated_carry is None:
+      return True
+    carry = (self.flow.params, self.flow.state, self.opt_state)
+    return any([a is not b for a, b in zip(carry, self.unreplicated_carry)])
+
+  def unreplicate_carry(self):
+    """ Copy the parameters, state and optimizer state from the first device to flow.params,
+        flow.state and opt_state after data parallel steps.  Values that were set from outside
+        of the trainer in the meantime are kept.
+    """
+    if self.carry_is_replicated == False:
+      return
+    self.carry_is_replicated = False
+    if self.host_carry_changed():
+      return
+    self.flow.params, self.flow.state, self.opt_state = jax.tree_map(lambda x: x[0], self.replicated_carry)
+    self.unreplicated_carry = (self.flow.params, self.flow.state, self.opt_state)
+
+  #############################################################################
+
+  def eval_step(self, params, state, key, inputs, mask, totals, **kwargs):
+    """ Evaluate a (n_iters, batch, ...) stack of inputs and add the log likelihoods of
+        the real (not padded) examples to the running totals.
+    """
+    outputs, state = self.flow._scan_apply_fun(params, state, key, inputs, **kwargs)
+    log_px = outputs.get("log_pz", 0.0) + outputs.get("log_det", 0.0)
 
-    nll = -sum_log_px/total_examples
+    # Keep the dtypes of the totals so that the next call hits the same executable
+    sum_log_px, n_examples = totals
+    sum_log_px = sum_log_px + jnp.sum(jnp.where(mask, log_px, 0.0)).astype(sum_log_px.dtype)
+    n_examples = n_examples + jnp.sum(mask).astype(n_examples.dtype)
+    return (sum_log_px, n_examples), log_px, state
+
+  def evaluate_test_stream(self,
+                           key: PRNGKey,
+                           input_iterator,
+                           prefetch_depth: int=2,
+                           **kwargs):
+    """ Generator that evaluates the test set and yields the log likelihoods of every batch.
+        The reductions stay on the device, so nothing waits for a batch to finish unless the
+        yielded values are read.  Once the generator is exhausted, the results are in
+        test_losses and test_metrics like with evaluate_test.  Evaluation runs with
+        is_training=False unless it is passed, so ragged batches are padded to a bucket size.
+    """
+    kwargs.setdefault("is_training", False)
+    self.unreplicate_carry()
+    totals = (jnp.zeros(()), jnp.zeros((), dtype=jnp.int32))
+
+    # Prepare the next batches while the current one is being evaluated
+    prefetcher = None
+    if prefetch_depth > 0 and isinstance(input_iterator, PrefetchIterator) == False:
+      prefetcher = PrefetchIterator(input_iterator, queue_depth=prefetch_depth)
+      input_iterator = prefetcher
+
+    # Stop the prefetch threads even if the caller stops reading the generator early
+    try:
+      for inputs in input_iterator:
+        key, test_key = random.split(key, 2)
+        if len(inputs["x"].shape) == len(self.flow.data_shape):
+          assert 0, "Expect a batched or doubly-batched input"
+
+        # Ragged batches are padded to a bucket size, so mask out the padding
+        batch_shape = self.flow.get_batch_shape(inputs)
+        if self.flow.pads_inputs(**kwargs):
+          inputs, mask = self.flow.bucketer.pad(inputs, len(batch_shape))
+        else:
+          mask = jnp.ones(batch_shape, dtype=bool)
+
+        totals, log_px, self.flow.state = self.compiled_eval_step(self.flow.params, self.flow.state, test_key, inputs, mask, totals, **kwargs)
+
+        if self.flow.pads_inputs(**kwargs):
+          log_px = self.flow.bucketer.unpad({"log_px": log_px}, batch_shape)["log_px"]
+        yield log_px
+    finally:
+      if prefetcher is not None:
+        prefetcher.close()
+
+    sum_log_px, n_examples = totals
+    nll = -sum_log_px/n_examples
     self.test_losses[self.n_train_steps] = nll
-    return nll
+    self.test_metrics[self.n_train_steps] = {"nll": nll,
+                                             "bits_per_dim": self.flow.to_bits_per_dim(nll),
+                                             "n_examples": n_examples}
+
+  def evaluate_test(self,
+                    key: PRNGKey,
+                    input_iterator,
+                    prefetch_depth: int=2,
+                    **kwargs):
+    for _ in self.evaluate_test_stream(key, input_iterator, prefetch_depth=prefetch_depth, **kwargs):
+      pass
+    return self.test_losses[self.n_train_steps]
 
   #############################################################################
 
+  def checkpoint_items(self):
+    # The metrics are concatenated in the background so that saving doesn't wait for the device
+    self.unreplicate_carry()
+    metrics_chunks = self.metrics.snapshot()
+    return {"params": self.flow.params,
+            "state": self.flow.state,
+            "opt_state": self.opt_state,
+            "train_metrics": lambda: MetricsBuffer.concatenate_chunks(metrics_chunks),
+            "test_losses": dict(self.test_losses)}
+
   def save(self, path: str=None):
-    save_items = {"params": self.flow.params,
-                  "state": self.flow.state,
-                  "opt_state": self.trainer.opt_state,
-                  "train_losses": self.train_losses,
-                  "test_losses": self.test_losses}
-    util.save_pytree(save_items, path, overwrite=True)
+    """ Save a checkpoint.  Without a path, the checkpoint is written to checkpoint_dir in the
+        background and training can continue right away.
+    """
+    items = self.checkpoint_items()
+    if path is None:
+      assert self.checkpoint_manager is not None, "Need a path or a checkpoint_dir"
+      self.checkpoint_manager.save(self.n_train_steps, items)
+      return
+
+    items["train_metrics"] = items["train_metrics"]()
+    util.save_pytree(items, path, overwrite=True)
 
   def load(self, path: str=None):
-    loaded_items = util.load_pytree(path)
-    self.flow.params = loaded_items["params"]
-    self.flow.state = loaded_items["state"]
-    self.trainer.opt_state = loaded_items["opt_state"]
-    self.trainer.losses = loaded_items["train_losses"]
-    self.tester.losses = loaded_items["test_losses"]
+    """ Load a checkpoint.  Without a path, loads the most recent checkpoint in checkpoint_dir. """
+    if path is None:
+      assert self.checkpoint_manager is not None, "Need a path or a checkpoint_dir"
+      loaded_items = self.checkpoint_manager.restore()
+    else:
+      loaded_items = util.load_pytree(path)
+
+    # The loaded arrays are memory mapped, so copy them to the device once instead of on every step
+    carry = (loaded_items["params"], loaded_items["state"], loaded_items["opt_state"])
+    self.flow.params, self.flow.state, self.opt_state = jax.device_put(carry)
+    if "train_metrics" in loaded_items:
+      self.metrics.load_history(loaded_items["train_metrics"])
+    else:
+      self.train_losses = loaded_items["train_losses"]
+    self.test_losses = dict(loaded_items["test_losses"])
 
   #############################################################################
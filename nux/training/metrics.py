@@ -0,0 +1,156 @@
+from functools import partial
+import jax.numpy as jnp
+import jax
+from jax import jit
+import numpy as np
+from typing import Optional, Mapping, Sequence, Any
+
+__all__ = ["MetricsBuffer"]
+
+################################################################################################################
+
+def _write_buffers(buffers, index, values):
+  return jax.tree_multimap(lambda buffer, value: jax.lax.dynamic_update_slice(buffer, value, (index,)), buffers, values)
+
+_compiled_write_buffers = None
+
+def write_buffers(buffers, index, values):
+  # The old buffers aren't used after the write, so XLA can update them in place.  The CPU
+  # backend can't use donated buffers and only warns, so only donate on the other backends.
+  global _compiled_write_buffers
+  if _compiled_write_buffers is None:
+    backend = jax.default_backend() if hasattr(jax, "default_backend") else jax.lib.xla_bridge.get_backend().platform
+    donate_argnums = (0,) if backend != "cpu" else ()
+    _compiled_write_buffers = jit(_write_buffers, donate_argnums=donate_argnums)
+  return _compiled_write_buffers(buffers, index, values)
+
+class MetricsBuffer():
+
+  def __init__(self,
+               names: Sequence[str]=("loss", "grad_norm", "bits_per_dim", "step_time"),
+               capacity: int=1000,
+               flush_every: int=100):
+    """ Collects per-step training metrics in preallocated device arrays.  Writing a
+        metric doesn't wait for the training step to finish.  Every flush_every steps the
+        values are copied to the host in the background.  Reading the history only waits
+        for the copies that haven't finished.
+    Args:
+      names      : The names of the metrics.
+      capacity   : Number of steps that the device buffers hold.
+      flush_every: Number of steps between copies to the host.
+    """
+    assert capacity >= flush_every
+    self.names       = tuple(names)
+    self.capacity    = capacity
+    self.flush_every = flush_every
+
+    self.buffers = {name: jnp.zeros((capacity,)) for name in self.names}
+    self.index   = 0
+    self.n_steps = 0
+
+    # Chunks that are being copied to the host.  The host history grows by doubling, so
+    # appending a chunk is amortized O(chunk) and reading the history doesn't copy it.
+    self.pending = []
+    self.host_history = {name: np.zeros((flush_every,), dtype=np.float32) for name in self.names}
+    self.n_host = 0
+
+  def __len__(self):
+    return self.n_steps
+
+  def write(self, metrics: Mapping[str, Any]):
+    """ Record the metrics of one or more steps.  Every value must be a scalar or a vector
+        with one element per step.  Metrics that are missing are recorded as nan.
+    """
+    values = {}
+    for name in self.names:
+      value = metrics.get(name, jnp.nan)
+      values[name] = jnp.atleast_1d(jnp.asarray(value, dtype=jnp.float32))
+    n_new = max([v.shape[0] for v in values.values()])
+    values = {name: jnp.broadcast_to(v, (n_new,)) for name, v in values.items()}
+
+    # Long scan loops skip the ring buffer
+    if n_new > self.capacity:
+      self.flush()
+      self.add_pending(values)
+      self.n_steps += n_new
+      return
+
+    if self.index + n_new > self.capacity:
+      self.flush()
+
+    self.buffers = write_buffers(self.buffers, self.index, values)
+    self.index += n_new
+    self.n_steps += n_new
+
+    if self.index >= self.flush_every:
+      self.flush()
+
+  def add_pending(self, chunk):
+    for value in chunk.values():
+      if hasattr(value, "copy_to_host_async"):
+        value.copy_to_host_async()
+    self.pending.append(chunk)
+
+  def flush(self):
+    """ Start copying the filled part of the buffers to the host """
+    if self.index == 0:
+      return
+    chunk = {name: buffer[:self.index] for name, buffer in self.buffers.items()}
+    self.add_pending(chunk)
+    self.index = 0
+
+  def append_to_host(self, chunk: Mapping[str, np.ndarray]):
+    n_new = next(iter(chunk.values())).shape[0]
+    size = self.n_host + n_new
+    capacity = next(iter(self.host_history.values())).shape[0]
+    if size > capacity:
+      capacity = max(2*capacity, size)
+      for name, values in self.host_history.items():
+        grown = np.zeros((capacity,), dtype=np.float32)
+        grown[:self.n_host] = values[:self.n_host]
+        self.host_history[name] = grown
+
+    for name, value in chunk.items():
+      self.host_history[name][self.n_host:size] = value
+    self.n_host = size
+
+  def sync(self):
+    """ Wait for the host copies to finish """
+    self.flush()
+    for chunk in self.pending:
+      self.append_to_host({name: np.asarray(value) for name, value in chunk.items()})
+    self.pending = []
+
+  def history(self, name: str) -> np.ndarray:
+    """ Read-only view of the history.  Only the steps since the last read are copied. """
+    self.sync()
+    view = self.host_history[name][:self.n_host]
+    view.flags.writeable = False
+    return view
+
+  def snapshot(self) -> Mapping[str, Sequence[Any]]:
+    """ The chunks of the history without waiting for the copies to the host.
+        Use concatenate_chunks to turn the output into arrays.
+    """
+    self.flush()
+    chunks = {name: [self.host_history[name][:self.n_host].copy()] for name in self.names}
+    for chunk in self.pending:
+      for name, value in chunk.items():
+        chunks[name].append(value)
+    return chunks
+
+  @staticmethod
+  def concatenate_chunks(chunks: Mapping[str, Sequence[Any]]) -> Mapping[str, np.ndarray]:
+    return {name: np.concatenate([np.zeros((0,), dtype=np.float32)] + [np.asarray(c) for c in values]) for name, values in chunks.items()}
+
+  def load_history(self, history: Mapping[str, Any]):
+    """ Replace the history, like when loading a checkpoint.  Missing metrics are filled with nan. """
+    self.sync()
+    history = {name: np.asarray(values, dtype=np.float32) for name, values in history.items()}
+    self.n_steps = max([values.size for values in history.values()])
+    self.n_host = 0
+    self.host_history = {name: np.zeros((max(self.n_steps, self.flush_every),), dtype=np.float32) for name in self.names}
+    self.append_to_host({name: history.get(name, np.full((self.n_steps,), np.nan, dtype=np.float32)) for name in self.names})
+
+  def as_dict(self) -> Mapping[str, np.ndarray]:
+    return {name: self.history(name) for name in self.names}
@@ -0,0 +1,194 @@
+import jax.numpy as jnp
+import jax
+import numpy as np
+import threading
+import queue
+from typing import Optional, Mapping, Iterator, Sequence, Any
+
+__all__ = ["PrefetchIterator"]
+
+################################################################################################################
+
+INPUT_KEYS = ("x", "y", "condition")
+
+def to_inputs(item: Any) -> Mapping[str, Any]:
+  """ Turn a batch into the {"x", "y", "condition"} dictionary that the layers expect.
+      Tuples are read in that order.
+  """
+  if isinstance(item, Mapping):
+    return dict(item)
+  if isinstance(item, (tuple, list)):
+    assert len(item) <= len(INPUT_KEYS), f"Expected at most {len(INPUT_KEYS)} elements in a batch"
+    return dict(zip(INPUT_KEYS, item))
+  return {"x": item}
+
+def stack_batches(batches: Sequence[Mapping[str, Any]]) -> Mapping[str, np.ndarray]:
+  # Build the (n_iters, batch, ...) arrays on the host so that there is one transfer per stack
+  return jax.tree_multimap(lambda *xs: np.stack(xs, axis=0), *batches)
+
+class _End():
+  pass
+
+class _Error():
+  def __init__(self, exception):
+    self.exception = exception
+
+################################################################################################################
+
+class PrefetchIterator():
+
+  def __init__(self,
+               iterator: Iterator,
+               queue_depth: int=2,
+               n_threads: int=1,
+               n_iters: Optional[int]=None,
+               drop_remainder: bool=False,
+               device_put: bool=True):
+    """ Prepare batches in background threads so that the host work overlaps with the training
+        step that is running on the device.  The batches come out in the order of iterator.
+        Use n_iters to get the (n_iters, batch, ...) stacks that grad_step_scan_loop and
+        scan_apply expect, e.g.
+
+          with PrefetchIterator(train_ds, n_iters=100) as batches:
+            for inputs in batches:
+              trainer.grad_step_scan_loop(key, inputs)
+
+        The threads stop when the source is exhausted, when close is called or when the with
+        statement exits.
+
+    Args:
+      iterator      : Produces dictionaries, tuples (x, y, condition) or arrays.
+      queue_depth   : Number of batches that are ready on the device.  2 gives double buffering.
+      n_threads     : Number of threads that pull from iterator and build the batches.
+      n_iters       : If set, stack this many batches along a new leading axis.
+      drop_remainder: Whether to drop the last stack if it has fewer than n_iters batches.
+      device_put    : Whether to start copying the batches to the device in the background.
+    """
+    assert queue_depth > 0 and n_threads > 0
+    self.iterator       = iter(iterator)
+    self.queue_depth    = queue_depth
+    self.n_iters        = n_iters
+    self.drop_remainder = drop_remainder
+    self.device_put     = device_put
+
+    self.queue          = queue.Queue(maxsize=queue_depth)
+    self.iterator_lock  = threading.Lock()
+    self.stop_event     = threading.Event()
+    self.next_index     = 0
+    self.read_index     = 0
+    self.ready          = {}
+    self.n_running      = n_threads
+
+    # Producers wait on this so that they don't get more than queue_depth batches ahead of the
+    # consumer.  Otherwise a slow batch lets the others pile up in ready without a bound.
+    self.read_condition = threading.Condition()
+
+    self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(n_threads)]
+    for thread in self.threads:
+      thread.start()
+
+  def pull(self):
+    """ Take the next batch (or n_iters batches) off of the source iterator """
+    with self.iterator_lock:
+      index = self.next_index
+      n_batches = 1 if self.n_iters is None else self.n_iters
+      batches = []
+      for _ in range(n_batches):
+        try:
+          batches.append(next(self.iterator))
+        except StopIteration:
+          break
+
+      if len(batches) == 0:
+        return None, None
+      if self.n_iters is not None and len(batches) < self.n_iters and self.drop_remainder:
+        return None, None
+
+      self.next_index += 1
+      return index, batches
+
+  def wait_for_turn(self, index):
+    with self.read_condition:
+      while index - self.read_index >= self.queue_depth and self.stop_event.is_set() == False:
+        self.read_condition.wait(timeout=0.1)
+    return self.stop_event.is_set() == False
+
+  def put(self, item):
+    # Don't block forever if the consumer went away
+    while self.stop_event.is_set() == False:
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def worker(self):
+    try:
+      while self.stop_event.is_set() == False:
+        index, batches = self.pull()
+        if index is None:
+          break
+
+        batches = [to_inputs(batch) for batch in batches]
+        inputs = batches[0] if self.n_iters is None else stack_batches(batches)
+
+        # device_put is asynchronous, so the copy overlaps with the running step
+        if self.device_put:
+          inputs = jax.device_put(inputs)
+
+        if self.wait_for_turn(index) == False or self.put((index, inputs)) == False:
+          return
+    except Exception as e:
+      self.put((None, _Error(e)))
+    self.put((None, _End()))
+
+  def __iter__(self):
+    return self
+
+  def __next__(self) -> Mapping[str, jnp.ndarray]:
+    while self.read_index not in self.ready:
+      if self.n_running == 0:
+        self.close()
+        raise StopIteration
+
+      index, item = self.queue.get()
+      if isinstance(item, _End):
+        self.n_running -= 1
+      elif isinstance(item, _Error):
+        self.close()
+        raise item.exception
+      else:
+        self.ready[index] = item
+
+    inputs = self.ready.pop(self.read_index)
+    with self.read_condition:
+      self.read_index += 1
+      self.read_condition.notify_all()
+    return inputs
+
+  def close(self, timeout: Optional[float]=None):
+    """ Stop the threads and wait for them to finish.  A thread that is blocked inside the
+        source iterator can only stop once the source returns, so timeout bounds the wait.
+    """
+    self.stop_event.set()
+    with self.read_condition:
+      self.read_condition.notify_all()
+
+    for thread in self.threads:
+      if thread is not threading.current_thread():
+        thread.join(timeout)
+
+    # Release the batches that were never read
+    self.ready.clear()
+    while True:
+      try:
+        self.queue.get_nowait()
+      except queue.Empty:
+        break
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -1,3 +1,4 @@
+from nux.util.compile_tracking import *
 from nux.util.weight_initializers import *
 from nux.util.spectral_norm import *
 from nux.util.householder import *
@@ -5,9 +6,11 @@ from nux.util.gaussian import *
 from nux.util.tree import *
 from nux.util.reshape import *
 from nux.util.save import *
+from nux.util.sinks import *
 from nux.util.default_networks import *
 from nux.util.optimizer import *
 from nux.util.misc import *
 from nux.util.logistic_cdf_mixture import *
 from nux.util.fixed_point import *
+from nux.util.fixed_point_solvers import *
 from nux.util.mmd import *
\ No newline at end of file
@@ -0,0 +1,183 @@
+from functools import wraps
+import jax.numpy as jnp
+import jax
+from jax import jit
+import collections
+import warnings
+import json
+import time
+from pathlib import Path
+from typing import Optional, Mapping, Callable, Any, Sequence, Union
+
+# Moved out of jax.core in later JAX versions
+try:
+  from jax.core import trace_state_clean
+except ImportError:
+  from jax._src.core import trace_state_clean
+
+__all__ = ["CompileTracker",
+           "get_compile_tracker",
+           "tracked_jit",
+           "track_traces"]
+
+""" Counts the traces, compiles and cache hits of NuX's jitted functions so that recompiles
+    can be found without jax_log_compiles.  A trace is recorded every time JAX runs the python
+    function to build a jaxpr.  A compile is a top level call that traced, and its time is the
+    time that the call took (trace + compile + dispatch).  A hit is a top level call that didn't. """
+
+################################################################################################################
+
+def describe_value(x: Any) -> str:
+  if hasattr(x, "shape") and hasattr(x, "dtype"):
+    return f"{jnp.dtype(x.dtype).name}{list(x.shape)}"
+  if callable(x):
+    return getattr(x, "__name__", type(x).__name__)
+  text = repr(x)
+  return text if len(text) <= 64 else text[:61] + "..."
+
+def describe_call(args: Sequence[Any], kwargs: Mapping[str, Any], max_leaves: int=16) -> str:
+  """ Short description of the shapes, dtypes and static values that a call was traced with """
+  def describe(x):
+    leaves = jax.tree_leaves(x)
+    if len(leaves) > max_leaves:
+      # Parameter trees are too big to spell out
+      return f"tree(leaves={len(leaves)}, hash={hash(tuple([describe_value(l) for l in leaves])) & 0xffffffff:08x})"
+    return str(jax.tree_map(describe_value, x))
+
+  descriptions = [describe(x) for x in args] + [f"{k}={describe(v)}" for k, v in sorted(kwargs.items())]
+  return "(" + ", ".join(descriptions) + ")"
+
+def is_tracing() -> bool:
+  """ Whether we're inside of a JAX transformation.  Looks at JAX's trace stack instead of
+      flattening the arguments, so it costs the same for a parameter tree as for an array.
+  """
+  return trace_state_clean() == False
+
+################################################################################################################
+
+class CompileTracker():
+
+  def __init__(self, max_signatures: int=100, warn_after: Optional[int]=None):
+    """ Holds the counters of every tracked function.
+    Args:
+      max_signatures: Number of recent trace signatures to keep per function.
+      warn_after    : If set, warn once a function has been traced this many times.
+    """
+    self.max_signatures = max_signatures
+    self.warn_after     = warn_after
+    self.reset()
+
+  def reset(self):
+    self.functions = collections.OrderedDict()
+
+  def get(self, name: str) -> Mapping[str, Any]:
+    if name not in self.functions:
+      self.functions[name] = {"traces": 0,
+                              "compiles": 0,
+                              "hits": 0,
+                              "compile_time": 0.0,
+                              "unique_signatures": set(),
+                              "signatures": collections.deque(maxlen=self.max_signatures)}
+    return self.functions[name]
+
+  def record_trace(self, name: str, signature: str):
+    record = self.get(name)
+    record["traces"] += 1
+    record["unique_signatures"].add(signature)
+    record["signatures"].append({"time": time.time(), "signature": signature})
+    if self.warn_after is not None and record["traces"] == self.warn_after:
+      warnings.warn(f"{name} has been traced {record['traces']} times with {len(record['unique_signatures'])} different signatures.  Last one: {signature}")
+
+  def record_compile(self, name: str, seconds: float):
+    record = self.get(name)
+    record["compiles"] += 1
+    record["compile_time"] += seconds
+
+  def record_hit(self, name: str):
+    self.get(name)["hits"] += 1
+
+  def stats(self, include_signatures: bool=False) -> Mapping[str, Mapping[str, Any]]:
+    stats = {}
+    for name, record in self.functions.items():
+      stats[name] = {"traces": record["traces"],
+                     "compiles": record["compiles"],
+                     "hits": record["hits"],
+                     "compile_time": record["compile_time"],
+                     "unique_signatures": len(record["unique_signatures"])}
+      if include_signatures:
+        stats[name]["signatures"] = list(record["signatures"])
+    return stats
+
+  def to_json(self, path: Union[str, Path]):
+    with open(path, "w") as file:
+      json.dump(self.stats(include_signatures=True), file, indent=2)
+
+  def to_prometheus(self, prefix: str="nux") -> str:
+    """ The counters in the Prometheus text format """
+    metrics = [("traces", "traces_total", "counter"),
+               ("compiles", "compiles_total", "counter"),
+               ("hits", "cache_hits_total", "counter"),
+               ("compile_time", "compile_seconds_total", "counter"),
+               ("unique_signatures", "unique_signatures", "gauge")]
+    lines = []
+    for metric, metric_name, kind in metrics:
+      metric_name = f"{prefix}_{metric_name}"
+      lines.append(f"# TYPE {metric_name} {kind}")
+      for name, stats in self.stats().items():
+        lines.append(f'{metric_name}{{function="{name}"}} {stats[metric]}')
+    return "\n".join(lines) + "\n"
+
+_tracker = CompileTracker()
+
+def get_compile_tracker() -> CompileTracker:
+  return _tracker
+
+################################################################################################################
+
+def track_traces(fun: Callable, name: Optional[str]=None) -> Callable:
+  """ Record every time fun is called with tracers.  For functions that are traced as part of
+      other jitted functions.
+  """
+  name = name if name is not None else getattr(fun, "__name__", "function")
+
+  @wraps(fun)
+  def wrapper(*args, **kwargs):
+    if is_tracing():
+      _tracker.record_trace(name, describe_call(args, kwargs))
+    return fun(*args, **kwargs)
+
+  return wrapper
+
+def tracked_jit(fun: Callable, name: Optional[str]=None, **jit_kwargs) -> Callable:
+  """ jax.jit that records its traces, compiles and cache hits.  jit_kwargs go to jax.jit.
+      The arguments are only described when jit misses its cache and runs traced_fun, so a
+      cache hit only adds a counter check to the call.
+  """
+  name = name if name is not None else getattr(fun, "__name__", "function")
+  n_traces = 0
+
+  @wraps(fun)
+  def traced_fun(*args, **kwargs):
+    nonlocal n_traces
+    n_traces += 1
+    _tracker.record_trace(name, describe_call(args, kwargs))
+    return fun(*args, **kwargs)
+
+  jitted = jit(traced_fun, **jit_kwargs)
+
+  @wraps(fun)
+  def wrapper(*args, **kwargs):
+    # Calls from inside another trace aren't compiled on their own
+    if is_tracing():
+      return jitted(*args, **kwargs)
+
+    n_traces_before = n_traces
+    start = time.perf_counter()
+    out = jitted(*args, **kwargs)
+    if n_traces > n_traces_before:
+      _tracker.record_compile(name, time.perf_counter() - start)
+    else:
+      _tracker.record_hit(name)
+    return out
+
+  return wrapper
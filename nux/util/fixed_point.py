@@ -3,13 +3,14 @@ import jax.numpy as jnp
 from jax import random, vmap, jit
 from functools import partial
 from jax.flatten_util import ravel_pytree
+from nux.util.compile_tracking import tracked_jit
 
 """ Taken from https://github.com/google/jax/blob/4a20eea8285d6396b50451ed884c0fe00e382821/docs/notebooks/Custom_derivative_rules_for_Python_code.ipynb
     and refactored to match http://www.autodiff.org/Docs/euroad/Second%20EuroAd%20Workshop%20-%20Sebastian%20Schlenkrich%20-%20Differentianting%20Fixed%20Point%20Iterations%20with%20ADOL-C.pdf"""
 
 __all__ = ["fixed_point"]
 
-@partial(jit, static_argnums=(0, 2))
+@partial(tracked_jit, static_argnums=(0, 2))
 def _fixed_point(f, x_init, max_iters):
   atol = 1e-5
 
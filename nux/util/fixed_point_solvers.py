@@ -0,0 +1,271 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from functools import partial
+from typing import Optional, Mapping, Callable, Tuple, Union, Any
+
+__all__ = ["masked_while_loop",
+           "banach_fixed_point",
+           "anderson_fixed_point",
+           "broyden_fixed_point",
+           "get_fixed_point_solver"]
+
+""" Solvers for x = f(x) where f is batched over the leading batch_ndim axes of x.  The examples
+    in a batch are independent problems, so the acceleration coefficients and convergence are
+    computed per example.  Every solver has the signature
+
+      solver(f, x_init, context=None, max_iters, atol, batch_ndim, compact_fraction) -> (x, n_iters, residual)
+
+    where n_iters and residual (max |f(x) - x| over each example) have the batch shape.  If context
+    is given, f is called as f(x, context) where every leaf of context has the same batch axes as x.
+    This lets the solver evaluate f on a subset of the examples, which is needed for compaction. """
+
+################################################################################################################
+
+def broadcast_mask(mask: jnp.ndarray, x: jnp.ndarray) -> jnp.ndarray:
+  return mask.reshape(mask.shape + (1,)*(x.ndim - mask.ndim))
+
+def run_masked_loop(step_fun, is_converged, carry, context, i, max_iters, stop_size):
+  # Iterate until at most stop_size examples are still running
+  def cond_fun(val):
+    i, carry = val
+    n_running = jnp.sum(~is_converged(carry))
+    return (i < max_iters) & (n_running > stop_size)
+
+  def body_fun(val):
+    i, carry = val
+    running = ~is_converged(carry)
+    new_carry = step_fun(carry, context)
+    carry = jax.tree_map(lambda new, old: jnp.where(broadcast_mask(running, new), new, old), new_carry, carry)
+    return i + 1, carry
+
+  return jax.lax.while_loop(cond_fun, body_fun, (i, carry))
+
+def masked_while_loop(step_fun: Callable,
+                      is_converged: Callable,
+                      carry: Any,
+                      context: Any=(),
+                      max_iters: int=1000,
+                      compact_fraction: Optional[float]=None,
+                      min_compact_size: int=8,
+                      i: int=0) -> Any:
+  """ Run carry = step_fun(carry, context) until is_converged(carry) holds for every example.
+      The leaves of carry and context have a leading example axis.  Examples that have converged
+      are frozen, so they stop changing while the rest of the batch finishes.
+  Args:
+    step_fun        : One iteration.  Must treat the examples independently.
+    is_converged    : Function carry -> boolean array with one entry per example.
+    carry           : Loop state.
+    context         : Per example constants that step_fun needs.
+    max_iters       : Max number of iterations over all of the examples.
+    compact_fraction: Once at most this fraction of the examples is still running, gather them
+                      into a smaller batch so that the remaining iterations are cheaper.  This is
+                      repeated until the batch would be smaller than min_compact_size.
+    min_compact_size: Smallest batch to compact to.
+  """
+  n_examples = jax.tree_leaves(carry)[0].shape[0]
+  compact_size = int(n_examples*compact_fraction) if compact_fraction is not None else 0
+  if compact_size < min_compact_size or compact_size >= n_examples:
+    _, carry = run_masked_loop(step_fun, is_converged, carry, context, i, max_iters, 0)
+    return carry
+
+  i, carry = run_masked_loop(step_fun, is_converged, carry, context, i, max_iters, compact_size)
+
+  # Gather the examples that are still running.  If there are fewer than compact_size, some
+  # converged examples come along too, but they stay frozen.
+  index = jnp.argsort(is_converged(carry).astype(jnp.int32))[:compact_size]
+  take = lambda x: x[index]
+  sub_carry = masked_while_loop(step_fun,
+                                is_converged,
+                                jax.tree_map(take, carry),
+                                jax.tree_map(take, context),
+                                max_iters=max_iters,
+                                compact_fraction=compact_fraction,
+                                min_compact_size=min_compact_size,
+                                i=i)
+
+  # Put the compacted examples back
+  return jax.tree_map(lambda x, sub_x: x.at[index].set(sub_x), carry, sub_carry)
+
+################################################################################################################
+
+def flatten_problem(f: Callable, x_init: jnp.ndarray, context: Any, batch_ndim: int):
+  """ Reshape the problem to (n_examples, dim).  A subset of m examples is given to f with
+      batch shape (1, ..., 1, m), which works with functions that collapse their batch axes.
+  """
+  batch_shape, x_shape = x_init.shape[:batch_ndim], x_init.shape[batch_ndim:]
+  n_examples = int(np.prod(batch_shape))
+
+  def unflatten(x):
+    m = x.shape[0]
+    lead_shape = batch_shape if m == n_examples else (1,)*(batch_ndim - 1) + (m,)
+    return x.reshape(lead_shape + x.shape[1:])
+
+  def flat_f(x, context):
+    m = x.shape[0]
+    x = unflatten(x.reshape((m,) + x_shape))
+    fx = f(x) if context is None else f(x, jax.tree_map(unflatten, context))
+    return fx.reshape((m, -1))
+
+  flatten_context = lambda x: x.reshape((n_examples,) + x.shape[batch_ndim:])
+  flat_context = jax.tree_map(flatten_context, context) if context is not None else None
+  return flat_f, x_init.reshape((n_examples, -1)), flat_context, batch_shape
+
+def example_residual(fx: jnp.ndarray, x: jnp.ndarray) -> jnp.ndarray:
+  return jnp.max(jnp.abs(fx - x), axis=-1)
+
+def solve(step_fun, carry, flat_context, max_iters, atol, compact_fraction, x_init, batch_shape):
+  # Shared driver.  The first three entries of carry are x, f(x) and the iteration counts.
+  is_converged = lambda carry: example_residual(carry[1], carry[0]) <= atol
+
+  if flat_context is None:
+    # f closes over the whole batch, so it can't be evaluated on a subset
+    compact_fraction = None
+    run_step = lambda carry, context: step_fun(carry, None)
+  else:
+    run_step = step_fun
+
+  carry = masked_while_loop(run_step, is_converged, carry, flat_context if flat_context is not None else (),
+                            max_iters=max_iters, compact_fraction=compact_fraction)
+  x, fx, n_iters = carry[:3]
+  return fx.reshape(x_init.shape), n_iters.reshape(batch_shape), example_residual(fx, x).reshape(batch_shape)
+
+################################################################################################################
+
+def banach_fixed_point(f: Callable,
+                       x_init: jnp.ndarray,
+                       context: Any=None,
+                       max_iters: int=1000,
+                       atol: float=1e-5,
+                       batch_ndim: int=0,
+                       compact_fraction: Optional[float]=None):
+  """ Plain fixed point iteration x <- f(x).  Converges for contractive f. """
+  flat_f, x, flat_context, batch_shape = flatten_problem(f, x_init, context, batch_ndim)
+
+  def step_fun(carry, context):
+    x, fx, n_iters = carry
+    return fx, flat_f(fx, context), n_iters + 1
+
+  carry = (x, flat_f(x, flat_context), jnp.zeros(x.shape[:1], dtype=jnp.int32))
+  return solve(step_fun, carry, flat_context, max_iters, atol, compact_fraction, x_init, batch_shape)
+
+################################################################################################################
+
+def anderson_fixed_point(f: Callable,
+                         x_init: jnp.ndarray,
+                         context: Any=None,
+                         max_iters: int=1000,
+                         atol: float=1e-5,
+                         batch_ndim: int=0,
+                         compact_fraction: Optional[float]=None,
+                         memory: int=5,
+                         beta: float=1.0,
+                         ridge: float=1e-4):
+  """ Anderson acceleration.  The next iterate is the combination of the last memory values
+      of f(x) whose residuals f(x) - x have the smallest norm.  Keeps two (batch, memory, dim)
+      arrays of history.
+  Args:
+    memory: Number of previous iterates to combine.
+    beta  : Mixing parameter.  1.0 only uses the f(x) values.
+    ridge : Regularization of the least squares problem.
+  """
+  flat_f, x, flat_context, batch_shape = flatten_problem(f, x_init, context, batch_ndim)
+  n_examples, dim = x.shape
+
+  # History of iterates and their images
+  fx = flat_f(x, flat_context)
+  X = jnp.zeros((n_examples, memory, dim), dtype=x.dtype).at[:, 0].set(x)
+  F = jnp.zeros((n_examples, memory, dim), dtype=x.dtype).at[:, 0].set(fx)
+
+  def mixing_weights(G, n_valid):
+    # min ||alpha^T G|| s.t. sum(alpha) = 1, only over the filled history slots
+    valid = jnp.arange(memory)[None] < n_valid[:, None]
+    both_valid = valid[:, :, None] & valid[:, None, :]
+    H = jnp.where(both_valid, jnp.einsum("bid,bjd->bij", G, G), 0.0)
+    scale = jnp.maximum(jnp.trace(H, axis1=1, axis2=2), 1e-12)[:, None, None]
+    H = H + jnp.where(valid[:, :, None], ridge*scale, 1.0)*jnp.eye(memory)
+    alpha = jnp.linalg.solve(H, jnp.ones(G.shape[:2] + (1,), dtype=G.dtype))[..., 0]
+    alpha = jnp.where(valid, alpha, 0.0)
+    return alpha/jnp.sum(alpha, axis=1, keepdims=True)
+
+  def step_fun(carry, context):
+    x, fx, n_iters, X, F = carry
+
+    # Each example has its own history because examples stop at different times
+    alpha = mixing_weights(F - X, jnp.minimum(n_iters + 1, memory))
+    x = beta*jnp.einsum("bi,bid->bd", alpha, F) + (1 - beta)*jnp.einsum("bi,bid->bd", alpha, X)
+    fx = flat_f(x, context)
+
+    slot = (jnp.arange(memory)[None] == ((n_iters + 1)%memory)[:, None])[..., None]
+    X, F = jnp.where(slot, x[:, None], X), jnp.where(slot, fx[:, None], F)
+    return x, fx, n_iters + 1, X, F
+
+  carry = (x, fx, jnp.zeros((n_examples,), dtype=jnp.int32), X, F)
+  return solve(step_fun, carry, flat_context, max_iters, atol, compact_fraction, x_init, batch_shape)
+
+################################################################################################################
+
+def broyden_fixed_point(f: Callable,
+                        x_init: jnp.ndarray,
+                        context: Any=None,
+                        max_iters: int=1000,
+                        atol: float=1e-5,
+                        batch_ndim: int=0,
+                        compact_fraction: Optional[float]=None,
+                        memory: int=10):
+  """ Limited memory Broyden's method on g(x) = f(x) - x.  The inverse Jacobian of g starts
+      at -I (so the first step is a fixed point iteration) and gets a rank one update every step.
+      Keeps two (batch, memory, dim) arrays of updates.
+  Args:
+    memory: Number of rank one updates to keep.
+  """
+  flat_f, x, flat_context, batch_shape = flatten_problem(f, x_init, context, batch_ndim)
+  n_examples, dim = x.shape
+
+  # Inverse Jacobian is -I + U^T VT, stored as memory rank one terms
+  U = jnp.zeros((n_examples, memory, dim), dtype=x.dtype)
+  VT = jnp.zeros((n_examples, memory, dim), dtype=x.dtype)
+
+  def matvec(U, VT, y):
+    return -y + jnp.einsum("bmd,bm->bd", U, jnp.einsum("bmd,bd->bm", VT, y))
+
+  def rmatvec(U, VT, y):
+    return -y + jnp.einsum("bmd,bm->bd", VT, jnp.einsum("bmd,bd->bm", U, y))
+
+  def step_fun(carry, context):
+    x, fx, n_iters, U, VT = carry
+    g = fx - x
+
+    x_new = x - matvec(U, VT, g)
+    fx_new = flat_f(x_new, context)
+    g_new = fx_new - x_new
+
+    # Rank one update so that the inverse Jacobian maps dg to dx
+    dx, dg = x_new - x, g_new - g
+    vT = rmatvec(U, VT, dx)
+    denominator = jnp.einsum("bd,bd->b", vT, dg)
+
+    # Skip the update of examples where it is ill defined.  The slot is filled with zeros instead.
+    valid = jnp.abs(denominator) > 1e-12
+    u = (dx - matvec(U, VT, dg))/jnp.where(valid, denominator, 1.0)[:, None]
+    u = jnp.where(valid[:, None], u, 0.0)
+
+    slot = (jnp.arange(memory)[None] == (n_iters%memory)[:, None])[..., None]
+    U, VT = jnp.where(slot, u[:, None], U), jnp.where(slot, vT[:, None], VT)
+    return x_new, fx_new, n_iters + 1, U, VT
+
+  carry = (x, flat_f(x, flat_context), jnp.zeros((n_examples,), dtype=jnp.int32), U, VT)
+  return solve(step_fun, carry, flat_context, max_iters, atol, compact_fraction, x_init, batch_shape)
+
+################################################################################################################
+
+FIXED_POINT_SOLVERS = {"banach": banach_fixed_point,
+                       "anderson": anderson_fixed_point,
+                       "broyden": broyden_fixed_point}
+
+def get_fixed_point_solver(solver: Union[str, Callable], **kwargs) -> Callable:
+  """ Look up a solver by name.  kwargs (max_iters, atol, memory, ...) are filled in. """
+  if callable(solver):
+    return partial(solver, **kwargs)
+  assert solver in FIXED_POINT_SOLVERS, f"Unknown fixed point solver {solver}.  Options are {list(FIXED_POINT_SOLVERS.keys())}"
+  return partial(FIXED_POINT_SOLVERS[solver], **kwargs)
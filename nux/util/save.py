@@ -1,30 +1,206 @@
 # Thanks! https://github.com/google/jax/issues/2116#issuecomment-580322624
 from jax.tree_util import pytree
+import jax.numpy as jnp
+import numpy as np
+import importlib
 import pickle
+import shutil
+import json
+import os
+from collections.abc import Mapping
 from pathlib import Path
-from typing import Union
+from typing import Union, Optional, Any, Tuple, Callable
 
-suffix = '.pickle'
+""" Checkpoints are directories with an index.json that describes the tree and one raw
+    buffer per array.  The buffers can be memory mapped on load, so opening a checkpoint
+    only reads the index and arrays are paged in from disk when they are first used.
+    Old pickle checkpoints can still be loaded. """
 
-def save_pytree(data: pytree, path: Union[str, Path], overwrite: bool = False):
+suffix = '.ckpt'
+pickle_suffix = '.pickle'
+index_name = 'index.json'
+
+################################################################################################################
+
+def checkpoint_path(path: Union[str, Path]) -> Path:
+  """ Append the checkpoint suffix so that paths like model.v1 and model.v2 stay different.
+      Only the suffix of old pickle checkpoints is replaced.
+  """
   path = Path(path)
+  if path.suffix == pickle_suffix:
+    return path.with_suffix(suffix)
   if path.suffix != suffix:
-    path = path.with_suffix(suffix)
-  path.parent.mkdir(parents=True, exist_ok=True)
+    path = path.with_name(path.name + suffix)
+  return path
+
+def describe_tree(data: Any, write_leaf: Callable) -> Any:
+  """ Build the JSON description of data.  write_leaf(array) stores an array and returns its file name. """
+  if data is None:
+    return {"type": "none"}
+
+  if isinstance(data, Mapping):
+    keys = list(data.keys())
+    return {"type": "dict",
+            "frozen": type(data).__name__ == "FlatMapping",
+            "keys": [{"int": k} if isinstance(k, int) else k for k in keys],
+            "children": [describe_tree(data[k], write_leaf) for k in keys]}
+
+  if isinstance(data, tuple) and hasattr(data, "_fields"):
+    cls = type(data)
+    return {"type": "namedtuple",
+            "class": f"{cls.__module__}:{cls.__qualname__}",
+            "children": [describe_tree(x, write_leaf) for x in data]}
+
+  if isinstance(data, (tuple, list)):
+    return {"type": type(data).__name__,
+            "children": [describe_tree(x, write_leaf) for x in data]}
+
+  if isinstance(data, (bool, int, float, str)):
+    return {"type": "value", "value": data}
+
+  array = np.asarray(data)
+  return {"type": "array",
+          "file": write_leaf(array),
+          "shape": list(array.shape),
+          "dtype": array.dtype.name}
+
+def import_class(name: str):
+  module_name, qualname = name.split(":")
+  obj = importlib.import_module(module_name)
+  for attr in qualname.split("."):
+    obj = getattr(obj, attr)
+  return obj
+
+def build_tree(description: Mapping[str, Any], read_leaf: Callable) -> Any:
+  """ Inverse of describe_tree """
+  kind = description["type"]
+  if kind == "none":
+    return None
+
+  if kind == "value":
+    return description["value"]
+
+  if kind == "array":
+    return read_leaf(description)
+
+  children = [build_tree(child, read_leaf) for child in description["children"]]
+
+  if kind == "dict":
+    keys = [k["int"] if isinstance(k, Mapping) else k for k in description["keys"]]
+    data = dict(zip(keys, children))
+    if description["frozen"]:
+      from haiku._src import data_structures
+      data = data_structures.to_immutable_dict(data)
+    return data
+
+  if kind == "namedtuple":
+    return import_class(description["class"])(*children)
+
+  if kind == "tuple":
+    return tuple(children)
+
+  return children
+
+def read_array(path: Path, description: Mapping[str, Any], mmap: bool) -> np.ndarray:
+  dtype = jnp.dtype(description["dtype"])
+  shape = tuple(description["shape"])
+  file_path = path/description["file"]
+
+  # Can't memory map an empty file
+  if int(np.prod(shape)) == 0:
+    return np.zeros(shape, dtype=dtype)
+
+  if mmap:
+    return np.memmap(file_path, dtype=dtype, mode="r", shape=shape)
+  return np.fromfile(file_path, dtype=dtype).reshape(shape)
+
+def old_checkpoint_path(path: Path) -> Path:
+  return path.with_name(path.name + ".old")
+
+def replace_directory(tmp_path: Path, path: Path):
+  """ Move tmp_path to path.  A directory can't be replaced with one rename, so the old
+      checkpoint is moved to path.old first.  Between the two renames path doesn't exist, so
+      a crash there leaves only path.old.  load_pytree reads path.old when path is missing.
+  """
+  old_path = old_checkpoint_path(path)
   if path.exists():
-    if overwrite:
-      path.unlink()
-    else:
-      raise RuntimeError(f'File {path} already exists.')
-  with open(path, 'wb') as file:
-    pickle.dump(data, file)
-
-def load_pytree(path: Union[str, Path]) -> pytree:
+    if old_path.exists():
+      shutil.rmtree(old_path)
+    os.rename(path, old_path)
+  os.rename(tmp_path, path)
+  if old_path.exists():
+    shutil.rmtree(old_path)
+
+def find_checkpoint(path: Path) -> Optional[Path]:
+  """ The complete checkpoint directory for path, if there is one """
+  for candidate in [path, old_checkpoint_path(path)]:
+    if (candidate/index_name).is_file():
+      return candidate
+  return None
+
+################################################################################################################
+
+def save_pytree(data: pytree,
+                path: Union[str, Path],
+                overwrite: bool = False,
+                link_leaf: Optional[Callable] = None):
+  """ Save a pytree as a checkpoint directory.
+  Args:
+    data     : The pytree.  Can contain dicts, lists, tuples, named tuples, arrays and python scalars.
+    path     : Where to save.  The suffix is replaced with .ckpt.
+    overwrite: Whether to replace an existing checkpoint.
+    link_leaf: Optional function (leaf_index, array, file_path) -> bool.  If it returns True, it has
+               already put the array's buffer at file_path (like with a hard link) and it isn't written.
+  """
+  path = checkpoint_path(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  if find_checkpoint(path) is not None and not overwrite:
+    raise RuntimeError(f'File {path} already exists.')
+
+  # Write everything to a temporary directory first so that a crash never leaves a partial checkpoint
+  tmp_path = path.with_name(path.name + ".tmp")
+  if tmp_path.exists():
+    shutil.rmtree(tmp_path)
+  tmp_path.mkdir()
+
+  n_leaves = 0
+  def write_leaf(array):
+    nonlocal n_leaves
+    file_name = f"leaf_{n_leaves:06d}.bin"
+    file_path = tmp_path/file_name
+    if link_leaf is None or link_leaf(n_leaves, array, file_path) == False:
+      np.ascontiguousarray(array).tofile(file_path)
+    n_leaves += 1
+    return file_name
+
+  index = {"format": 1, "tree": describe_tree(data, write_leaf)}
+  with open(tmp_path/index_name, 'w') as file:
+    json.dump(index, file)
+
+  replace_directory(tmp_path, path)
+  return path
+
+def load_pytree(path: Union[str, Path], mmap: bool = True) -> pytree:
+  """ Load a checkpoint.  path is mapped to a .ckpt directory the same way as in save_pytree,
+      so save_pytree(data, "model.pickle") can be read with load_pytree("model.pickle").
+      Pickle files from before the directory format are loaded if there is no checkpoint directory.
+      With mmap=True, the arrays are read-only numpy views of the files on disk, so this returns
+      after reading the index and the data is read when it is used.
+  """
   path = Path(path)
-  if not path.is_file():
-    raise ValueError(f'Not a file: {path}')
-  if path.suffix != suffix:
-    raise ValueError(f'Not a {suffix} file: {path}')
-  with open(path, 'rb') as file:
-    data = pickle.load(file)
-  return data
+  directory = find_checkpoint(checkpoint_path(path))
+
+  if directory is None:
+    # Checkpoints that were saved before the directory format
+    pickle_path = path.with_suffix(pickle_suffix)
+    if not pickle_path.is_file():
+      raise ValueError(f'No {suffix} checkpoint or {pickle_suffix} file at {path}')
+    with open(pickle_path, 'rb') as file:
+      data = pickle.load(file)
+    return data
+
+  path = directory
+  with open(path/index_name, 'r') as file:
+    index = json.load(file)
+
+  return build_tree(index["tree"], lambda description: read_array(path, description, mmap))
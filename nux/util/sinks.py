@@ -0,0 +1,80 @@
+import numpy as np
+from pathlib import Path
+from typing import Optional, Mapping, Sequence, Union, Any
+
+__all__ = ["NpySink",
+           "ShardedNpySink"]
+
+################################################################################################################
+
+class NpySink():
+
+  def __init__(self,
+               path: Union[str, Path],
+               n_samples: int,
+               keys: Sequence[str]=("x", "log_px")):
+    """ Write chunks of samples into memory mapped .npy files, one for each key
+        (<path>_x.npy, <path>_log_px.npy, ...).  Only the chunk that is being written
+        needs to fit in memory.  The files can be opened with np.load(..., mmap_mode="r").
+    Args:
+      path     : Prefix of the file names.
+      n_samples: Total number of samples that will be written.
+      keys     : Which outputs to save.
+    """
+    self.path      = Path(path)
+    self.n_samples = n_samples
+    self.keys      = tuple(keys)
+    self.arrays    = None
+    self.index     = 0
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+
+  def file_path(self, key):
+    return self.path.with_name(f"{self.path.name}_{key}.npy")
+
+  def write(self, chunk: Mapping[str, Any]):
+    chunk = {key: np.asarray(chunk[key]) for key in self.keys}
+    n = chunk[self.keys[0]].shape[0]
+    assert self.index + n <= self.n_samples, "Wrote more samples than n_samples"
+
+    # The shapes are known once the first chunk arrives
+    if self.arrays is None:
+      self.arrays = {}
+      for key, value in chunk.items():
+        shape = (self.n_samples,) + value.shape[1:]
+        self.arrays[key] = np.lib.format.open_memmap(self.file_path(key), mode="w+", dtype=value.dtype, shape=shape)
+
+    for key, value in chunk.items():
+      self.arrays[key][self.index:self.index + n] = value
+    self.index += n
+
+  def close(self):
+    if self.arrays is not None:
+      for array in self.arrays.values():
+        array.flush()
+    self.arrays = None
+
+################################################################################################################
+
+class ShardedNpySink():
+
+  def __init__(self,
+               directory: Union[str, Path],
+               keys: Sequence[str]=("x", "log_px")):
+    """ Write every chunk of samples to its own set of files,
+        <directory>/shard_<i>_<key>.npy.  Doesn't need to know the number of samples in advance.
+    Args:
+      directory: Where to put the shards.
+      keys     : Which outputs to save.
+    """
+    self.directory = Path(directory)
+    self.keys      = tuple(keys)
+    self.n_shards  = 0
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+  def write(self, chunk: Mapping[str, Any]):
+    for key in self.keys:
+      np.save(self.directory/f"shard_{self.n_shards:06d}_{key}.npy", np.asarray(chunk[key]))
+    self.n_shards += 1
+
+  def close(self):
+    pass
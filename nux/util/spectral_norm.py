@@ -3,6 +3,7 @@ from jax import jit, random
 from functools import partial
 import jax
 import nux.util as util
+from nux.util.compile_tracking import tracked_jit
 from typing import Optional, Mapping, Callable, Sequence, Any, Union, Tuple
 import haiku as hk
 
@@ -35,7 +36,7 @@ def spectral_norm_iter(W, uv):
 
   return (u, v)
 
-@partial(jit, static_argnums=(4, 5))
+@partial(tracked_jit, static_argnums=(4, 5))
 def spectral_norm_apply(W: jnp.ndarray,
                         u: jnp.ndarray,
                         v: jnp.ndarray,
@@ -78,7 +79,7 @@ def spectral_norm_conv_iter(W, uv, stride, padding):
 
   return (u, v)
 
-@partial(jit, static_argnums=(2, 3, 5))
+@partial(tracked_jit, static_argnums=(2, 3, 5))
 def spectral_norm_conv_apply(W: jnp.ndarray,
                              u: jnp.ndarray,
                              stride: Sequence[int],
@@ -1,5 +1,6 @@
 import jax
 from jax import random
+import numpy as np
 
 def key_tree_like(key, pytree):
   # Figure out what the tree structure is
@@ -24,3 +25,20 @@ def tree_shapes(pytree):
 
 def tree_ndims(pytree):
   return jax.tree_util.tree_map(lambda x:x.ndim, pytree)
+
+def block(pytree):
+  # Wait for the asynchronously dispatched computations that produce pytree
+  return jax.tree_util.tree_map(lambda x: x.block_until_ready() if hasattr(x, "block_until_ready") else x, pytree)
+
+def tree_bytes(pytree):
+  return int(sum([x.size*x.dtype.itemsize for x in jax.tree_util.tree_leaves(pytree) if hasattr(x, "dtype")]))
+
+def trees_equal(a, b, atol=None):
+  # Same structure and values.  The values must match exactly unless atol is set.
+  a_leaves, a_treedef = jax.tree_util.tree_flatten(a)
+  b_leaves, b_treedef = jax.tree_util.tree_flatten(b)
+  if a_treedef != b_treedef:
+    return False
+  if atol is None:
+    return all([np.array_equal(x, y) for x, y in zip(a_leaves, b_leaves)])
+  return all([np.allclose(x, y, atol=atol) for x, y in zip(a_leaves, b_leaves)])
@@ -1 +1,5 @@
-from nux.vae.gaussian_vae import *
\ No newline at end of file
+from nux.lazy import lazy_exports
+
+__getattr__, __dir__ = lazy_exports(__name__,
+                                    ["nux.vae.gaussian_vae"],
+                                    submodules=["gaussian_vae"])